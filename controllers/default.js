@@ -1,13 +1,97 @@
 const Pty = require('node-pty');
 const fs = require('fs');
+const net = require('net');
+const childProcess = require('child_process');
+
+// When N3_SERVICE_SOCKET is set, sessions are served by one long lived
+// python order service instead of a new python process per connection.
+const serviceSocket = process.env.N3_SERVICE_SOCKET;
 
 exports.install = function () {
 
     ROUTE('/');
     WEBSOCKET('/', socket, ['raw']);
 
+    if (serviceSocket) {
+        startService();
+    }
+
 };
 
+function startService() {
+
+    const service = childProcess.spawn('python3', ['-m', 'n3orthotics.service'], {
+        cwd: process.env.PWD,
+        env: process.env,
+        stdio: 'inherit'
+    });
+
+    service.on('exit', function (code, signal) {
+        console.log("Order service stopped, restarting");
+        setTimeout(startService, 1000);
+    });
+}
+
+function spawnTerminal(client) {
+
+    client.tty = Pty.spawn('python3', ['run.py'], {
+        name: 'xterm-color',
+        cols: 80,
+        rows: 24,
+        cwd: process.env.PWD,
+        env: process.env
+    });
+
+    client.tty.on('exit', function (code, signal) {
+        client.tty = null;
+        client.close();
+        console.log("Process killed");
+    });
+
+    client.tty.on('data', function (data) {
+        client.send(data);
+    });
+}
+
+function connectService(client) {
+
+    const connection = net.connect(serviceSocket);
+    let connected = false;
+
+    connection.setEncoding('utf8');
+
+    connection.on('connect', function () {
+        connected = true;
+        client.tty = {
+            write: function (msg) {
+                connection.write(msg);
+            },
+            kill: function () {
+                connection.destroy();
+            }
+        };
+    });
+
+    connection.on('data', function (data) {
+        client.send(data);
+    });
+
+    connection.on('error', function (err) {
+        if (!connected) {
+            // Service not running yet, fall back to a terminal of our own
+            spawnTerminal(client);
+        }
+    });
+
+    connection.on('close', function () {
+        if (connected) {
+            client.tty = null;
+            client.close();
+            console.log("Session ended");
+        }
+    });
+}
+
 function socket() {
 
     this.encodedecode = false;
@@ -16,23 +100,11 @@ function socket() {
     this.on('open', function (client) {
 
         // Spawn terminal
-        client.tty = Pty.spawn('python3', ['run.py'], {
-            name: 'xterm-color',
-            cols: 80,
-            rows: 24,
-            cwd: process.env.PWD,
-            env: process.env
-        });
-
-        client.tty.on('exit', function (code, signal) {
-            client.tty = null;
-            client.close();
-            console.log("Process killed");
-        });
-
-        client.tty.on('data', function (data) {
-            client.send(data);
-        });
+        if (serviceSocket) {
+            connectService(client);
+        } else {
+            spawnTerminal(client);
+        }
 
     });
 
@@ -57,4 +129,4 @@ if (process.env.CREDS != null) {
             socket.emit("console_output", "Error saving credentials: " + err);
         }
     });
-}
\ No newline at end of file
+}
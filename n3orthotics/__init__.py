@@ -0,0 +1,3 @@
+"""
+Supporting modules for the N(3)ORTHOTICS order portal in run.py
+"""
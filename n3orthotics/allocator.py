@@ -0,0 +1,145 @@
+"""
+Hands out order numbers and worksheet row slots from counters held in a
+small SQLite file, so concurrent sessions never receive the same number
+and no worksheet column has to be downloaded to work out the next one.
+"""
+import datetime
+import sqlite3
+import threading
+from datetime import timezone
+from n3orthotics.store import local_path
+
+ALLOCATOR_PATH = local_path('N3_ALLOCATOR_PATH', 'allocator.sqlite3')
+MAX_DAILY_ORDERS = 9999
+
+
+class OrderAllocator:
+    """
+    Counters for the daily order sequence and the next free row.
+    Each allocation runs inside an immediate SQLite transaction, which
+    locks the file against other processes until it commits. The
+    counters are seeded once from the order store the first time the
+    file is created. The file is only opened on the first allocation,
+    and threads of one process take turns on its connection.
+    """
+
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Opens the counter file in autocommit mode, transactions being
+        started explicitly by allocate
+        """
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None,
+            check_same_thread=False
+            )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS counters '
+            '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)'
+            )
+
+    def after_fork(self):
+        """
+        Drops the counter file connection in a forked child process,
+        to be reopened on its next allocation
+        """
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def next_order_no(self):
+        """
+        Returns a new order number of todays date + 4 digit sequence
+        """
+        return self.allocate(rows=False)[0]
+
+    def next_row_no(self):
+        """
+        Returns the number of a new, unused worksheet row
+        """
+        return self.allocate(order_no=False)[1]
+
+    def allocate(self, order_no=True, rows=True):
+        """
+        Returns (order_no, row_no), taking the next value of each
+        counter asked for in a single transaction
+        """
+        return self.allocate_many(1, order_no, rows)[0]
+
+    def allocate_many(self, count, order_no=True, rows=True):
+        """
+        Returns a list of count (order_no, row_no) pairs in a single
+        transaction, the row numbers being consecutive
+        """
+        with self.lock:
+            return self._allocate_many(count, order_no, rows)
+
+    def _allocate_many(self, count, order_no, rows):
+        """
+        Runs the allocation transaction for allocate_many
+        """
+        now = datetime.datetime.now(timezone.utc)
+        order_date = int(now.strftime('%y%m%d'))
+        if self.connection is None:
+            self.connect()
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            counters = dict(cursor.execute('SELECT name, value FROM counters'))
+            if not counters:
+                counters = self._seed()
+            order_nos = row_nos = [None] * count
+            if order_no:
+                if counters['order_date'] != order_date:
+                    counters['order_date'] = order_date
+                    counters['order_seq'] = 0
+                first_seq = counters['order_seq'] + 1
+                counters['order_seq'] += count
+                if counters['order_seq'] > MAX_DAILY_ORDERS:
+                    raise ValueError(
+                        f'Only {MAX_DAILY_ORDERS} order numbers can be '
+                        'allocated each day'
+                        )
+                order_nos = [
+                    order_date * 10000 + seq
+                    for seq in range(first_seq, counters['order_seq'] + 1)
+                    ]
+            if rows:
+                # Sharded stores start each month on a higher row
+                counters['row_no'] = max(
+                    counters['row_no'], self.store.row_floor(now))
+                first_row = counters['row_no'] + 1
+                counters['row_no'] += count
+                row_nos = list(range(first_row, counters['row_no'] + 1))
+            cursor.executemany(
+                'INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                counters.items()
+                )
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return list(zip(order_nos, row_nos))
+
+    def _seed(self):
+        """
+        Reads the last order number and row in use from the order store
+        """
+        last_order_no = self.store.last_order_no() or 0
+        return {
+            'order_date': last_order_no // 10000,
+            'order_seq': last_order_no % 10000,
+            'row_no': self.store.row_count(),
+            }
+
+
+def open_allocator(store):
+    """
+    Opens the allocator file named by N3_ALLOCATOR_PATH, by default
+    allocator.sqlite3, or one in a temporary directory for the fake sheet
+    """
+    return OrderAllocator(ALLOCATOR_PATH, store)
@@ -0,0 +1,361 @@
+"""
+Columnar order analytics. The orders worksheet is read one chunk at a
+time into NumPy arrays: size_eu (column D) as floats, arch height, insole
+width and status (E, F and I) as category codes, order_no as int64 and
+the order and update dates (H and J) as datetime64. Each report is then
+worked out over whole columns at once instead of looping over rows of
+strings, so reports over a million orders take a fraction of a second.
+
+Reports:
+    sizes   orders per EU size per week, weeks starting on Monday
+    mix     orders per arch height and insole width
+    lead    hours from the order date to the last update for the
+            orders now at each later status: count, median, 90th
+            percentile and mean
+
+Needs numpy installed.
+
+Usage: python3 -m n3orthotics.analytics [sizes|mix|lead] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import timezone
+from n3orthotics.exporter import parse_time
+from n3orthotics.status import STATUS_RULES
+from n3orthotics.store import COLUMNS, open_store
+from n3orthotics.validation import HEIGHTS, WIDTHS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK_SIZE = 10000
+HEIGHT_NAMES = tuple(HEIGHTS.values())
+WIDTH_NAMES = tuple(WIDTHS.values())
+STATUS_NAMES = tuple(STATUS_RULES)
+# Statuses with no time spent in production behind them
+NOT_STARTED = ('PENDING', 'NEW ORDER')
+SIZE_EU = COLUMNS.index('size_eu')
+HEIGHT = COLUMNS.index('height')
+WIDTH = COLUMNS.index('width')
+ORDER_NO = COLUMNS.index('order_no')
+ORDER_DATE = COLUMNS.index('order_date')
+ORDER_STATUS = COLUMNS.index('order_status')
+ORDER_UPDATE = COLUMNS.index('order_update')
+
+
+def require_numpy():
+    """
+    Stops with a message if numpy is not installed
+    """
+    if numpy is None:
+        raise SystemExit('Order analytics needs numpy installed')
+
+
+class OrderColumns:
+    """
+    The orders of a worksheet as one array per column. Category columns
+    hold the position of the value in HEIGHT_NAMES, WIDTH_NAMES or
+    STATUS_NAMES, -1 when it is blank or unknown. Blank sizes are NaN,
+    blank order numbers 0 and blank dates NaT.
+    """
+
+    def __init__(self, chunks):
+        require_numpy()
+        self.size_eu = _join(chunks, 0, numpy.float64)
+        self.height = _join(chunks, 1, numpy.int8)
+        self.width = _join(chunks, 2, numpy.int8)
+        self.status = _join(chunks, 3, numpy.int8)
+        self.order_no = _join(chunks, 4, numpy.int64)
+        self.order_date = _join(chunks, 5, 'datetime64[s]')
+        self.order_update = _join(chunks, 6, 'datetime64[s]')
+
+    def __len__(self):
+        return len(self.order_no)
+
+
+def _join(chunks, position, dtype):
+    """
+    Returns one column of every chunk as a single array
+    """
+    return numpy.concatenate(
+        [chunk[position] for chunk in chunks]
+        or [numpy.empty(0, dtype)])
+
+
+def load_columns(store, chunk_size=CHUNK_SIZE):
+    """
+    Reads every order in store into an OrderColumns, skipping the
+    headings row
+    """
+    require_numpy()
+    chunks = []
+    for chunk in store.iter_rows(chunk_size):
+        rows = [
+            values + [''] * (len(COLUMNS) - len(values))
+            for row, values in chunk if row > 1
+            ]
+        if rows:
+            chunks.append(chunk_columns(list(zip(*rows))))
+    return OrderColumns(chunks)
+
+
+def chunk_columns(columns):
+    """
+    Converts the string columns of one chunk into typed arrays, in the
+    order OrderColumns takes them
+    """
+    return (
+        _floats(columns[SIZE_EU]),
+        _codes(columns[HEIGHT], HEIGHT_NAMES),
+        _codes(columns[WIDTH], WIDTH_NAMES),
+        _codes(columns[ORDER_STATUS], STATUS_NAMES),
+        _integers(columns[ORDER_NO]),
+        _datetimes(columns[ORDER_DATE]),
+        _datetimes(columns[ORDER_UPDATE]),
+        )
+
+
+def _floats(column):
+    """
+    Returns a column of numbers as floats, NaN where blank or not a
+    number
+    """
+    values = numpy.array(column, dtype=str)
+    values[values == ''] = 'nan'
+    try:
+        return values.astype(numpy.float64)
+    except ValueError:
+        return numpy.array([_float(value) for value in column])
+
+
+def _float(value):
+    """
+    Returns value as a float, NaN if it is not a number
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def _codes(column, names):
+    """
+    Returns a column of category names as their positions in names
+    """
+    codes = {name: code for code, name in enumerate(names)}
+    return numpy.fromiter(
+        (codes.get(value, -1) for value in column), numpy.int8, len(column))
+
+
+def _integers(column):
+    """
+    Returns a column of whole numbers as int64, 0 where blank or not
+    a whole number
+    """
+    values = numpy.array(column, dtype=str)
+    values[~numpy.char.isdigit(values)] = '0'
+    return values.astype(numpy.int64)
+
+
+def _datetimes(column):
+    """
+    Returns a column of ISO timestamps as UTC datetime64, NaT where
+    blank or not a timestamp. The timestamps the order flow writes are
+    all UTC, so they are cut to the second and converted in one go,
+    other offsets being parsed one at a time.
+    """
+    values = numpy.array(column, dtype=str)
+    blank = values == ''
+    if (blank | numpy.char.endswith(values, '+00:00')).all():
+        values = values.astype('U19')
+        values[blank] = 'NaT'
+        try:
+            return values.astype('datetime64[s]')
+        except ValueError:
+            pass
+    return numpy.array([_datetime(value) for value in column],
+                       dtype='datetime64[s]')
+
+
+def _datetime(value):
+    """
+    Returns value as a naive UTC datetime, None if it is not a timestamp
+    """
+    when = parse_time(value)
+    if when is None:
+        return None
+    return when.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def size_by_week(columns):
+    """
+    Returns (weeks, sizes, counts), counts[i, j] being the orders of
+    size sizes[j] made in the week starting on Monday weeks[i]
+    """
+    require_numpy()
+    keep = ~numpy.isnan(columns.size_eu) & ~numpy.isnat(columns.order_date)
+    # datetime64 weeks start on Thursday, the day of the epoch
+    monday = numpy.timedelta64(3, 'D')
+    dates = columns.order_date[keep].astype('datetime64[D]')
+    weeks, week_index = numpy.unique(
+        (dates + monday).astype('datetime64[W]').astype('datetime64[D]')
+        - monday, return_inverse=True)
+    sizes, size_index = numpy.unique(
+        columns.size_eu[keep], return_inverse=True)
+    counts = numpy.bincount(
+        week_index * len(sizes) + size_index,
+        minlength=len(weeks) * len(sizes))
+    return weeks, sizes, counts.reshape(len(weeks), len(sizes))
+
+
+def feature_mix(columns):
+    """
+    Returns counts, counts[i, j] being the orders of arch height
+    HEIGHT_NAMES[i] and insole width WIDTH_NAMES[j]
+    """
+    require_numpy()
+    keep = (columns.height >= 0) & (columns.width >= 0)
+    pairs = (columns.height[keep].astype(numpy.intp) * len(WIDTH_NAMES)
+             + columns.width[keep])
+    counts = numpy.bincount(
+        pairs, minlength=len(HEIGHT_NAMES) * len(WIDTH_NAMES))
+    return counts.reshape(len(HEIGHT_NAMES), len(WIDTH_NAMES))
+
+
+def lead_times(columns):
+    """
+    Returns a dict of status to the count, median, 90th percentile and
+    mean hours from the order date to the last update of the orders now
+    at that status. The last update (column J) is when the order moved
+    to its current status, so this is the time an order takes from
+    being ordered to reaching each later status.
+    """
+    require_numpy()
+    keep = ~numpy.isnat(columns.order_date) & \
+        ~numpy.isnat(columns.order_update) & (columns.status >= 0)
+    hours = (columns.order_update[keep] - columns.order_date[keep]) / \
+        numpy.timedelta64(1, 'h')
+    statuses = columns.status[keep]
+    order = numpy.argsort(statuses, kind='stable')
+    hours, statuses = hours[order], statuses[order]
+    bounds = numpy.searchsorted(
+        statuses, numpy.arange(len(STATUS_NAMES) + 1))
+    report = {}
+    for code, name in enumerate(STATUS_NAMES):
+        if name in NOT_STARTED:
+            continue
+        group = hours[bounds[code]:bounds[code + 1]]
+        if len(group):
+            median, slowest = numpy.percentile(group, [50, 90])
+            report[name] = {
+                'orders': int(len(group)),
+                'median': float(median),
+                'p90': float(slowest),
+                'mean': float(group.mean()),
+                }
+    return report
+
+
+def sizes_report(columns):
+    """
+    Returns the size per week report as a dict, for JSON output
+    """
+    weeks, sizes, counts = size_by_week(columns)
+    return {
+        'sizes': [float(size) for size in sizes],
+        'weeks': {
+            f'{week}': [int(count) for count in row]
+            for week, row in zip(weeks, counts)
+            },
+        }
+
+
+def mix_report(columns):
+    """
+    Returns the arch height and insole width mix as a dict, for JSON
+    output
+    """
+    counts = feature_mix(columns)
+    return {
+        height: dict(zip(WIDTH_NAMES, (int(count) for count in row)))
+        for height, row in zip(HEIGHT_NAMES, counts)
+        }
+
+
+REPORTS = {'sizes': sizes_report, 'mix': mix_report, 'lead': lead_times}
+
+
+def print_sizes(report):
+    """
+    Prints orders per size per week, one row per week
+    """
+    print('week        ' + ''.join(f'{size:>6g}' for size in report['sizes']))
+    for week, counts in report['weeks'].items():
+        print(f'{week:<12}' + ''.join(f'{count:>6}' for count in counts))
+
+
+def print_mix(report):
+    """
+    Prints the arch height and insole width mix as a table
+    """
+    print(f'{"":<8}' + ''.join(f'{width:>10}' for width in WIDTH_NAMES))
+    for height, counts in report.items():
+        print(f'{height:<8}' + ''.join(
+            f'{counts[width]:>10}' for width in WIDTH_NAMES))
+
+
+def print_lead(report):
+    """
+    Prints the hours from ordering to each status
+    """
+    print(f'{"status":<20}{"orders":>8}{"median h":>10}{"p90 h":>10}'
+          f'{"mean h":>10}')
+    for status, times in report.items():
+        print(f'{status:<20}{times["orders"]:>8}{times["median"]:>10.1f}'
+              f'{times["p90"]:>10.1f}{times["mean"]:>10.1f}')
+
+
+PRINTERS = {'sizes': print_sizes, 'mix': print_mix, 'lead': print_lead}
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('reports', nargs='*',
+                        help='sizes, mix or lead, all by default')
+    parser.add_argument('--json', action='store_true',
+                        help='print the reports as one JSON object')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    for name in args.reports:
+        if name not in REPORTS:
+            parser.error(f'unknown report {name}, choose from sizes, mix '
+                         'or lead')
+    require_numpy()
+
+    started = time.perf_counter()
+    columns = load_columns(open_store(), args.chunk_size)
+    loaded = time.perf_counter()
+    results = {
+        name: REPORTS[name](columns) for name in args.reports or REPORTS}
+    finished = time.perf_counter()
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for name, report in results.items():
+            print()
+            PRINTERS[name](report)
+    print(f'\n{len(columns)} orders loaded in '
+          f'{(loaded - started) * 1000:.0f} ms, reported in '
+          f'{(finished - loaded) * 1000:.0f} ms', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,543 @@
+"""
+HTTP JSON order API for clinic partner systems, served beside the
+terminal UI from one asyncio process. Connections are kept alive
+between requests, and the order store calls run on a fixed pool of
+N3_API_WORKERS threads sharing the one store, its write-behind journal
+and its google client, so no request opens its own connection.
+
+Endpoints:
+    POST /orders                   create an order, as submit_order
+    POST /orders/pending           save an order as PENDING
+    GET  /orders/<order_no>        retrieve an order
+    PATCH /orders/<order_no>       change some of its details
+    POST /orders/<order_no>/cancel cancel it
+    POST /batch                    run up to BATCH_LIMIT of the above,
+                                   {"requests": [{"method": "POST",
+                                   "path": "/orders", "body": {...}}]}
+
+Every request needs a partner's API key, sent as
+"Authorization: Bearer <key>". Keys are kept in the N3_API_KEYS file as
+SHA-256 hashes, each with the partner's name and the scopes it may use:
+read, create, edit and cancel. A missing or unknown key gets a 401 reply
+and an endpoint outside the key's scopes a 403. Add a key with:
+    python3 -m n3orthotics.api --add-key <partner> --scope read ...
+
+Request and response bodies are JSON objects using the worksheet
+column names. PATCH and cancel may send the order_update of the version
+they last read, and get a 409 reply if the order changed since. Field
+errors are a 422 reply listing each field, error code and message.
+
+Start with: python3 -m n3orthotics.api
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import secrets
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from n3orthotics.order import Order
+from n3orthotics.status import is_cancelable, is_modifiable
+from n3orthotics.store import COLUMN_LETTERS, COLUMNS, ConflictError
+from n3orthotics.validation import ORDER_RULES, ORDER_SCHEMA, FieldError
+
+API_HOST = os.environ.get('N3_API_HOST', '127.0.0.1')
+API_PORT = int(os.environ.get('N3_API_PORT', '8080'))
+API_WORKERS = int(os.environ.get('N3_API_WORKERS', '8'))
+API_KEYS = os.environ.get('N3_API_KEYS', 'api-keys.json')
+BATCH_LIMIT = 100
+MAX_BODY = 1024 * 1024
+MAX_HEADERS = 100
+SCOPES = ('read', 'create', 'edit', 'cancel')
+# Fields a partner sees, row_no being internal to the store
+PUBLIC_FIELDS = [column for column in COLUMNS if column != 'row_no']
+# method, path, handler, scope needed, a batch needing those of its
+# requests
+ROUTES = [
+    ('POST', re.compile(r'^/orders$'), 'create', 'create'),
+    ('POST', re.compile(r'^/orders/pending$'), 'save_pending', 'create'),
+    ('GET', re.compile(r'^/orders/(\d+)$'), 'retrieve', 'read'),
+    ('PATCH', re.compile(r'^/orders/(\d+)$'), 'edit', 'edit'),
+    ('POST', re.compile(r'^/orders/(\d+)/cancel$'), 'cancel', 'cancel'),
+    ('POST', re.compile(r'^/batch$'), 'batch', None),
+    ]
+
+
+class ApiError(Exception):
+    """
+    Ends a request with an HTTP status and a JSON body
+    """
+
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.body = {'error': message, **details}
+
+
+def hash_key(key):
+    """
+    Returns the hash an API key is kept as
+    """
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def load_keys(path=API_KEYS):
+    """
+    Returns the partners of the API keys file at path, a dict of key
+    hash to {"partner": name, "scopes": [...]}, empty if there is no
+    file
+    """
+    try:
+        with open(path, encoding='utf-8') as keys_file:
+            return json.load(keys_file)
+    except FileNotFoundError:
+        return {}
+
+
+def add_key(partner, scopes, path=API_KEYS):
+    """
+    Adds a new API key for partner limited to scopes to the keys file
+    at path, readable only by its owner, and returns the key
+    """
+    keys = load_keys(path)
+    key = secrets.token_urlsafe(32)
+    keys[hash_key(key)] = {'partner': partner, 'scopes': sorted(scopes)}
+    temporary = f'{path}.{os.getpid()}.tmp'
+    descriptor = os.open(
+        temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w', encoding='utf-8') as keys_file:
+        json.dump(keys, keys_file, indent=2)
+    os.replace(temporary, path)
+    return key
+
+
+def authenticate(headers, keys):
+    """
+    Returns the partner of the bearer key in headers, raising a 401
+    ApiError if there is none or it is unknown
+    """
+    scheme, _, key = headers.get('authorization', '').partition(' ')
+    partner = keys.get(hash_key(key.strip())) \
+        if scheme.lower() == 'bearer' else None
+    if partner is None:
+        raise ApiError(HTTPStatus.UNAUTHORIZED,
+                       'Send a partner API key as "Authorization: Bearer"')
+    return partner
+
+
+def order_body(order):
+    """
+    Returns the public fields of order as a dict
+    """
+    values = dict(zip(COLUMNS, order.to_row()))
+    return {field: values[field] for field in PUBLIC_FIELDS}
+
+
+def field_errors(errors):
+    """
+    Returns an ApiError listing FieldErrors
+    """
+    return ApiError(
+        HTTPStatus.UNPROCESSABLE_ENTITY, 'Invalid order details',
+        errors=[error.to_dict() for error in errors])
+
+
+class OrderApi:
+    """
+    The order operations of run.py as JSON request handlers. Each
+    handler is a blocking call made on a worker thread and returns
+    (status, body).
+    """
+
+    def __init__(self, run):
+        self.run = run
+
+    def dispatch(self, method, path, body, scopes):
+        """
+        Routes one request from a partner allowed scopes to its
+        handler, returning (status, body)
+        """
+        if body is not None and not isinstance(body, dict):
+            return HTTPStatus.BAD_REQUEST, {
+                'error': 'The body must be a JSON object'}
+        allowed = []
+        for route_method, pattern, name, scope in ROUTES:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if route_method != method:
+                allowed.append(route_method)
+                continue
+            try:
+                if scope is None:
+                    return getattr(self, name)(body, scopes)
+                require(scope, scopes)
+                return getattr(self, name)(body, *match.groups())
+            except ApiError as error:
+                return error.status, error.body
+        if allowed:
+            return HTTPStatus.METHOD_NOT_ALLOWED, {
+                'error': f'{method} is not allowed, use {", ".join(allowed)}'}
+        return HTTPStatus.NOT_FOUND, {'error': f'No endpoint {path}'}
+
+    def create(self, body):
+        return self.create_many([body])[0]
+
+    def save_pending(self, body):
+        return self.create_many([body], pending=True)[0]
+
+    def create_many(self, bodies, pending=False):
+        """
+        Creates an order for each valid body with one allocation and
+        one write for them all. Returns (status, body) for each.
+        """
+        replies = [None] * len(bodies)
+        orders = []
+        for position, (values, errors) in enumerate(
+                ORDER_SCHEMA.check_many(bodies)):
+            if errors:
+                error = field_errors(errors)
+                replies[position] = (error.status, error.body)
+            else:
+                orders.append((position, Order(**values)))
+        if not orders:
+            return replies
+        slots = self.run.ALLOCATOR.allocate_many(len(orders))
+        for (_, order), (order_no, row_no) in zip(orders, slots):
+            order.order_no, order.row_no = order_no, row_no
+            if pending:
+                self.run.mark_pending(order)
+            else:
+                self.run.update_date_ordered(order)
+        self.run.STORE.append_rows([order.to_row() for _, order in orders])
+        for position, order in orders:
+            replies[position] = (HTTPStatus.CREATED, order_body(order))
+        return replies
+
+    def find(self, order_no):
+        """
+        Returns the Order numbered order_no, raising a 404 ApiError if
+        there is none
+        """
+        found = self.run.STORE.find_order(order_no)
+        if found is None:
+            raise ApiError(
+                HTTPStatus.NOT_FOUND, f'Order number {order_no} not found')
+        row, values = found
+        return Order.from_row(values, row)
+
+    def retrieve(self, body, order_no):
+        return HTTPStatus.OK, order_body(self.find(order_no))
+
+    def edit(self, body, order_no):
+        changes = {}
+        errors = []
+        for field, value in (body or {}).items():
+            if field not in ORDER_RULES:
+                continue
+            try:
+                changes[field] = ORDER_SCHEMA.check_field(field, value)
+            except FieldError as error:
+                errors.append(error)
+        if errors:
+            raise field_errors(errors)
+        if not changes:
+            raise ApiError(
+                HTTPStatus.BAD_REQUEST,
+                f'Nothing to change, send any of {", ".join(ORDER_RULES)}')
+        order = self.find(order_no)
+        base = order.to_row()
+        expected = self.expected(order, body, is_modifiable)
+        for field, value in changes.items():
+            setattr(order, field, value)
+        order.order_update = self.run.generate_utc_time()
+        order.order_status = 'UPDATED ORDER'
+        cells = order.cells(list(changes) + ['order_status', 'order_update'])
+        self.write(order, body, expected, is_modifiable, lambda version:
+                   self.run.STORE.update_cells_checked(
+                       order.row_no, cells, version), base, list(changes))
+        return HTTPStatus.OK, order_body(order)
+
+    def cancel(self, body, order_no):
+        order = self.find(order_no)
+        expected = self.expected(order, body, is_cancelable)
+        order.order_update = self.run.generate_utc_time()
+        order.order_status = 'CANCELED'
+        cells = {
+            COLUMN_LETTERS[COLUMNS.index('order_status')]: order.order_status,
+            COLUMN_LETTERS[COLUMNS.index('order_update')]: order.order_update,
+            }
+        self.write(order, body, expected, is_cancelable, lambda version:
+                   self.run.STORE.update_cells_checked(
+                       order.row_no, cells, version))
+        return HTTPStatus.OK, order_body(order)
+
+    @staticmethod
+    def expected(order, body, allowed):
+        """
+        Returns the version a change to order is made over, the
+        order_update sent in body if any. Raises a 409 ApiError if the
+        order's status does not allow the change.
+        """
+        if not allowed(order.order_status):
+            raise ApiError(
+                HTTPStatus.CONFLICT, f'Order {order.order_no} is at the '
+                f'{order.order_status} stage and can no longer be changed',
+                order=order_body(order))
+        return (body or {}).get('order_update', order.order_update)
+
+    def write(self, order, body, expected, allowed, write, base=None,
+              fields=()):
+        """
+        Makes a checked write, raising a 409 ApiError with the latest
+        order if it could not be made. A version sent in body must still
+        be current, otherwise the write is merged over newer versions as
+        the terminal does, fields being the ones changed since order was
+        read as the row values base.
+        """
+        if 'order_update' in (body or {}):
+            try:
+                write(expected)
+                return
+            except ConflictError as conflict:
+                raise ApiError(
+                    HTTPStatus.CONFLICT, f'Order {order.order_no} was '
+                    f'changed at "{conflict.values[9]}" since the version '
+                    'sent', order=order_body(self.find(order.order_no))
+                    ) from None
+        messages = []
+        if not self.run.checked_write(
+                order, expected, allowed, write, messages.append, base,
+                fields):
+            raise ApiError(
+                HTTPStatus.CONFLICT, messages[-1].strip(),
+                order=order_body(self.find(order.order_no)))
+
+    def batch(self, body, scopes):
+        requests = (body or {}).get('requests')
+        if not isinstance(requests, list):
+            raise ApiError(HTTPStatus.BAD_REQUEST,
+                           'Send {"requests": [...]} to /batch')
+        if len(requests) > BATCH_LIMIT:
+            raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                           f'At most {BATCH_LIMIT} requests per batch')
+        replies = [None] * len(requests)
+        creates = {False: [], True: []}
+        for position, request in enumerate(requests):
+            if not isinstance(request, dict):
+                replies[position] = (HTTPStatus.BAD_REQUEST,
+                                     {'error': 'Unreadable request'})
+                continue
+            method = f'{request.get("method", "GET")}'.upper()
+            path = f'{request.get("path", "")}'
+            if method == 'POST' and path in ('/orders', '/orders/pending') \
+                    and 'create' in scopes:
+                # New orders share one allocation and one write
+                creates[path == '/orders/pending'].append(
+                    (position, request.get('body')))
+            elif path == '/batch':
+                replies[position] = (HTTPStatus.BAD_REQUEST,
+                                     {'error': 'Batches cannot be nested'})
+            else:
+                replies[position] = self.dispatch(
+                    method, path, request.get('body'), scopes)
+        for pending, created in creates.items():
+            if created:
+                for (position, _), reply in zip(created, self.create_many(
+                        [body for _, body in created], pending)):
+                    replies[position] = reply
+        return HTTPStatus.OK, {'responses': [
+            {'status': int(status), 'body': reply_body}
+            for status, reply_body in replies
+            ]}
+
+
+def require(scope, scopes):
+    """
+    Raises a 403 ApiError unless scope is one of a partner's scopes
+    """
+    if scope not in scopes:
+        raise ApiError(HTTPStatus.FORBIDDEN,
+                       f'This API key may not {scope} orders')
+
+
+async def read_line(reader, status, message):
+    """
+    Reads one line of a request, raising an ApiError of status if it is
+    longer than the reader's limit
+    """
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError) as error:
+        raise ApiError(status, message) from error
+
+
+async def read_request(reader):
+    """
+    Reads one HTTP/1.1 request, returning (method, path, headers, body),
+    or None when the client has closed the connection
+    """
+    line = await read_line(
+        reader, HTTPStatus.BAD_REQUEST, 'The request line is too long')
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError as error:
+        raise ApiError(HTTPStatus.BAD_REQUEST, 'Bad request line') from error
+    headers = {}
+    while True:
+        line = await read_line(
+            reader, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+            'A header line is too long')
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise ApiError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+                           f'At most {MAX_HEADERS} headers per request')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    headers['version'] = version
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        raise ApiError(HTTPStatus.LENGTH_REQUIRED,
+                       'Send a Content-Length instead of chunks')
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise ApiError(HTTPStatus.BAD_REQUEST, 'Bad Content-Length')
+    if length > MAX_BODY:
+        raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                       f'Bodies are limited to {MAX_BODY} bytes')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?')[0], headers, body
+
+
+def keep_alive(headers):
+    """
+    Checks if the client wants the connection kept open
+    """
+    connection = headers.get('connection', '').lower()
+    if headers.get('version') == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+async def write_response(writer, status, body, alive):
+    """
+    Sends a JSON response
+    """
+    payload = json.dumps(body).encode('utf-8')
+    status = HTTPStatus(status)
+    challenge = 'WWW-Authenticate: Bearer\r\n' \
+        if status == HTTPStatus.UNAUTHORIZED else ''
+    writer.write(
+        f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+        f'{challenge}Content-Type: application/json\r\n'
+        f'Content-Length: {len(payload)}\r\n'
+        f'Connection: {"keep-alive" if alive else "close"}\r\n\r\n'
+        .encode('latin-1') + payload)
+    await writer.drain()
+
+
+async def serve_connection(reader, writer, api, executor, keys):
+    """
+    Answers requests on one connection until the client closes it or
+    asks for it to be closed, each from a partner with one of keys
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except ApiError as error:
+                await write_response(writer, error.status, error.body, False)
+                break
+            if request is None:
+                break
+            method, path, headers, raw_body = request
+            alive = keep_alive(headers)
+            try:
+                partner = authenticate(headers, keys)
+            except ApiError as error:
+                await write_response(writer, error.status, error.body, alive)
+                if not alive:
+                    break
+                continue
+            try:
+                body = json.loads(raw_body) if raw_body else None
+            except ValueError:
+                await write_response(
+                    writer, HTTPStatus.BAD_REQUEST,
+                    {'error': 'The body is not valid JSON'}, alive)
+            else:
+                try:
+                    status, reply = await loop.run_in_executor(
+                        executor, api.dispatch, method, path, body,
+                        partner['scopes'])
+                except Exception:  # pylint: disable=broad-except
+                    traceback.print_exc(file=sys.stderr)
+                    status = HTTPStatus.INTERNAL_SERVER_ERROR
+                    reply = {'error': 'The order could not be processed'}
+                await write_response(writer, status, reply, alive)
+            if not alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(api, keys, host=API_HOST, port=API_PORT,
+                workers=API_WORKERS):
+    """
+    Serves the API on host and port to partners with one of keys until
+    cancelled
+    """
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='api')
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(
+            reader, writer, api, executor, keys),
+        host, port)
+    print(f'n3orthotics order API listening on http://{host}:{port}')
+    if not keys:
+        print(f'No API keys in {API_KEYS}, every request will be refused')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=True)
+
+
+def main(argv=None):
+    """
+    Loads run.py and opens the order store, then serves the API, or
+    adds an API key with --add-key
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--add-key', metavar='PARTNER',
+                        help='add an API key for PARTNER and print it')
+    parser.add_argument('--scope', action='append', choices=SCOPES,
+                        help='what the new key may do, can be repeated '
+                        '(read only by default)')
+    args = parser.parse_args(argv)
+    if args.add_key:
+        print(add_key(args.add_key, set(args.scope or ['read'])))
+        return
+    import run
+    run.STORE.open()
+    try:
+        asyncio.run(serve(OrderApi(run), load_keys()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        run.STORE.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+Order lifecycle benchmarks. Scripts the terminal flows of run.py (new
+order, retrieve, edit and cancel) against the offline fake of google
+sheets filled with 1k, 100k and 1M orders, and reports latency
+percentiles, remote calls and worksheet cache hits per operation and
+peak memory for each. Every remote call takes --latency seconds, by
+default N3_FAKE_LATENCY or 50 ms, near a real google sheets call.
+
+With --save the results become the baseline. With --baseline the run
+fails if any flow's median time or peak memory grows past the baseline
+by more than --tolerance, or it makes more remote calls.
+
+Usage: python3 -m n3orthotics.benchmark [--sizes 1000,100000]
+           [--save | --baseline] [--path benchmark-baseline.json]
+"""
+import argparse
+import contextlib
+import json
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from n3orthotics import fakesheets
+from n3orthotics.allocator import OrderAllocator
+from n3orthotics.cache import CachedWorksheet
+from n3orthotics.journal import Journal, JournaledStore
+from n3orthotics.order import Session
+from n3orthotics.status import is_modifiable
+from n3orthotics.store import SheetStore
+
+SIZES = (1000, 100000, 1000000)
+ITERATIONS = 50
+TOLERANCE = 0.5
+MIN_SLOWDOWN = 0.001
+BASELINE_PATH = 'benchmark-baseline.json'
+PERCENTILES = (50, 95, 99)
+
+
+class Script:
+    """
+    Stands in for input(), answering prompts from a list of replies
+    """
+
+    def __init__(self):
+        self.replies = []
+
+    def feed(self, *replies):
+        self.replies.extend(replies)
+
+    def __call__(self, prompt=''):
+        if not self.replies:
+            raise RuntimeError(f'No scripted reply for prompt {prompt!r}')
+        return self.replies.pop(0)
+
+
+@contextlib.contextmanager
+def scripted(run, store, allocator, script):
+    """
+    Points run.py at store and allocator, answers its prompts from
+    script and silences its output and screen clearing
+    """
+    saved = run.STORE, run.ALLOCATOR, run.clear_screen
+    run.STORE, run.ALLOCATOR = store, allocator
+    run.clear_screen = lambda: None
+    # Module globals shadow the builtins for the code in run.py
+    run.input = script
+    run.print = lambda *args, **kwargs: None
+    try:
+        yield
+    finally:
+        run.STORE, run.ALLOCATOR, run.clear_screen = saved
+        del run.input, run.print
+
+
+def new_order(run, script, session, order_no):
+    """
+    New order: user details, confirmation, order details and submit
+    """
+    script.feed('Ann', 'Lee', 'ann.lee@example.com', 'y', '42', 'm', 's',
+                'y')
+    run.new_order_screen(session)
+    run.yes_no_user(session)
+    run.submit_order(session)
+
+
+def retrieve(run, script, session, order_no):
+    """
+    Retrieve an order by its number
+    """
+    script.feed(order_no)
+    run.display_order(session)
+
+
+def edit(run, script, session, order_no):
+    """
+    Retrieve an order, change the first name and resubmit it
+    """
+    script.feed(order_no, '1', 'Zoe', '7')
+    run.display_order(session)
+    run.validate_change_feature_of_order(session)
+    run.change_feature_of_order(session)
+    run.validate_change_feature_of_order(session)
+    run.change_feature_of_order(session)
+
+
+def cancel(run, script, session, order_no):
+    """
+    Retrieve an order and cancel it
+    """
+    script.feed(order_no, 'y')
+    run.display_order(session)
+    run.update_to_canceled_status(session)
+
+
+FLOWS = {'new order': new_order, 'retrieve': retrieve, 'edit': edit,
+         'cancel': cancel}
+
+
+def percentile(values, percent):
+    """
+    Returns the nearest rank percentile of values
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def open_bench_store(rows, latency, workdir, journal=True):
+    """
+    Returns (store, client) for a fake spreadsheet of rows orders,
+    wrapped the way open_store wraps the sheets backend
+    """
+    client = fakesheets.FakeClient(latency, 0, 0)
+    spreadsheet = fakesheets.open_spreadsheet(
+        f'benchmark {rows}', rows, client)
+    store = SheetStore(CachedWorksheet(spreadsheet.worksheet('orders')))
+    if journal:
+        store = JournaledStore(store, Journal(f'{workdir}/journal.sqlite3'))
+        store.start()
+    return store, client
+
+
+def pick_orders(worksheet, count):
+    """
+    Returns order numbers of count random modifiable orders, each used
+    once since a cancel cannot be repeated
+    """
+    rows = worksheet.grid.rows[1:]
+    picked = []
+    while len(picked) < count:
+        values = random.choice(rows)
+        if is_modifiable(values[8]) and values[6] not in picked:
+            picked.append(values[6])
+    return picked
+
+
+def bench_size(run, rows, iterations, latency, journal=True):
+    """
+    Runs every flow iterations times against rows orders. Returns a
+    dict of flow name to its results.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        store, client = open_bench_store(rows, latency, workdir, journal)
+        allocator = OrderAllocator(f'{workdir}/allocator.sqlite3', store)
+        order_nos = pick_orders(
+            store.worksheet.worksheet, (iterations + 1) * len(FLOWS) + 1)
+        script = Script()
+        with scripted(run, store, allocator, script):
+            # The first lookup builds the order index, time it apart
+            started = time.perf_counter()
+            store.find_order(order_nos[0])
+            results['index load'] = {
+                'seconds': time.perf_counter() - started}
+            for name, flow in FLOWS.items():
+                results[name] = bench_flow(
+                    flow, run, script, store, client, order_nos,
+                    iterations)
+        if journal:
+            store.drain()
+    fakesheets.SPREADSHEETS.pop(f'benchmark {rows}', None)
+    return results
+
+
+def bench_flow(flow, run, script, store, client, order_nos, iterations):
+    """
+    Times iterations runs of flow, counting the remote calls each run
+    makes including writes sent later by the journal and the reads the
+    worksheet cache answered, then runs it once more under tracemalloc
+    for its peak memory
+    """
+    timings = []
+    calls = 0
+    peak = 0
+    cache = store.worksheet
+    hits = cache.hits
+    for _ in range(iterations + 1):
+        session = Session()
+        before = sum(client.calls.values())
+        started = time.perf_counter()
+        if len(timings) == iterations:
+            tracemalloc.start()
+            flow(run, script, session, order_nos.pop())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            flow(run, script, session, order_nos.pop())
+            timings.append(time.perf_counter() - started)
+        if hasattr(store, 'drain'):
+            store.drain()
+        calls += sum(client.calls.values()) - before
+    result = {
+        f'p{percent}': percentile(timings, percent) for percent in PERCENTILES
+        }
+    result['calls'] = calls / (iterations + 1)
+    result['cache_hits'] = (cache.hits - hits) / (iterations + 1)
+    result['peak_kib'] = peak / 1024
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of regressions of results against baseline
+    """
+    regressions = []
+    for size, flows in results.items():
+        for name, result in flows.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None or 'calls' not in result:
+                continue
+            # The median is compared as the tail is mostly scheduling
+            # noise, and sub-millisecond timings need a floor as well
+            if result['p50'] > base['p50'] * (1 + tolerance) and \
+                    result['p50'] - base['p50'] > MIN_SLOWDOWN:
+                regressions.append(
+                    f'{size} {name}: p50 {result["p50"] * 1000:.2f} ms, '
+                    f'baseline {base["p50"] * 1000:.2f} ms')
+            if result['calls'] > base['calls']:
+                regressions.append(
+                    f'{size} {name}: {result["calls"]:.1f} remote calls, '
+                    f'baseline {base["calls"]:.1f}')
+            if result['peak_kib'] > base['peak_kib'] * (1 + tolerance):
+                regressions.append(
+                    f'{size} {name}: peak {result["peak_kib"]:.0f} KiB, '
+                    f'baseline {base["peak_kib"]:.0f} KiB')
+    return regressions
+
+
+def print_results(size, flows):
+    """
+    Prints the results for one sheet size
+    """
+    print(f'\n{size} orders, index load '
+          f'{flows["index load"]["seconds"] * 1000:.0f} ms')
+    for name, result in flows.items():
+        if 'calls' not in result:
+            continue
+        timings = ' '.join(
+            f'p{percent} {result[f"p{percent}"] * 1000:7.2f} ms'
+            for percent in PERCENTILES
+            )
+        print(f'  {name:<10} {timings}  {result["calls"]:5.1f} calls  '
+              f'{result["cache_hits"]:4.1f} cache hits  '
+              f'peak {result["peak_kib"]:8.1f} KiB')
+
+
+def main(argv=None):
+    """
+    Command line entry point. Returns 1 if a regression was found.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated sheet sizes in orders')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--latency', type=float,
+                        default=fakesheets.FAKE_LATENCY,
+                        help='simulated seconds per remote call')
+    parser.add_argument('--no-journal', action='store_true',
+                        help='write straight to the sheet')
+    parser.add_argument('--path', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed slow down or memory growth, 0.5 = 50%%')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    action.add_argument('--baseline', action='store_true',
+                        help='fail on regressions against the baseline')
+    args = parser.parse_args(argv)
+    if args.iterations < 1:
+        parser.error('--iterations must be at least 1')
+
+    import run  # pylint: disable=import-outside-toplevel
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results[str(size)] = bench_size(
+            run, size, args.iterations, args.latency, not args.no_journal)
+        print_results(size, results[str(size)])
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'\nPeak resident memory {peak_rss / 1024:.0f} MiB')
+
+    if args.save:
+        with open(args.path, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f'Baseline saved to {args.path}')
+    elif args.baseline:
+        with open(args.path, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print('No regressions against the baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Read-through cache in front of a gspread worksheet. Repeated reads of
+the same A1 range within the time to live are answered locally, and
+writes made through the cache drop any cached range they overlap.
+Hits and misses are counted in the tracing metrics when tracing is on.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from n3orthotics import tracing
+
+CACHE_TTL = float(os.environ.get('N3_CACHE_TTL', '30'))
+CACHE_SIZE = int(os.environ.get('N3_CACHE_SIZE', '128'))
+A1_CELL = re.compile(r'^([A-Z]*)(\d*)$')
+NO_LIMIT = float('inf')
+
+
+def column_number(letters):
+    """
+    Converts column letters into a 1 based column number, A = 1
+    """
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+
+def a1_bounds(range_name):
+    """
+    Converts an A1 range such as 'G:G', 'A5:K5' or 'I5' into
+    (first column, first row, last column, last row)
+    """
+    cells = range_name.upper().split('!')[-1].split(':')
+    start = A1_CELL.match(cells[0])
+    end = A1_CELL.match(cells[-1])
+    if start is None or end is None:
+        return (1, 1, NO_LIMIT, NO_LIMIT)
+    first_col = column_number(start.group(1)) if start.group(1) else 1
+    first_row = int(start.group(2)) if start.group(2) else 1
+    last_col = column_number(end.group(1)) if end.group(1) else NO_LIMIT
+    last_row = int(end.group(2)) if end.group(2) else NO_LIMIT
+    return (first_col, first_row, last_col, last_row)
+
+
+def overlaps(bounds, other):
+    """
+    Checks if two (first column, first row, last column, last row)
+    bounds share any cell
+    """
+    return (
+        bounds[0] <= other[2] and other[0] <= bounds[2]
+        and bounds[1] <= other[3] and other[1] <= bounds[3]
+        )
+
+
+class CachedWorksheet:
+    """
+    Wraps a worksheet, caching get_values results by range for ttl
+    seconds and keeping at most size ranges, least recently used first
+    out. Any attribute not handled here is passed to the worksheet.
+    """
+
+    def __init__(self, worksheet, ttl=CACHE_TTL, size=CACHE_SIZE):
+        self.worksheet = worksheet
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Counts invalidations, so a read that overlapped one is not kept
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.worksheet, name)
+
+    def get_values(self, range_name=None, **kwargs):
+        """
+        Returns the cached values of range_name, reading through to
+        the worksheet when missing or older than the time to live
+        """
+        if kwargs:
+            return self.worksheet.get_values(range_name, **kwargs)
+        key = range_name or ''
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if tracing.ENABLED:
+                    tracing.count('cache_hits')
+                return [list(row) for row in entry[1]]
+            self.misses += 1
+            generation = self.generation
+        if tracing.ENABLED:
+            tracing.count('cache_misses')
+        values = self.worksheet.get_values(range_name)
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (now, values)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return [list(row) for row in values]
+
+    def append_row(self, values, **kwargs):
+        """
+        Appends a row, dropping cached ranges that reach past the last
+        cached row or cover whole columns
+        """
+        response = self.worksheet.append_row(values, **kwargs)
+        self.invalidate_where(lambda bounds: bounds[3] == NO_LIMIT)
+        self.invalidate_where(lambda bounds: bounds[1] > 1, empty=True)
+        return response
+
+    def update(self, range_name, values=None, **kwargs):
+        """
+        Updates range_name, dropping any cached range it overlaps
+        """
+        response = self.worksheet.update(range_name, values, **kwargs)
+        self.invalidate(range_name)
+        return response
+
+    def batch_update(self, data, **kwargs):
+        """
+        Updates several ranges in one request, dropping any cached
+        range they overlap
+        """
+        response = self.worksheet.batch_update(data, **kwargs)
+        for update in data:
+            self.invalidate(update['range'])
+        return response
+
+    def invalidate(self, range_name=None):
+        """
+        Drops cached ranges overlapping range_name, or every cached
+        range when none is given
+        """
+        if range_name is None:
+            with self.lock:
+                self.entries.clear()
+                self.generation += 1
+            return
+        bounds = a1_bounds(range_name)
+        self.invalidate_where(lambda cached: overlaps(bounds, cached))
+
+    def invalidate_where(self, test, empty=False):
+        """
+        Drops cached ranges whose bounds pass test, only those which
+        held no values when empty is True
+        """
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                if empty and self.entries[key][1]:
+                    continue
+                if test(a1_bounds(key)):
+                    del self.entries[key]
+
+    def stats(self):
+        """
+        Returns the cache hit and miss counters and current size
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'size': self.size,
+                'ttl': self.ttl,
+                }
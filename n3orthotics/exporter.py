@@ -0,0 +1,183 @@
+"""
+Streaming export of the orders worksheet, columns A to K. Rows are read
+a fixed size chunk at a time and written out straight away, so memory
+use does not grow with the size of the sheet.
+
+Formats:
+    csv      heading row then one row per order
+    jsonl    one JSON object per order
+    columns  one JSON object per chunk, holding a list per column
+    parquet  a Parquet file with a row group per chunk (needs pyarrow)
+
+Usage: python3 -m n3orthotics.exporter orders.csv [--since TIMESTAMP]
+"""
+import argparse
+import csv
+import datetime
+import json
+import sys
+from datetime import timezone
+from n3orthotics.store import COLUMNS, open_store
+
+CHUNK_SIZE = 1000
+ORDER_DATE = COLUMNS.index('order_date')
+ORDER_UPDATE = COLUMNS.index('order_update')
+
+
+def parse_time(value):
+    """
+    Converts an ISO date and time into a UTC aware datetime, or None
+    """
+    try:
+        when = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+
+def last_changed(values):
+    """
+    Returns when a row was last changed, the date updated (column J) or,
+    for orders never updated, the date ordered. None if neither is set.
+    """
+    changed = None
+    if len(values) > ORDER_UPDATE:
+        changed = parse_time(values[ORDER_UPDATE])
+    if changed is None and len(values) > ORDER_DATE:
+        changed = parse_time(values[ORDER_DATE])
+    return changed
+
+
+def changed_since(values, since):
+    """
+    Checks if a row was last changed at or after since
+    """
+    changed = last_changed(values)
+    return changed is not None and changed >= since
+
+
+def iter_chunks(store, chunk_size=CHUNK_SIZE, since=None):
+    """
+    Yields chunks of (row, values) pairs, only rows changed since the
+    datetime since when it is given
+    """
+    for chunk in store.iter_rows(chunk_size):
+        if since is not None:
+            chunk = [
+                (row, values) for row, values in chunk
+                if changed_since(values, since)
+                ]
+        if chunk:
+            yield chunk
+
+
+def write_csv(chunks, out):
+    """
+    Writes chunks as CSV with a heading row
+    """
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    for chunk in chunks:
+        writer.writerows(values for _, values in chunk)
+
+
+def write_jsonl(chunks, out):
+    """
+    Writes one JSON object per row
+    """
+    for chunk in chunks:
+        for _, values in chunk:
+            out.write(json.dumps(dict(zip(COLUMNS, values))) + '\n')
+
+
+def write_columns(chunks, out):
+    """
+    Writes one JSON object per chunk, each column as a list
+    """
+    for chunk in chunks:
+        columns = list(zip(*(values for _, values in chunk)))
+        out.write(json.dumps({
+            'rows': len(chunk),
+            **{name: list(column) for name, column in zip(COLUMNS, columns)}
+            }) + '\n')
+
+
+def write_parquet(chunks, path):
+    """
+    Writes a Parquet file of string columns, one row group per chunk
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise SystemExit('The parquet format needs pyarrow installed') \
+            from error
+    schema = pyarrow.schema([(name, pyarrow.string()) for name in COLUMNS])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            columns = list(zip(*(values for _, values in chunk)))
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, pyarrow.string())
+                 for column in columns],
+                schema=schema
+                ))
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'columns': write_columns}
+
+
+def export_orders(store, path, file_format='csv', chunk_size=CHUNK_SIZE,
+                  since=None):
+    """
+    Exports the orders in store to path ('-' for stdout)
+    """
+    chunks = iter_chunks(store, chunk_size, since)
+    if file_format == 'parquet':
+        write_parquet(chunks, path)
+    elif path == '-':
+        WRITERS[file_format](chunks, sys.stdout)
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as out:
+            WRITERS[file_format](chunks, out)
+
+
+def main(argv=None):
+    """
+    Command line entry point. With --state, the time of the last export
+    is kept in a file so each run only exports rows changed since then.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help="output file, '-' for stdout")
+    parser.add_argument('--format', default='csv',
+                        choices=['csv', 'jsonl', 'columns', 'parquet'])
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--since', help='only rows changed since this '
+                        'ISO timestamp (column J, or H if never updated)')
+    parser.add_argument('--state', help='file keeping the last export time')
+    args = parser.parse_args(argv)
+
+    since = args.since
+    if since is None and args.state:
+        try:
+            with open(args.state, encoding='utf-8') as state_file:
+                since = state_file.read().strip()
+        except FileNotFoundError:
+            pass
+    since_time = None
+    if since:
+        since_time = parse_time(since)
+        if since_time is None:
+            parser.error(f'--since "{since}" is not an ISO timestamp')
+
+    started = datetime.datetime.now(timezone.utc).isoformat()
+    export_orders(open_store(), args.path, args.format, args.chunk_size,
+                  since_time)
+    if args.state:
+        with open(args.state, 'w', encoding='utf-8') as state_file:
+            state_file.write(started + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""
+Offline stand-in for the part of gspread the order store uses, so the
+whole order flow can be load tested without google credentials or
+quota. Selected with N3_FAKE_SHEETS=1 in place of creds.json.
+
+Each request sleeps for N3_FAKE_LATENCY seconds (give or take half) and
+fails with a 429 quota error at the rate N3_FAKE_ERROR_RATE, or once
+more than N3_FAKE_QUOTA requests are made in a minute. N3_FAKE_ROWS
+orders are generated into the worksheet when it is created.
+
+The spreadsheet lives in the memory of one process, so forked service
+sessions each start from a copy of it. The journal and allocator files
+default to a temporary directory of the process for the same reason,
+unless N3_JOURNAL_PATH or N3_ALLOCATOR_PATH name them.
+"""
+import datetime
+import itertools
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import timezone
+from n3orthotics.cache import a1_bounds
+from n3orthotics.store import COLUMNS
+from n3orthotics.timing import timed
+
+try:
+    from gspread.exceptions import APIError, WorksheetNotFound
+except ImportError:
+    class APIError(Exception):
+        """
+        Stands in for gspread's APIError when gspread is not installed
+        """
+
+        def __init__(self, response):
+            super().__init__(response.json()['error'])
+            self.response = response
+
+    class WorksheetNotFound(Exception):
+        """
+        Stands in for gspread's WorksheetNotFound
+        """
+
+FAKE_LATENCY = float(os.environ.get('N3_FAKE_LATENCY', '0.05'))
+FAKE_ERROR_RATE = float(os.environ.get('N3_FAKE_ERROR_RATE', '0'))
+FAKE_QUOTA = int(os.environ.get('N3_FAKE_QUOTA', '0'))
+FAKE_ROWS = int(os.environ.get('N3_FAKE_ROWS', '0'))
+GRID_ROWS = 1000
+GRID_COLS = 26
+SHEET_IDS = itertools.count()
+SPREADSHEETS = {}
+
+
+class FakeResponse:
+    """
+    The parts of a requests Response that gspread's APIError reads
+    """
+
+    def __init__(self, status_code, message, status):
+        self.status_code = status_code
+        self.text = message
+        self.error = {'code': status_code, 'message': message,
+                      'status': status}
+
+    def json(self):
+        return {'error': self.error}
+
+
+class FakeSession:
+    """
+    Stands in for the client's http session
+    """
+
+    def close(self):
+        """
+        Nothing to close
+        """
+
+
+class FakeClient:
+    """
+    Stands in for gspread.Client. Every request made through its
+    spreadsheets is counted by method in calls.
+    """
+
+    def __init__(self, latency=FAKE_LATENCY, error_rate=FAKE_ERROR_RATE,
+                 quota=FAKE_QUOTA):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota = quota
+        self.session = FakeSession()
+        self.calls = Counter()
+        self.recent = deque()
+        self.lock = threading.Lock()
+
+    def request(self, method):
+        """
+        Counts a request, waits out the simulated latency and raises the
+        simulated quota errors
+        """
+        with self.lock:
+            self.calls[method] += 1
+            now = time.monotonic()
+            while self.recent and self.recent[0] < now - 60:
+                self.recent.popleft()
+            self.recent.append(now)
+            over_quota = self.quota and len(self.recent) > self.quota
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if over_quota or random.random() < self.error_rate:
+            raise APIError(FakeResponse(
+                429, 'Quota exceeded for quota metric \'Read requests\'',
+                'RESOURCE_EXHAUSTED'
+                ))
+
+    def open(self, title):
+        """
+        Returns the spreadsheet named title, creating it on first use
+        """
+        self.request('open')
+        if title not in SPREADSHEETS:
+            SPREADSHEETS[title] = {}
+        return FakeSpreadsheet(self, title, SPREADSHEETS[title])
+
+
+class FakeSpreadsheet:
+    """
+    Stands in for gspread.Spreadsheet
+    """
+
+    def __init__(self, client, title, sheets):
+        self.client = client
+        self.title = title
+        self.sheets = sheets
+
+    def worksheets(self):
+        self.client.request('fetch_sheet_metadata')
+        return [
+            FakeWorksheet(self, title, grid)
+            for title, grid in self.sheets.items()
+            ]
+
+    def worksheet(self, title):
+        self.client.request('fetch_sheet_metadata')
+        if title not in self.sheets:
+            raise WorksheetNotFound(title)
+        return FakeWorksheet(self, title, self.sheets[title])
+
+    def add_worksheet(self, title, rows=GRID_ROWS, cols=GRID_COLS):
+        self.client.request('batch_update')
+        self.sheets[title] = Grid(rows, cols)
+        return FakeWorksheet(self, title, self.sheets[title])
+
+    def batch_update(self, body):
+        """
+        Runs appendDimension requests, adding rows to a grid whatever
+        size the caller last saw
+        """
+        self.client.request('batch_update')
+        grids = {grid.sheet_id: grid for grid in self.sheets.values()}
+        for request in body['requests']:
+            append = request['appendDimension']
+            grid = grids[append['sheetId']]
+            with grid.lock:
+                grid.row_count += append['length']
+        return {'replies': [{} for _ in body['requests']]}
+
+
+class Grid:
+    """
+    Cell values of one worksheet, as a list of rows trimmed of trailing
+    empty cells, plus its grid size
+    """
+
+    def __init__(self, rows=GRID_ROWS, cols=GRID_COLS):
+        self.rows = []
+        self.row_count = rows
+        self.col_count = cols
+        self.sheet_id = next(SHEET_IDS)
+        self.lock = threading.Lock()
+
+
+class FakeWorksheet:
+    """
+    Stands in for gspread.Worksheet: get_values with A1 ranges,
+    append_row(s), update, batch_update and the grid size.
+    Values are kept and returned as strings, as the formatted values
+    the sheets API returns.
+    """
+
+    def __init__(self, spreadsheet, title, grid):
+        self.spreadsheet = spreadsheet
+        self.client = spreadsheet.client
+        self.title = title
+        self.grid = grid
+
+    @property
+    def id(self):  # pylint: disable=invalid-name
+        return self.grid.sheet_id
+
+    @property
+    def row_count(self):
+        return self.grid.row_count
+
+    @property
+    def col_count(self):
+        return self.grid.col_count
+
+    def get_values(self, range_name=None, **kwargs):
+        self.client.request('values_get')
+        first_col, first_row, last_col, last_row = a1_bounds(
+            range_name or 'A:ZZ')
+        with self.grid.lock:
+            rows = self.grid.rows[first_row - 1:_end(last_row)]
+            values = [
+                _trim(row[first_col - 1:_end(last_col)]) for row in rows
+                ]
+        while values and not values[-1]:
+            values.pop()
+        width = max((len(row) for row in values), default=0)
+        return [row + [''] * (width - len(row)) for row in values]
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self.client.request('values_append')
+        with self.grid.lock:
+            while self.grid.rows and not self.grid.rows[-1]:
+                self.grid.rows.pop()
+            first_row = len(self.grid.rows) + 1
+            self.grid.rows.extend(_trim(_cells(row)) for row in values)
+            self.grid.row_count = max(self.grid.row_count,
+                                      len(self.grid.rows))
+        return {'updates': {'updatedRange': f'{self.title}!A{first_row}'}}
+
+    def update(self, range_name, values=None, **kwargs):
+        if values is None and isinstance(range_name, list):
+            range_name, values = 'A1', range_name
+        if not isinstance(values, list):
+            values = [[values]]
+        self.client.request('values_update')
+        with self.grid.lock:
+            self._write(range_name, values)
+        return {'updatedRange': f'{self.title}!{range_name}'}
+
+    def batch_update(self, data, **kwargs):
+        self.client.request('values_batch_update')
+        with self.grid.lock:
+            for entry in data:
+                self._write(entry['range'], entry['values'])
+        return {'totalUpdatedRows': len(data)}
+
+    def _write(self, range_name, values):
+        """
+        Writes a block of values from the first cell of range_name,
+        failing like the sheets API if it runs past the grid
+        """
+        first_col, first_row, _, _ = a1_bounds(range_name)
+        last_row = first_row + len(values) - 1
+        if last_row > self.grid.row_count:
+            raise APIError(FakeResponse(
+                400, f'Range ({self.title}!{range_name}) exceeds grid '
+                f'limits. Max rows: {self.grid.row_count}',
+                'INVALID_ARGUMENT'
+                ))
+        rows = self.grid.rows
+        rows.extend([] for _ in range(last_row - len(rows)))
+        for row_no, row_values in enumerate(values, first_row):
+            row = rows[row_no - 1]
+            cells = _cells(row_values)
+            last_col = first_col + len(cells) - 1
+            row.extend([''] * (last_col - len(row)))
+            row[first_col - 1:last_col] = cells
+            rows[row_no - 1] = _trim(row)
+
+
+def _end(last):
+    """
+    Returns a slice end for a 1 based inclusive bound, None if open
+    """
+    return None if last == float('inf') else int(last)
+
+
+def _trim(row):
+    """
+    Drops trailing empty cells, as the sheets API does
+    """
+    row = list(row)
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def _cells(values):
+    """
+    Formats written values the way sheets shows them, whole floats
+    without a decimal point
+    """
+    cells = []
+    for value in values:
+        if value is None:
+            value = ''
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        cells.append(f'{value}')
+    return cells
+
+
+def seed_orders(worksheet, count, start=1):
+    """
+    Writes count generated orders under the headings row of worksheet,
+    straight into its grid without any simulated requests
+    """
+    now = datetime.datetime.now(timezone.utc)
+    last = start + count - 1
+    statuses = ['PENDING', 'NEW ORDER', 'ACCEPTED', 'DESIGNED',
+                'SUBMITTED TO PRINT', 'CANCELED']
+    grid = worksheet.grid
+    with grid.lock:
+        if not grid.rows:
+            grid.rows.append(list(COLUMNS))
+        first_row = len(grid.rows) + 1
+        for number in range(start, start + count):
+            row_no = first_row + number - start
+            # Up to 9999 orders a day, the newest on the last row
+            ordered = now - datetime.timedelta(
+                days=(last - number) // 9999, seconds=last - number)
+            grid.rows.append(_cells([
+                random.choice(['Ann', 'Brian', 'Ciara', 'Declan']),
+                random.choice(['Byrne', 'Kelly', 'Walsh', 'Ryan']),
+                f'customer{number}@example.com',
+                random.randrange(38, 100) / 2,
+                random.choice(['Low', 'Medium', 'High']),
+                random.choice(['Narrow', 'Standard', 'Wide']),
+                f'{ordered:%y%m%d}{number % 9999 + 1:04d}',
+                ordered.isoformat(),
+                random.choice(statuses),
+                '',
+                row_no,
+                ]))
+        grid.row_count = max(grid.row_count, len(grid.rows))
+
+
+def open_spreadsheet(title='n3orthotics', rows=FAKE_ROWS, client=None):
+    """
+    Opens the fake spreadsheet, creating its 'orders' worksheet with
+    the headings row and rows generated orders the first time
+    """
+    with timed('open spreadsheet'):
+        spreadsheet = (client or FakeClient()).open(title)
+    if 'orders' not in spreadsheet.sheets:
+        worksheet = FakeWorksheet(
+            spreadsheet, 'orders', spreadsheet.sheets.setdefault(
+                'orders', Grid()))
+        seed_orders(worksheet, rows)
+    return spreadsheet
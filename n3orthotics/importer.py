@@ -0,0 +1,170 @@
+"""
+Bulk order import. Streams a CSV or JSONL file of orders a chunk at a
+time. Each chunk is checked in one call against the order schema the
+terminal prompts use, given order numbers and rows and written to the
+order store in one batch. Records that fail are listed in an error
+report. The import stops at the first chunk that cannot be given order
+numbers, the day's numbers having run out, listing its records as
+failed. Orders still waiting in the write-behind journal when the
+import ends are counted in the summary, and are sent by the next
+process to open the journal.
+
+Usage: python3 -m n3orthotics.importer orders.csv [--report errors.csv]
+"""
+import argparse
+import csv
+import datetime
+import json
+import sys
+from datetime import timezone
+from n3orthotics.allocator import open_allocator
+from n3orthotics.order import Order
+from n3orthotics.store import open_store
+from n3orthotics.validation import ORDER_SCHEMA
+
+CHUNK_SIZE = 500
+
+
+def read_records(path, file_format=None):
+    """
+    Yields (line number, record) from a CSV file with a heading row or
+    a JSONL file with one JSON object per line. A JSONL line that cannot
+    be read is yielded as its ValueError.
+    """
+    if file_format is None:
+        file_format = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+    with open(path, newline='', encoding='utf-8-sig') as import_file:
+        if file_format == 'csv':
+            reader = csv.DictReader(import_file)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line_no, line in enumerate(import_file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError as error:
+                yield line_no, error
+
+
+def read_chunks(path, file_format=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields lists of up to chunk_size (line number, record) pairs
+    """
+    records = []
+    for line_no, record in read_records(path, file_format):
+        records.append((line_no, record))
+        if len(records) >= chunk_size:
+            yield records
+            records = []
+    if records:
+        yield records
+
+
+def check_records(records):
+    """
+    Returns (Order, errors) for each of records, checked against the
+    order schema in one batch, errors being a list of FieldErrors. The
+    Order is None if there are errors.
+    """
+    checked = []
+    for values, errors in ORDER_SCHEMA.check_many(records):
+        order = None
+        if values is not None:
+            order = Order()
+            for field, value in values.items():
+                setattr(order, field, value)
+        checked.append((order, errors))
+    return checked
+
+
+def write_chunk(store, allocator, orders):
+    """
+    Gives each order a new order number and row, then writes them all
+    to the store in one batch. Raises ValueError, writing nothing, if
+    there are not enough order numbers left today.
+    """
+    order_date = datetime.datetime.now(timezone.utc).isoformat()
+    slots = allocator.allocate_many(len(orders))
+    for order, (order_no, row_no) in zip(orders, slots):
+        order.order_no = order_no
+        order.row_no = row_no
+        order.order_date = order_date
+        order.order_status = 'NEW ORDER'
+    store.append_rows([order.to_row() for order in orders])
+
+
+def import_orders(path, store, allocator, report, chunk_size=CHUNK_SIZE,
+                  file_format=None):
+    """
+    Imports every valid record in path, writing each failed field to
+    the csv writer report, and stops at the first chunk that cannot be
+    allocated order numbers. Returns (orders imported, records failed,
+    line number stopped at or None).
+    """
+    imported = failed = 0
+    for records in read_chunks(path, file_format, chunk_size):
+        chunk = []
+        line_nos = [line_no for line_no, _ in records]
+        checked = check_records([record for _, record in records])
+        for line_no, (order, errors) in zip(line_nos, checked):
+            if errors:
+                failed += 1
+                for error in errors:
+                    report.writerow(
+                        [line_no, error.field, error.code, error.message])
+                continue
+            chunk.append((line_no, order))
+        if not chunk:
+            continue
+        try:
+            write_chunk(store, allocator, [order for _, order in chunk])
+        except ValueError as error:
+            failed += len(chunk)
+            for line_no, _ in chunk:
+                report.writerow([line_no, 'order_no', 'allocation', error])
+            return imported, failed, chunk[0][0]
+        imported += len(chunk)
+    return imported, failed, None
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='CSV or JSONL file of orders')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='file format, by default from the extension')
+    parser.add_argument('--report', help='error report CSV, default stderr')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    store = open_store()
+    allocator = open_allocator(store)
+    if args.report:
+        report_file = open(args.report, 'w', newline='', encoding='utf-8')
+    else:
+        report_file = sys.stderr
+    try:
+        report = csv.writer(report_file)
+        report.writerow(['line', 'field', 'code', 'error'])
+        imported, failed, stopped = import_orders(
+            args.path, store, allocator, report, args.chunk_size, args.format)
+    finally:
+        if args.report:
+            report_file.close()
+    pending = store.drain() if hasattr(store, 'drain') else 0
+    if stopped is not None:
+        print(f'Import stopped at line {stopped}, no order numbers left '
+              'today.')
+    print(f'{imported} orders imported, {failed} records failed.')
+    if pending:
+        print(f'{pending} writes are still waiting in the journal and will '
+              'be sent by the next run.')
+    return 1 if failed or stopped is not None else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+In memory order_no to row index, so an order and its full row can be
+found without downloading and scanning the order_no column each time,
+plus a prefix search index over chosen columns for finding orders when
+the order number has been lost
+"""
+from bisect import bisect_left, insort
+
+
+class OrderIndex:
+    """
+    Holds every order row keyed by row number, plus a dict of
+    order_no to row number. Built once from the whole worksheet and
+    then kept up to date as rows are appended or updated.
+    """
+
+    def __init__(self, order_no_column, search_columns=()):
+        self.order_no_column = order_no_column
+        self.search_columns = search_columns
+        self.rows = {}
+        self.by_order_no = {}
+        self.last_row = 0
+        self.search_index = None
+
+    def load(self, rows):
+        """
+        Rebuilds the index from a list of rows, the first being row 1
+        """
+        self.rows.clear()
+        self.by_order_no.clear()
+        self.last_row = 0
+        self.search_index = None
+        for row, values in enumerate(rows, 1):
+            self.put(row, values)
+
+    def lookup(self, order_no):
+        """
+        Returns (row, values) for order_no, or None if not indexed
+        """
+        row = self.by_order_no.get(str(order_no))
+        if row is None:
+            return None
+        return row, list(self.rows[row])
+
+    def search(self, query, limit=None):
+        """
+        Returns (row, values) of the orders matching every word of query
+        as a case insensitive prefix of one of the search columns,
+        newest first. The search index is built on the first search and
+        kept up to date from then on.
+        """
+        if self.search_index is None:
+            self.search_index = SearchIndex(self.search_columns)
+            self.search_index.load(self.rows)
+        rows = sorted(self.search_index.search(query), reverse=True)
+        return [(row, list(self.rows[row])) for row in rows[:limit]]
+
+    def put(self, row, values):
+        """
+        Stores the values of row, re-pointing its order_no entry
+        """
+        values = ['' if value is None else str(value) for value in values]
+        old_values = self.rows.get(row)
+        if old_values is not None:
+            self._unlink(row, old_values)
+            if self.search_index is not None:
+                self.search_index.remove(row, old_values)
+        if self.search_index is not None:
+            self.search_index.add(row, values)
+        self.rows[row] = values
+        if len(values) > self.order_no_column:
+            order_no = values[self.order_no_column]
+            if order_no:
+                self.by_order_no.setdefault(order_no, row)
+        self.last_row = max(self.last_row, row)
+
+    def append(self, values):
+        """
+        Stores values as the row after the last indexed row
+        """
+        self.put(self.last_row + 1, values)
+
+    def update(self, row, column_values):
+        """
+        Replaces single values of an indexed row, column_values being a
+        dict of column position to value
+        """
+        values = list(self.rows.get(row, []))
+        for column, value in column_values.items():
+            values.extend([''] * (column + 1 - len(values)))
+            values[column] = value
+        self.put(row, values)
+
+    def _unlink(self, row, values):
+        """
+        Drops the order_no entry pointing at row
+        """
+        if len(values) > self.order_no_column:
+            order_no = values[self.order_no_column]
+            if self.by_order_no.get(order_no) == row:
+                del self.by_order_no[order_no]
+
+
+class SearchIndex:
+    """
+    Case insensitive prefix search over some columns of order rows.
+    Each column is kept as a sorted list of (value, row), so the rows
+    starting with a prefix are found with two binary searches and a
+    changed row is moved with one removal and one insertion.
+    The headings in row 1 are never indexed.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.keys = {column: [] for column in columns}
+
+    def load(self, rows):
+        """
+        Rebuilds the index from a dict of row number to values
+        """
+        for column in self.columns:
+            self.keys[column] = sorted(
+                (search_key(values[column]), row)
+                for row, values in rows.items()
+                if row > 1 and len(values) > column and values[column]
+                )
+
+    def add(self, row, values):
+        """
+        Indexes the search columns of row
+        """
+        for column in self._columns_of(row, values):
+            insort(self.keys[column], (search_key(values[column]), row))
+
+    def remove(self, row, values):
+        """
+        Drops the search columns of row, values being as last indexed
+        """
+        for column in self._columns_of(row, values):
+            keys = self.keys[column]
+            entry = (search_key(values[column]), row)
+            position = bisect_left(keys, entry)
+            if position < len(keys) and keys[position] == entry:
+                del keys[position]
+
+    def _columns_of(self, row, values):
+        """
+        Returns the search columns with a value in row
+        """
+        if row <= 1:
+            return []
+        return [
+            column for column in self.columns
+            if len(values) > column and values[column]
+            ]
+
+    def prefix(self, column, prefix):
+        """
+        Returns the set of rows whose column starts with prefix
+        """
+        keys = self.keys[column]
+        first = bisect_left(keys, (prefix,))
+        last = bisect_left(keys, (prefix + '\U0010ffff',))
+        return {row for _, row in keys[first:last]}
+
+    def search(self, query):
+        """
+        Returns the set of rows where each word of query starts one of
+        the search columns
+        """
+        found = None
+        for word in search_key(query).split():
+            rows = set()
+            for column in self.columns:
+                rows |= self.prefix(column, word)
+            found = rows if found is None else found & rows
+            if not found:
+                break
+        return found or set()
+
+
+def search_key(value):
+    """
+    Returns value as a search key, trimmed and case folded
+    """
+    return f'{value}'.strip().casefold()
+
+
+def row_matches(values, query, columns):
+    """
+    Checks a single row as SearchIndex.search would, for rows that are
+    not indexed
+    """
+    keys = [
+        search_key(values[column]) for column in columns
+        if len(values) > column and values[column]
+        ]
+    words = search_key(query).split()
+    return bool(words) and all(
+        any(key.startswith(word) for key in keys) for word in words)
@@ -0,0 +1,682 @@
+"""
+Write-behind journal for order store writes. Writes are saved to a local
+SQLite file and acknowledged straight away, then a background thread
+sends them on to the order store in coalesced batches, retrying with
+exponential backoff while the store is failing. Entries are only
+removed once written, so anything left behind by a crash or a killed
+session is sent by the next process to open the journal.
+
+Each entry is keyed by order number and operation, so writing the same
+thing twice replaces the earlier entry. Every write goes to the fixed
+row held in column K of the order, so sending an entry again after a
+crash overwrites the row instead of adding a duplicate.
+
+Every process sharing a journal file flushes it. A process claims the
+rows it is about to send for CLAIM_LEASE seconds, and no other process
+sends entries for a claimed row until the claim is released or has
+expired, so a slow flush of a row cannot land after, and overwrite, a
+newer write to it sent by another process. Only the entries claimed are
+removed once sent; an entry that replaced one of them while it was
+being sent stays for the next flush.
+
+A batch the store refuses, rather than one that fails because the store
+is unreachable or over quota, is sent again in halves until the entry
+it refuses is sent on its own. An entry refused MAX_ATTEMPTS times that
+way is parked: it stays in the journal file, reported on stderr, but is
+no longer sent, so it cannot hold up the entries behind it. Writing the
+same order and operation again replaces it and sends it once more.
+"""
+import atexit
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from n3orthotics.index import row_matches
+from n3orthotics.store import (
+    COLUMN_LETTERS, COLUMNS, ORDER_NO_COLUMN, ORDER_UPDATE_COLUMN,
+    SEARCH_COLUMNS, SEARCH_LIMIT, ConflictError, OrderStore, _row_slot,
+    _to_text, local_path
+    )
+
+JOURNAL_PATH = local_path('N3_JOURNAL_PATH', 'journal.sqlite3')
+FLUSH_INTERVAL = 0.2
+BATCH_SIZE = 500
+RETRY_BASE = 0.5
+RETRY_MAX = 60
+DRAIN_TIMEOUT = 10
+MAX_ATTEMPTS = 5
+# Longer than a write can take with the HTTP timeouts and retries
+CLAIM_LEASE = 120
+# How long a flushed row is remembered for checked writes
+FLUSHED_KEEP = 600
+
+
+class Journal:
+    """
+    Pending writes, oldest first, in a SQLite file shared by every
+    process using the same path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        """
+        Opens the journal file in autocommit mode, creating the table on
+        first use
+        """
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None,
+            check_same_thread=False
+            )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS journal ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE, '
+            'order_no TEXT, op TEXT, row INTEGER, payload TEXT, '
+            'attempts INTEGER NOT NULL DEFAULT 0, error TEXT)'
+            )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS journal_row ON journal (row)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS journal_order_no '
+            'ON journal (order_no)'
+            )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS claims ('
+            'row INTEGER PRIMARY KEY, owner TEXT, until REAL)'
+            )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS flushed ('
+            'row INTEGER PRIMARY KEY, seq INTEGER, at REAL)'
+            )
+
+    def after_fork(self):
+        """
+        Drops the journal connection in a forked child process
+        """
+        self.connection = None
+        self.lock = threading.RLock()
+
+    def _execute(self, sql, parameters=()):
+        if self.connection is None:
+            self.connect()
+        return self.connection.execute(sql, parameters)
+
+    def add(self, entries, check=None):
+        """
+        Saves entries, a list of (order_no, op, row, payload), in one
+        transaction. An entry with the same order_no and op as a pending
+        one replaces it and moves to the back of the queue, the cells of
+        a 'cells' entry being merged into the pending ones. check is
+        called first inside the transaction, so no other process can add
+        entries between it and the save, and may raise to save nothing
+        or return rows whose entries are left out.
+        """
+        with self.lock:
+            self._execute('BEGIN IMMEDIATE')
+            try:
+                skip = ()
+                if check is not None:
+                    skip = check() or ()
+                for order_no, op, row, payload in entries:
+                    if row in skip:
+                        continue
+                    key = f'{order_no}:{op}'
+                    if op == 'cells':
+                        found = self._execute(
+                            'SELECT payload FROM journal WHERE key = ?',
+                            (key,)
+                            ).fetchone()
+                        if found is not None:
+                            payload = {**json.loads(found[0]), **payload}
+                    self._execute(
+                        'INSERT OR REPLACE INTO journal '
+                        '(key, order_no, op, row, payload) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (key, str(order_no), op, row, json.dumps(payload))
+                        )
+                self._execute('COMMIT')
+            except BaseException:
+                self._execute('ROLLBACK')
+                raise
+
+    def claim(self, owner, limit=BATCH_SIZE, lease=CLAIM_LEASE):
+        """
+        Claims the rows of up to limit of the oldest unparked entries whose
+        rows no other owner has claimed, for lease seconds, and returns the
+        entries as (seq, key, op, row, payload)
+        """
+        with self.lock:
+            self._execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                self._execute(
+                    'DELETE FROM claims WHERE until < ? OR owner = ?',
+                    (now, owner)
+                    )
+                found = self._execute(
+                    'SELECT seq, key, op, row, payload FROM journal '
+                    'WHERE row NOT IN (SELECT row FROM claims) '
+                    'AND attempts < ? ORDER BY seq LIMIT ?',
+                    (MAX_ATTEMPTS, limit)
+                    ).fetchall()
+                self.connection.executemany(
+                    'INSERT INTO claims (row, owner, until) VALUES (?, ?, ?)',
+                    [(row, owner, now + lease)
+                     for row in {entry[3] for entry in found}]
+                    )
+                self._execute('COMMIT')
+            except BaseException:
+                self._execute('ROLLBACK')
+                raise
+        return [
+            (seq, key, op, row, json.loads(payload))
+            for seq, key, op, row, payload in found
+            ]
+
+    def for_row(self, row):
+        """
+        Returns (op, payload) of the entries for row, oldest first
+        """
+        with self.lock:
+            found = self._execute(
+                'SELECT op, payload FROM journal WHERE row = ? ORDER BY seq',
+                (row,)
+                ).fetchall()
+        return [(op, json.loads(payload)) for op, payload in found]
+
+    def row_for(self, order_no):
+        """
+        Returns the row of the latest entry for order_no, or None
+        """
+        with self.lock:
+            found = self._execute(
+                'SELECT row FROM journal WHERE order_no = ? '
+                'ORDER BY seq DESC LIMIT 1', (str(order_no),)
+                ).fetchone()
+        return found[0] if found else None
+
+    def rows(self):
+        """
+        Returns the rows with pending entries
+        """
+        with self.lock:
+            found = self._execute('SELECT DISTINCT row FROM journal')
+            return [row for row, in found.fetchall()]
+
+    def last_row(self):
+        """
+        Returns the highest row with a pending entry, or None
+        """
+        with self.lock:
+            return self._execute('SELECT MAX(row) FROM journal').fetchone()[0]
+
+    def last_order_no(self):
+        """
+        Returns the highest pending order number as an int, or None
+        """
+        with self.lock:
+            found = self._execute(
+                "SELECT MAX(CAST(order_no AS INTEGER)) FROM journal "
+                "WHERE order_no GLOB '[0-9]*'"
+                ).fetchone()
+        return found[0]
+
+    def remove(self, entries, owner):
+        """
+        Removes flushed entries claimed by owner, leaving any replaced
+        since they were claimed, releases owner's claims and marks the
+        rows as flushed
+        """
+        now = time.time()
+        last = {}
+        for entry in entries:
+            last[entry[3]] = max(entry[0], last.get(entry[3], 0))
+        with self.lock:
+            self._execute('BEGIN IMMEDIATE')
+            self.connection.executemany(
+                'DELETE FROM journal WHERE seq = ?',
+                [(entry[0],) for entry in entries]
+                )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO flushed (row, seq, at) '
+                'VALUES (?, ?, ?)',
+                [(row, seq, now) for row, seq in last.items()]
+                )
+            self._execute(
+                'DELETE FROM flushed WHERE at < ?', (now - FLUSHED_KEEP,))
+            self._execute('DELETE FROM claims WHERE owner = ?', (owner,))
+            self._execute('COMMIT')
+
+    def failed(self, entries, error, owner, refused=False):
+        """
+        Records error against entries, counting an attempt against them
+        if the store refused them, and releases owner's claims. Returns
+        the keys of the entries parked by this attempt.
+        """
+        with self.lock:
+            self._execute('BEGIN IMMEDIATE')
+            self.connection.executemany(
+                'UPDATE journal SET attempts = attempts + ?, error = ? '
+                'WHERE seq = ?',
+                [(int(refused), f'{error}', entry[0]) for entry in entries]
+                )
+            parked = [
+                key for key, in self._execute(
+                    'SELECT key FROM journal WHERE attempts = ? AND seq IN '
+                    f'({", ".join("?" * len(entries))})',
+                    [MAX_ATTEMPTS] + [entry[0] for entry in entries]
+                    )
+                ] if refused else []
+            self._execute('DELETE FROM claims WHERE owner = ?', (owner,))
+            self._execute('COMMIT')
+        return parked
+
+    def flushed(self, rows):
+        """
+        Returns {row: seq} of the last entry flushed for each of rows
+        that was flushed recently
+        """
+        rows = list(rows)
+        marks = {}
+        with self.lock:
+            # Kept under SQLite's limit on query parameters
+            for start in range(0, len(rows), 500):
+                chunk = rows[start:start + 500]
+                marks.update(self._execute(
+                    'SELECT row, seq FROM flushed WHERE row IN '
+                    f'({", ".join("?" * len(chunk))})', chunk
+                    ).fetchall())
+        return marks
+
+    def last_seq(self):
+        """
+        Returns the sequence number of the newest entry, or 0
+        """
+        with self.lock:
+            found = self._execute('SELECT MAX(seq) FROM journal').fetchone()
+        return found[0] or 0
+
+    def count(self, last_seq=None):
+        """
+        Returns the number of pending entries, not counting parked ones,
+        only counting those up to last_seq if given
+        """
+        with self.lock:
+            if last_seq is None:
+                found = self._execute(
+                    'SELECT COUNT(*) FROM journal WHERE attempts < ?',
+                    (MAX_ATTEMPTS,)
+                    )
+            else:
+                found = self._execute(
+                    'SELECT COUNT(*) FROM journal '
+                    'WHERE attempts < ? AND seq <= ?',
+                    (MAX_ATTEMPTS, last_seq)
+                    )
+            return found.fetchone()[0]
+
+
+class JournaledStore(OrderStore):
+    """
+    Wraps an order store so writes go through a Journal. Reads of single
+    rows and orders include any writes still waiting in the journal, so
+    a session sees its own writes straight away. Bulk reads with
+    iter_rows send the journal first.
+    Checked writes compare the date updated inside the journal's
+    transaction, which serializes them across every process sharing the
+    journal file. The rows are read from the store before that
+    transaction starts, so other writers are not held up by the read,
+    and only read again inside it if one of them was flushed meanwhile.
+    """
+
+    def __init__(self, store, journal, flush_interval=FLUSH_INTERVAL):
+        self.store = store
+        self.journal = journal
+        self.flush_interval = flush_interval
+        self.flush_lock = threading.Lock()
+        self.owner = f'{os.getpid()}'
+        self.wake = threading.Event()
+        self.worker = None
+        self.batch_size = BATCH_SIZE
+        self.failures = 0
+        self.last_error = None
+        atexit.register(self.close)
+
+    def start(self):
+        """
+        Starts the background flush thread, which also sends anything
+        left in the journal by an earlier process
+        """
+        if self.worker is None:
+            self.worker = threading.Thread(
+                target=self._run, daemon=True, name='journal')
+            self.worker.start()
+            self.wake.set()
+
+    def _run(self):
+        """
+        Background loop, flushing whenever woken or every flush_interval
+        and backing off exponentially after a failure
+        """
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                while self.flush():
+                    pass
+            except Exception as error:  # pylint: disable=broad-except
+                self.failures += 1
+                self.last_error = error
+                delay = min(RETRY_BASE * 2 ** (self.failures - 1), RETRY_MAX)
+                time.sleep(delay * random.uniform(0.5, 1))
+            else:
+                self.failures = 0
+
+    def flush(self):
+        """
+        Claims one batch of the oldest entries no other process is
+        sending, sends them to the store and removes them. Returns the
+        number of entries sent.
+        """
+        with self.flush_lock:
+            entries = self.journal.claim(self.owner, self.batch_size)
+            if not entries:
+                return 0
+            try:
+                write_entries(self.store, entries)
+            except Exception as error:
+                refused = not _transient(error)
+                if refused:
+                    # Halved until the entry refused is sent on its own
+                    self.batch_size = max(1, len(entries) // 2)
+                parked = self.journal.failed(
+                    entries, error, self.owner, refused and len(entries) == 1)
+                for key in parked:
+                    print(f'Journal entry {key} parked after {MAX_ATTEMPTS} '
+                          f'failed writes: {error}', file=sys.stderr)
+                raise
+            self.journal.remove(entries, self.owner)
+            self.batch_size = min(BATCH_SIZE, self.batch_size * 2)
+            return len(entries)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Flushes until every entry pending when called has been sent, by
+        this process or another, or timeout seconds have passed. Returns
+        the number of those entries still pending.
+        """
+        deadline = time.monotonic() + timeout
+        last_seq = self.journal.last_seq()
+        while time.monotonic() < deadline:
+            try:
+                if not self.flush():
+                    if not self.journal.count(last_seq):
+                        return 0
+                    # The rest are being sent by another process
+                    time.sleep(self.flush_interval)
+            except Exception:  # pylint: disable=broad-except
+                time.sleep(RETRY_BASE)
+        return self.journal.count(last_seq)
+
+    def close(self):
+        """
+        Tries to send everything still pending, anything left staying in
+        the journal for the next process
+        """
+        if self.journal.connection is not None:
+            self.drain()
+
+    def after_fork(self):
+        self.store.after_fork()
+        self.journal.after_fork()
+        self.flush_lock = threading.Lock()
+        self.owner = f'{os.getpid()}'
+        self.wake = threading.Event()
+        # Started by the child's first write
+        self.worker = None
+
+    def _add(self, entries, check=None):
+        self.journal.add(entries, check)
+        self.start()
+        self.wake.set()
+
+    def last_order_no(self):
+        pending = self.journal.last_order_no()
+        stored = self.store.last_order_no()
+        if pending is None or (stored is not None and stored > pending):
+            return stored
+        return pending
+
+    def row_count(self):
+        return max(self.store.row_count(), self.journal.last_row() or 0)
+
+    def row_floor(self, when):
+        return self.store.row_floor(when)
+
+    def find_row(self, order_no):
+        found = self.find_order(order_no)
+        return found[0] if found else None
+
+    def find_order(self, order_no):
+        row = self.journal.row_for(order_no)
+        if row is None:
+            row = self.store.find_row(order_no)
+            if row is None:
+                return None
+        return row, self.get_row(row)
+
+    # Journal entries are read before the store, as an entry flushed
+    # between the two reads would otherwise be missed by both
+
+    def get_row(self, row):
+        pending = self.journal.for_row(row)
+        return self._overlay(self.store.get_row(row), pending)
+
+    def search_orders(self, query, limit=SEARCH_LIMIT):
+        pending = {row: self.journal.for_row(row)
+                   for row in self.journal.rows()}
+        found = dict(self.store.search_orders(query, limit))
+        for row, entries in pending.items():
+            stored = found.get(row) or self.store.get_row(row)
+            found[row] = self._overlay(stored, entries)
+        matched = [
+            (row, values) for row, values in found.items()
+            if row_matches(values, query, SEARCH_COLUMNS)
+            ]
+        return sorted(matched, reverse=True)[:limit]
+
+    def current_row(self, row):
+        pending = self.journal.for_row(row)
+        return self._overlay(self.store.current_row(row), pending)
+
+    def current_rows(self, rows):
+        pending = {row: self.journal.for_row(row) for row in rows}
+        stored = self.store.current_rows(rows)
+        return {row: self._overlay(stored[row], pending[row]) for row in rows}
+
+    @staticmethod
+    def _overlay(values, pending):
+        """
+        Applies pending journal entries, (op, payload) oldest first, to
+        the stored values of a row, formatting them as the store would
+        return them
+        """
+        values = list(values) + [''] * (len(COLUMNS) - len(values))
+        for op, payload in pending:
+            if op == 'cells':
+                for letter, value in payload.items():
+                    values[COLUMN_LETTERS.index(letter)] = _to_text(value)
+            else:
+                values = [_to_text(value) for value in payload]
+                values += [''] * (len(COLUMNS) - len(values))
+        return values
+
+    def iter_rows(self, chunk_size=1000, columns=None):
+        self.drain()
+        return self.store.iter_rows(chunk_size, columns)
+
+    def append_row(self, values):
+        self.append_rows([values])
+
+    def append_rows(self, rows):
+        rows = [list(values) for values in rows]
+        unplaced = [values for values in rows if _row_slot(values) is None]
+        if unplaced:
+            # Without a row slot a replayed append would add a second row
+            self.store.append_rows(unplaced)
+        self._add([
+            (values[ORDER_NO_COLUMN], 'append', _row_slot(values), values)
+            for values in rows if _row_slot(values) is not None
+            ])
+
+    def update_row(self, row, values):
+        self.update_rows({row: values})
+
+    def update_rows(self, rows):
+        self._add([
+            (values[ORDER_NO_COLUMN], 'update', row, list(values))
+            for row, values in rows.items()
+            ])
+
+    def update_row_checked(self, row, values, expected):
+        self._add_checked(
+            [(values[ORDER_NO_COLUMN], 'update', row, list(values))],
+            {row: expected}
+            )
+
+    def update_cells(self, row, cells):
+        self.update_cells_batch({row: cells})
+
+    def update_cells_checked(self, row, cells, expected):
+        values = self.get_row(row)
+        self._add_checked(
+            [(values[ORDER_NO_COLUMN] or f'row {row}', 'cells', row,
+              dict(cells))],
+            {row: expected}
+            )
+
+    def update_cells_batch(self, cells_by_row):
+        self._add(self._cell_entries(cells_by_row))
+
+    def update_cells_batch_checked(self, cells_by_row, expected):
+        return self._add_checked(
+            self._cell_entries(cells_by_row),
+            {row: expected[row] for row in cells_by_row}, skip=True
+            )
+
+    def _add_checked(self, entries, expected, skip=False):
+        """
+        Saves entries if the date updated of each row of expected is
+        still expected[row], raising ConflictError for the first that is
+        not, or with skip leaving out the entries of rows that are not.
+        Returns the rows left out.
+        """
+        rows = list(expected)
+        marks = self.journal.flushed(rows)
+        stored = self.store.current_rows(rows)
+        stale = []
+
+        def check():
+            if self.journal.flushed(rows) != marks:
+                # A flush landed after the read, so the read may have
+                # missed a write that is no longer in the journal
+                stored.update(self.store.current_rows(rows))
+            for row in rows:
+                values = self._overlay(stored[row], self.journal.for_row(row))
+                if values[ORDER_UPDATE_COLUMN] == (expected[row] or ''):
+                    continue
+                if not skip:
+                    raise ConflictError(row, expected[row], values)
+                stale.append(row)
+            return stale
+        self._add(entries, check)
+        return stale
+
+    def _cell_entries(self, cells_by_row):
+        """
+        Returns journal entries for single cells of many rows
+        """
+        stored = self.store.get_rows(cells_by_row)
+        return [
+            (self._overlay(stored[row], self.journal.for_row(row))
+             [ORDER_NO_COLUMN] or f'row {row}', 'cells', row, dict(cells))
+            for row, cells in cells_by_row.items()
+            ]
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def write_entries(store, entries):
+    """
+    Coalesces entries, oldest first, into at most one write per row and
+    sends them with the store's batch methods: new rows in runs of
+    consecutive rows, whole row updates, then single cell updates
+    """
+    appends = {}
+    updates = {}
+    cells = {}
+    for _, _, op, row, payload in entries:
+        if op == 'cells':
+            values = appends.get(row) or updates.get(row)
+            if values is None:
+                cells.setdefault(row, {}).update(payload)
+                continue
+            for letter, value in payload.items():
+                values[COLUMN_LETTERS.index(letter)] = value
+            continue
+        # A whole row replaces any earlier writes to it
+        cells.pop(row, None)
+        values = payload + [''] * (len(COLUMNS) - len(payload))
+        if op == 'append' or row in appends:
+            updates.pop(row, None)
+            appends[row] = values
+        else:
+            updates[row] = values
+    for run in _runs(sorted(appends)):
+        store.append_rows([appends[row] for row in run])
+    if updates:
+        store.update_rows(updates)
+    if cells:
+        store.update_cells_batch(cells)
+
+
+def _runs(rows):
+    """
+    Splits sorted row numbers into lists of consecutive rows
+    """
+    runs = []
+    for row in rows:
+        if runs and runs[-1][-1] == row - 1:
+            runs[-1].append(row)
+        else:
+            runs.append([row])
+    return runs
+
+
+def _transient(error):
+    """
+    Returns whether error is one the store may not give when the write
+    is tried again: a network error, a timeout or a quota or server
+    error response
+    """
+    if isinstance(error, (OSError, sqlite3.OperationalError)):
+        return True
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def open_journal(store, path=JOURNAL_PATH):
+    """
+    Wraps store in a JournaledStore using the journal file at path and
+    starts sending anything pending in it
+    """
+    journaled = JournaledStore(store, Journal(path))
+    journaled.start()
+    return journaled
@@ -0,0 +1,79 @@
+"""
+Order record and terminal session types. Each session works on its own
+Order instead of the module level lists run.py used to share.
+"""
+from operator import attrgetter
+from n3orthotics.store import COLUMN_LETTERS, COLUMNS
+
+
+class Order:
+    """
+    One order, with a slot for each worksheet column A to K so an
+    instance carries no per-instance dict. Converts straight to and from
+    a worksheet row.
+    """
+    __slots__ = tuple(COLUMNS)
+    _row_getter = attrgetter(*COLUMNS)
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name, ''))
+
+    @classmethod
+    def from_row(cls, values, row_no=None):
+        """
+        Creates an Order from worksheet row values (strings), turning
+        size_eu back into a float and order_no and row_no into ints
+        """
+        order = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            setattr(order, name, value)
+        for name in cls.__slots__[len(values):]:
+            setattr(order, name, '')
+        order.size_eu = _convert(float, order.size_eu)
+        order.order_no = _convert(int, order.order_no)
+        order.row_no = _convert(int, order.row_no if row_no is None
+                                else row_no)
+        return order
+
+    def to_row(self):
+        """
+        Returns the order as a list of worksheet values, columns A to K
+        """
+        return list(self._row_getter(self))
+
+    def cells(self, fields):
+        """
+        Returns fields of the order as a dict of column letter to value,
+        for a write of single cells
+        """
+        return {
+            COLUMN_LETTERS[COLUMNS.index(field)]: getattr(self, field)
+            for field in fields
+            }
+
+    def __repr__(self):
+        return f'Order({self.order_no!r}, row {self.row_no!r})'
+
+
+class Session:
+    """
+    State kept for one terminal session: the order being worked on, and
+    the row values it was last read or written as, which edits are
+    merged over
+    """
+    __slots__ = ('order', 'base')
+
+    def __init__(self):
+        self.order = Order()
+        self.base = self.order.to_row()
+
+
+def _convert(convert, value):
+    """
+    Converts value with convert, leaving it unchanged if that fails
+    """
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return value
@@ -0,0 +1,111 @@
+"""
+Worksheet registry. Each worksheet is looked up in the spreadsheet
+metadata once per process and the handle kept, so the order store never
+repeats the worksheet('orders') metadata call that run.py used to make
+for every read and write. Service sessions inherit the registry from
+the service process, so they make no lookup at all.
+
+A handle is looked up again only when the sheet structure has changed
+under it: when its grid looks too small for a write, or when a call
+fails because its range no longer fits or parses. Lookups made,
+refreshed and saved (one per worksheet call) are counted with the
+tracing counters.
+"""
+import threading
+from n3orthotics.tracing import count
+
+STRUCTURE_ERRORS = ('exceeds grid limits', 'Unable to parse range')
+
+
+class WorksheetRegistry:
+    """
+    Worksheets of one spreadsheet, each looked up on first use
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.worksheets = {}
+        self.lock = threading.Lock()
+
+    def worksheet(self, title):
+        """
+        Returns a handle for the worksheet named title, without any
+        lookup until it is first used
+        """
+        return RegisteredWorksheet(self, title)
+
+    def resolve(self, title):
+        """
+        Returns the worksheet named title, looking it up only once
+        """
+        worksheet = self.worksheets.get(title)
+        if worksheet is not None:
+            return worksheet
+        with self.lock:
+            if title not in self.worksheets:
+                self.worksheets[title] = self.spreadsheet.worksheet(title)
+                count('worksheet_lookups')
+            return self.worksheets[title]
+
+    def titles(self):
+        """
+        Returns the titles of every worksheet in the spreadsheet
+        """
+        count('worksheet_listings')
+        return [worksheet.title for worksheet in self.spreadsheet.worksheets()]
+
+    def add(self, title, rows, cols):
+        """
+        Adds a worksheet named title of rows by cols cells and keeps
+        its handle
+        """
+        with self.lock:
+            self.worksheets[title] = self.spreadsheet.add_worksheet(
+                title=title, rows=rows, cols=cols)
+            count('worksheets_added')
+            return self.worksheets[title]
+
+    def refresh(self, title):
+        """
+        Looks up the worksheet named title again, after its structure
+        has changed
+        """
+        with self.lock:
+            self.worksheets[title] = self.spreadsheet.worksheet(title)
+            count('worksheet_refreshes')
+            return self.worksheets[title]
+
+
+class RegisteredWorksheet:
+    """
+    Stands in for a worksheet held by a WorksheetRegistry. A call that
+    fails because the sheet structure changed is made once more after
+    refreshing the worksheet.
+    """
+
+    def __init__(self, registry, title):
+        self.registry = registry
+        self.title = title
+
+    def refresh(self):
+        """
+        Looks the worksheet up again, picking up a new grid size
+        """
+        self.registry.refresh(self.title)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.registry.resolve(self.title), name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            # run.py used to look the worksheet up for every call
+            count('worksheet_lookups_saved')
+            try:
+                return attribute(*args, **kwargs)
+            except Exception as error:  # pylint: disable=broad-except
+                if not any(text in f'{error}' for text in STRUCTURE_ERRORS):
+                    raise
+            worksheet = self.registry.refresh(self.title)
+            return getattr(worksheet, name)(*args, **kwargs)
+        return call
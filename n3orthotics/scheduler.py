@@ -0,0 +1,153 @@
+"""
+Print queue scheduler. Reads the orders ready for printing, groups them
+by EU size, arch height and insole width so each printer plate holds
+insoles of one geometry, and moves every order on a plate to SUBMITTED
+TO PRINT with one batched write per plate.
+
+Full plates are always scheduled. A part filled plate waits for more
+orders of its geometry unless its oldest order has waited longer than
+--max-wait hours, or --flush is given.
+
+Only DESIGNED orders are ready by default, as the status table only
+lets a DESIGNED order move to SUBMITTED TO PRINT. A lab that designs
+insoles at the printer can add --status ACCEPTED, and those orders go
+straight to SUBMITTED TO PRINT without passing through DESIGNED.
+
+Usage: python3 -m n3orthotics.scheduler [--plate-size 8] [--dry-run]
+"""
+import argparse
+import datetime
+from datetime import timezone
+from n3orthotics.exporter import parse_time
+from n3orthotics.order import Order
+from n3orthotics.status import apply_transition
+from n3orthotics.store import COLUMNS, open_store
+
+CHUNK_SIZE = 1000
+PLATE_SIZE = 8
+MAX_WAIT_HOURS = 24
+PRINT_STATUS = 'SUBMITTED TO PRINT'
+READY_STATUSES = ('DESIGNED',)
+# Statuses --status may add to the queue, see the module docstring
+QUEUE_STATUSES = ('ACCEPTED', 'DESIGNED')
+ORDER_STATUS = COLUMNS.index('order_status')
+
+
+def read_queue(store, statuses=READY_STATUSES, chunk_size=CHUNK_SIZE):
+    """
+    Returns the orders with one of statuses, grouped in a dict keyed by
+    (size_eu, height, width), each group in order number order
+    """
+    groups = {}
+    for chunk in store.iter_rows(chunk_size):
+        for row, values in chunk:
+            if len(values) <= ORDER_STATUS or \
+                    values[ORDER_STATUS] not in statuses:
+                continue
+            order = Order.from_row(values, row)
+            key = (order.size_eu, order.height, order.width)
+            groups.setdefault(key, []).append(order)
+    for orders in groups.values():
+        orders.sort(key=lambda order: f'{order.order_no}')
+    return groups
+
+
+def waited_since(orders):
+    """
+    Returns the earliest order date among orders, or None
+    """
+    dates = [parse_time(order.order_date) for order in orders]
+    dates = [date for date in dates if date is not None]
+    return min(dates) if dates else None
+
+
+def plan_plates(groups, plate_size=PLATE_SIZE, max_wait=MAX_WAIT_HOURS,
+                flush=False, now=None):
+    """
+    Packs each geometry group into plates of up to plate_size orders.
+    Returns a list of (geometry, orders), fullest and oldest plates
+    first, holding back part filled plates that have not waited long
+    enough.
+    """
+    now = now or datetime.datetime.now(timezone.utc)
+    cutoff = now - datetime.timedelta(hours=max_wait)
+    plates = []
+    for key, orders in groups.items():
+        for start in range(0, len(orders), plate_size):
+            plate = orders[start:start + plate_size]
+            if len(plate) < plate_size and not flush:
+                oldest = waited_since(plate)
+                if oldest is None or oldest > cutoff:
+                    continue
+            plates.append((key, plate))
+    plates.sort(key=lambda plate: (
+        -len(plate[1]), f'{plate[1][0].order_no}'))
+    return plates
+
+
+def submit_plate(store, orders, status=PRINT_STATUS, now=None):
+    """
+    Moves every order on a plate to status in one batched write, leaving
+    out orders changed by another session since the queue was read.
+    Returns the orders moved.
+    """
+    now = now or datetime.datetime.now(timezone.utc)
+    moved = set(apply_transition(
+        store, status,
+        {order.row_no: order.order_update for order in orders}, now))
+    orders = [order for order in orders if order.row_no in moved]
+    for order in orders:
+        order.order_status = status
+        order.order_update = now.isoformat()
+    return orders
+
+
+def schedule(store, plate_size=PLATE_SIZE, max_wait=MAX_WAIT_HOURS,
+             flush=False, statuses=READY_STATUSES, dry_run=False):
+    """
+    Plans and submits plates for the print queue in store. Returns the
+    list of plates, without the orders that could not be submitted.
+    """
+    plates = plan_plates(read_queue(store, statuses), plate_size, max_wait,
+                         flush)
+    if not dry_run:
+        plates = [
+            (key, submit_plate(store, orders)) for key, orders in plates]
+        plates = [(key, orders) for key, orders in plates if orders]
+    return plates
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--plate-size', type=int, default=PLATE_SIZE)
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT_HOURS,
+                        help='hours a part filled plate may wait')
+    parser.add_argument('--flush', action='store_true',
+                        help='schedule part filled plates straight away')
+    parser.add_argument('--status', action='append', choices=QUEUE_STATUSES,
+                        help='orders with this status are ready, by default '
+                        'only DESIGNED')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the plates without changing any order')
+    args = parser.parse_args(argv)
+    if args.plate_size < 1:
+        parser.error('--plate-size must be at least 1')
+
+    plates = schedule(open_store(), args.plate_size, args.max_wait,
+                      args.flush, tuple(args.status or READY_STATUSES),
+                      args.dry_run)
+    for plate_no, ((size_eu, height, width), orders) in enumerate(plates, 1):
+        order_nos = ', '.join(f'{order.order_no}' for order in orders)
+        print(f'Plate {plate_no}: EU {size_eu} {height} {width} '
+              f'({len(orders)}) {order_nos}')
+    total = sum(len(orders) for _, orders in plates)
+    action = 'would be' if args.dry_run else 'were'
+    print(f'{total} orders on {len(plates)} plates {action} submitted '
+          'to print.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Long lived order service. Loads run.py and the modules the order store
+is opened with once, then serves every terminal session on a unix socket
+from a forked child process with its own pseudo terminal, so sessions
+skip interpreter start up and the google imports. Each session opens its
+own store, reusing the OAuth token other processes saved to the token
+cache. The service itself opens no store, connections or threads, as a
+child forked while another thread holds a lock would find it held
+forever.
+
+Start with: python3 -m n3orthotics.service
+"""
+import asyncio
+import fcntl
+import os
+import pty
+import signal
+import socket
+import struct
+import sys
+import termios
+import time
+from n3orthotics import timing, tracing
+from n3orthotics.journal import DRAIN_TIMEOUT
+
+SERVICE_SOCKET = os.environ.get('N3_SERVICE_SOCKET', '/tmp/n3orthotics.sock')
+TERMINAL_ROWS = 24
+TERMINAL_COLS = 80
+READ_SIZE = 4096
+# Long enough for a stopping session to send its journal
+SESSION_GRACE = DRAIN_TIMEOUT + 5
+
+
+def start_session(run):
+    """
+    Forks a child running run.main() on a new pseudo terminal and
+    returns the child pid and the terminal's master file descriptor.
+    The child keeps only the terminal, closing the listening socket and
+    the sockets and terminals of other sessions it inherited, and stops
+    cleanly on SIGTERM.
+    """
+    pid, master = pty.fork()
+    if pid == 0:
+        os.environ['TERM'] = 'xterm-color'
+        timing.reset()
+        tracing.reset()
+        run.STORE.after_fork()
+        run.ALLOCATOR.after_fork()
+        # The terminal is on 0 to 2, and the store and allocator open
+        # their files and connections on first use
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        signal.signal(signal.SIGTERM, _stop)
+        try:
+            run.main()
+        except SystemExit:
+            pass
+        finally:
+            sys.stdout.flush()
+            run.STORE.close()
+            timing.write_report()
+            tracing.write_outputs()
+            os._exit(0)
+    fcntl.ioctl(
+        master, termios.TIOCSWINSZ,
+        struct.pack('HHHH', TERMINAL_ROWS, TERMINAL_COLS, 0, 0)
+        )
+    return pid, master
+
+
+def _stop(signum, frame):
+    """
+    SIGTERM handler of a session, exiting through run.main()'s clean up
+    so the journal is sent
+    """
+    sys.exit(0)
+
+
+def stop_session(pid):
+    """
+    Asks a session's child process to stop
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def end_session(pid, grace=SESSION_GRACE):
+    """
+    Stops a session's child process with SIGTERM, killing it if it is
+    still running after grace seconds, and waits for it to exit
+    """
+    stop_session(pid)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            return
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+
+async def serve_session(reader, writer, run):
+    """
+    Relays one socket connection to and from a new session's terminal
+    until either side closes
+    """
+    loop = asyncio.get_running_loop()
+    pid, master = start_session(run)
+    output = asyncio.Queue()
+
+    def read_terminal():
+        try:
+            data = os.read(master, READ_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            loop.remove_reader(master)
+        output.put_nowait(data)
+
+    async def relay_input():
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            os.write(master, data)
+        stop_session(pid)
+
+    loop.add_reader(master, read_terminal)
+    input_task = asyncio.ensure_future(relay_input())
+    try:
+        while True:
+            data = await output.get()
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        input_task.cancel()
+        loop.remove_reader(master)
+        await loop.run_in_executor(None, end_session, pid)
+        os.close(master)
+        try:
+            # Ends the connection even if a process forked meanwhile
+            # still holds the socket
+            writer.get_extra_info('socket').shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        writer.close()
+
+
+async def serve(run, path=SERVICE_SOCKET):
+    """
+    Accepts terminal sessions on the unix socket at path
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: serve_session(reader, writer, run), path=path
+        )
+    print(f'n3orthotics order service listening on {path}')
+    async with server:
+        await server.serve_forever()
+
+
+def preload():
+    """
+    Imports the modules the order store is opened with, without opening
+    it
+    """
+    # pylint: disable=import-outside-toplevel,unused-import
+    if os.environ.get('N3_FAKE_SHEETS', '0') != '0':
+        import n3orthotics.fakesheets
+    else:
+        with timing.timed('google imports'):
+            import n3orthotics.sheets
+
+
+def main():
+    """
+    Loads run.py and the store's modules, then serves sessions
+    """
+    import run
+    preload()
+    asyncio.run(serve(run))
+
+
+if __name__ == '__main__':
+    main()
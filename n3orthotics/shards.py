@@ -0,0 +1,469 @@
+"""
+Month shards of the order store. Orders are split over one store per
+month, picked by the YYMM at the start of their order number, so no
+single worksheet grows without end or reaches the sheets cell limit.
+Orders made before sharding was turned on stay in the original store,
+shard 0. Turned on with N3_SHARDS=month.
+
+Row numbers carry their shard: row 2610000002 is row 2 of the October
+2026 shard, and shard 0 keeps its row numbers unchanged. Inside each
+shard, column K holds the row number within that shard as before.
+
+Only the current month's shard takes new orders. Older shards are
+closed: their orders can still change status, so their reads are cached
+for no longer than the current shard's, but no rows are added, so an
+order number missing from their index only downloads them again after
+N3_CLOSED_SHARD_TTL seconds. The list of worksheet shards is kept for
+N3_SHARD_LIST_TTL seconds, as listing them fetches the spreadsheet's
+metadata.
+"""
+import datetime
+import glob
+import os
+import threading
+import time
+from datetime import timezone
+from n3orthotics.cache import CACHE_TTL, CachedWorksheet
+from n3orthotics.store import (
+    COLUMN_LETTERS, COLUMNS, INDEX_RELOAD, SEARCH_LIMIT, ConflictError,
+    OrderStore, SheetStore, SqliteStore, _row_slot
+    )
+
+SHARD_SPAN = 10 ** 6
+CLOSED_SHARD_TTL = float(os.environ.get('N3_CLOSED_SHARD_TTL', '3600'))
+SHARD_LIST_TTL = float(os.environ.get('N3_SHARD_LIST_TTL', '60'))
+LEGACY = 0
+ROW_NO_COLUMN = COLUMNS.index('row_no')
+ROW_NO_LETTER = COLUMN_LETTERS[ROW_NO_COLUMN]
+
+
+def month_key(order_no):
+    """
+    Returns the YYMM shard key of order_no, or None if it is not an
+    order number
+    """
+    order_no = f'{order_no}'.strip()
+    if len(order_no) != 10 or not order_no.isdigit():
+        return None
+    return parse_key(order_no[:4])
+
+
+def parse_key(name):
+    """
+    Returns the shard key written as YYMM in name, or None
+    """
+    if len(name) != 4 or not name.isdigit() or \
+            not 1 <= int(name[2:]) <= 12:
+        return None
+    return int(name)
+
+
+def current_key(now=None):
+    """
+    Returns the shard key new orders made at the datetime now go in
+    """
+    return int((now or datetime.datetime.now(timezone.utc)).strftime('%y%m'))
+
+
+def next_key(key):
+    """
+    Returns the shard key of the month after key
+    """
+    year, month = divmod(key, 100)
+    return (year + 1) * 100 + 1 if month == 12 else key + 1
+
+
+def split_row(row):
+    """
+    Returns (shard key, row within the shard) of a row number
+    """
+    return divmod(row, SHARD_SPAN)
+
+
+def join_row(key, row):
+    """
+    Returns the row number of row within the shard key
+    """
+    return key * SHARD_SPAN + row
+
+
+class ShardedStore(OrderStore):
+    """
+    Routes each call to the store of the shard it is for. Shard stores
+    are opened on first use, and the current month's shard is created
+    when its first order is added.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.stores = {}
+        # Closed shards found missing, which are never created later
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    def _store(self, key, create=False):
+        """
+        Returns the store of shard key, or None if the shard does not
+        exist and create is False
+        """
+        store = self.stores.get(key)
+        if store is not None or (key in self.missing and not create):
+            return store
+        with self.lock:
+            if key not in self.stores:
+                closed = key == LEGACY or key < current_key()
+                store = None
+                if key not in self.missing:
+                    store = self.shards.open(key, closed)
+                if store is None and not create:
+                    if closed:
+                        self.missing.add(key)
+                    return None
+                self.stores[key] = store or self.shards.create(key)
+                self.missing.discard(key)
+            return self.stores[key]
+
+    def _up(self, key, values):
+        """
+        Returns values read from shard key with its own row number in
+        column K turned into a sharded one
+        """
+        values = list(values)
+        slot = _row_slot(values)
+        if key != LEGACY and slot is not None:
+            values[ROW_NO_COLUMN] = f'{join_row(key, slot)}'
+        return values
+
+    def _found(self, key, found):
+        """
+        Returns (row, values) from shard key as sharded ones
+        """
+        return join_row(key, found[0]), self._up(key, found[1])
+
+    def _by_shard(self, rows):
+        """
+        Splits a dict of sharded row number to value into a dict of
+        shard key to a dict of shard row to value
+        """
+        shards = {}
+        for row, value in rows.items():
+            key, shard_row = split_row(row)
+            shards.setdefault(key, {})[shard_row] = value
+        return shards
+
+    def last_order_no(self):
+        for key in (current_key(), LEGACY):
+            store = self._store(key)
+            order_no = store and store.last_order_no()
+            if order_no:
+                return order_no
+        return None
+
+    def row_count(self):
+        key = current_key()
+        store = self._store(key)
+        return join_row(key, store.row_count() if store else 1)
+
+    def row_floor(self, when):
+        return join_row(current_key(when), 1)
+
+    def find_row(self, order_no):
+        found = self.find_order(order_no)
+        return found[0] if found else None
+
+    def find_order(self, order_no):
+        key = month_key(order_no)
+        keys = [LEGACY]
+        if key is not None:
+            # An order numbered just before the end of a month may have
+            # been given a row in the next month's shard
+            keys = [key, next_key(key), LEGACY]
+        for key in keys:
+            store = self._store(key)
+            found = store and store.find_order(order_no)
+            if found:
+                return self._found(key, found)
+        return None
+
+    def search_orders(self, query, limit=SEARCH_LIMIT):
+        found = []
+        for key in sorted(self.shards.keys(), reverse=True):
+            found += [
+                self._found(key, shard_found)
+                for shard_found in self._store(key).search_orders(
+                    query, limit - len(found))
+                ]
+            if len(found) >= limit:
+                break
+        return found
+
+    def get_row(self, row):
+        key, shard_row = split_row(row)
+        store = self._store(key)
+        if store is None:
+            return [''] * len(COLUMNS)
+        return self._up(key, store.get_row(shard_row))
+
+    def get_rows(self, rows):
+        return self._read_rows(rows, 'get_rows')
+
+    def current_row(self, row):
+        key, shard_row = split_row(row)
+        store = self._store(key)
+        if store is None:
+            return [''] * len(COLUMNS)
+        return self._up(key, store.current_row(shard_row))
+
+    def current_rows(self, rows):
+        return self._read_rows(rows, 'current_rows')
+
+    def _read_rows(self, rows, method):
+        """
+        Reads rows with one call of the store method named method per
+        shard, rows of shards that do not exist being empty
+        """
+        found = {}
+        for key, shard_rows in self._by_shard(dict.fromkeys(rows)).items():
+            store = self._store(key)
+            if store is None:
+                shard_found = {row: [''] * len(COLUMNS) for row in shard_rows}
+            else:
+                shard_found = getattr(store, method)(list(shard_rows))
+            found.update(
+                self._found(key, item) for item in shard_found.items())
+        return found
+
+    def iter_rows(self, chunk_size=1000, columns=None):
+        for key in sorted(self.shards.keys()):
+            for chunk in self._store(key).iter_rows(chunk_size, columns):
+                yield [self._found(key, found) for found in chunk]
+
+    def append_row(self, values):
+        self.append_rows([values])
+
+    def append_rows(self, rows):
+        shards = {}
+        for values in rows:
+            values = list(values)
+            slot = _row_slot(values)
+            if slot is None:
+                # Without a row number an order goes after the last row
+                # of the current month
+                key = current_key()
+            else:
+                key, shard_row = split_row(slot)
+                values[ROW_NO_COLUMN] = shard_row
+            shards.setdefault(key, []).append(values)
+        for key, shard_rows in shards.items():
+            self._store(key, create=True).append_rows(shard_rows)
+
+    def update_row(self, row, values):
+        self.update_rows({row: values})
+
+    def update_rows(self, rows):
+        for key, shard_rows in self._by_shard(rows).items():
+            self._store(key, create=True).update_rows({
+                shard_row: _down(values, shard_row)
+                for shard_row, values in shard_rows.items()
+                })
+
+    def update_cells(self, row, cells):
+        self.update_cells_batch({row: cells})
+
+    def update_cells_batch(self, cells_by_row):
+        for key, shard_rows in self._by_shard(cells_by_row).items():
+            self._store(key, create=True).update_cells_batch({
+                shard_row: _down_cells(cells, shard_row)
+                for shard_row, cells in shard_rows.items()
+                })
+
+    def update_cells_batch_checked(self, cells_by_row, expected):
+        stale = []
+        for key, shard_rows in self._by_shard(cells_by_row).items():
+            shard_stale = self._store(key, create=True)\
+                .update_cells_batch_checked(
+                    {
+                        shard_row: _down_cells(cells, shard_row)
+                        for shard_row, cells in shard_rows.items()
+                        },
+                    {
+                        shard_row: expected[join_row(key, shard_row)]
+                        for shard_row in shard_rows
+                        })
+            stale += [join_row(key, shard_row) for shard_row in shard_stale]
+        return stale
+
+    def update_row_checked(self, row, values, expected):
+        key, shard_row = split_row(row)
+        try:
+            self._store(key, create=True).update_row_checked(
+                shard_row, _down(values, shard_row), expected)
+        except ConflictError as error:
+            raise ConflictError(
+                row, expected, self._up(key, error.values)) from None
+
+    def update_cells_checked(self, row, cells, expected):
+        key, shard_row = split_row(row)
+        try:
+            self._store(key, create=True).update_cells_checked(
+                shard_row, _down_cells(cells, shard_row), expected)
+        except ConflictError as error:
+            raise ConflictError(
+                row, expected, self._up(key, error.values)) from None
+
+    def close(self):
+        for store in list(self.stores.values()):
+            store.close()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        for store in list(self.stores.values()):
+            store.after_fork()
+
+
+def _down(values, shard_row):
+    """
+    Returns values to write to a shard, a row number in column K being
+    replaced by the row within the shard
+    """
+    values = list(values)
+    if _row_slot(values) is not None:
+        values[ROW_NO_COLUMN] = shard_row
+    return values
+
+
+def _down_cells(cells, shard_row):
+    """
+    Returns cells to write to a shard, as _down does for whole rows
+    """
+    if ROW_NO_LETTER in cells and f'{cells[ROW_NO_LETTER]}'.strip():
+        cells = dict(cells, **{ROW_NO_LETTER: shard_row})
+    return cells
+
+
+class SheetShards:
+    """
+    Month shards held as worksheets named orders_YYMM, shard 0 being
+    the original orders worksheet
+    """
+
+    def __init__(self, registry, batch_writes=True):
+        self.registry = registry
+        self.batch_writes = batch_writes
+        # (worksheet titles, when they were listed)
+        self.listed = (frozenset(), None)
+
+    @staticmethod
+    def title(key):
+        """
+        Returns the worksheet title of shard key
+        """
+        return 'orders' if key == LEGACY else f'orders_{key:04d}'
+
+    def keys(self):
+        """
+        Returns the keys of every shard in the spreadsheet
+        """
+        keys = {LEGACY}
+        for title in self._titles():
+            key = parse_key(title[len('orders_'):])
+            if key is not None and title == self.title(key):
+                keys.add(key)
+        return sorted(keys)
+
+    def open(self, key, closed):
+        """
+        Returns a store for shard key, or None if it has no worksheet
+        """
+        title = self.title(key)
+        if key != LEGACY and title not in self._titles():
+            return None
+        return self._store(title, closed)
+
+    def _titles(self):
+        """
+        Returns the worksheet titles, listed again once they are
+        SHARD_LIST_TTL seconds old
+        """
+        titles, listed_at = self.listed
+        if listed_at is None or \
+                time.monotonic() - listed_at >= SHARD_LIST_TTL:
+            titles = frozenset(self.registry.titles())
+            self.listed = (titles, time.monotonic())
+        return titles
+
+    def create(self, key):
+        """
+        Adds the worksheet of shard key with its headings row
+        """
+        title = self.title(key)
+        try:
+            worksheet = self.registry.add(title, 1000, len(COLUMNS))
+        except Exception:  # pylint: disable=broad-except
+            # Another session may have just added it
+            if title not in self.registry.titles():
+                raise
+        else:
+            worksheet.update(
+                f'A1:{COLUMN_LETTERS[-1]}1', [list(COLUMNS)])
+        titles, listed_at = self.listed
+        self.listed = (titles | {title}, listed_at)
+        return self._store(title, False)
+
+    def _store(self, title, closed):
+        """
+        Returns a SheetStore over the worksheet title, the index of a
+        closed shard being reloaded on a miss only every
+        CLOSED_SHARD_TTL seconds. Reads are cached for CACHE_TTL either
+        way, as orders in closed shards still change status.
+        """
+        return SheetStore(
+            CachedWorksheet(self.registry.worksheet(title), CACHE_TTL),
+            self.batch_writes, CLOSED_SHARD_TTL if closed else INDEX_RELOAD)
+
+
+class SqliteShards:
+    """
+    Month shards held as SQLite files named after the original file,
+    orders_2610.sqlite3 beside orders.sqlite3, shard 0 being the
+    original file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root, self.extension = os.path.splitext(path)
+
+    def file(self, key):
+        """
+        Returns the file name of shard key
+        """
+        if key == LEGACY:
+            return self.path
+        return f'{self.root}_{key:04d}{self.extension}'
+
+    def keys(self):
+        """
+        Returns the keys of every shard file
+        """
+        keys = {LEGACY}
+        for path in glob.glob(f'{glob.escape(self.root)}_*{self.extension}'):
+            name = path[len(self.root) + 1:len(path) - len(self.extension)]
+            key = parse_key(name)
+            if key is not None and path == self.file(key):
+                keys.add(key)
+        return sorted(keys)
+
+    def open(self, key, closed):  # pylint: disable=unused-argument
+        """
+        Returns a store for shard key, or None if it has no file. A
+        closed shard's file is read like any other.
+        """
+        if key != LEGACY and not os.path.exists(self.file(key)):
+            return None
+        return SqliteStore(self.file(key))
+
+    def create(self, key):
+        """
+        Creates the file of shard key
+        """
+        return SqliteStore(self.file(key))
@@ -0,0 +1,30 @@
+"""
+Connects to the n3orthotics google sheets document using the service
+account credentials held in creds.json, through the pooled transport of
+transport.py
+"""
+from google.oauth2.service_account import Credentials
+from n3orthotics.timing import timed
+from n3orthotics.transport import authorize
+
+SCOPE = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive.file',
+    'https://www.googleapis.com/auth/drive'
+    ]
+CREDS_FILE = 'creds.json'
+SPREADSHEET = 'n3orthotics'
+
+
+def open_spreadsheet():
+    """
+    Authorizes a gspread client from creds.json and opens the
+    n3orthotics spreadsheet
+    """
+    with timed('credentials'):
+        creds = Credentials.from_service_account_file(CREDS_FILE)
+        scoped_creds = creds.with_scopes(SCOPE)
+    with timed('authorize'):
+        gspread_client = authorize(scoped_creds)
+    with timed('open spreadsheet'):
+        return gspread_client.open(SPREADSHEET)
@@ -0,0 +1,158 @@
+"""
+Order status rules and a bulk transition engine. STATUS_RULES lists, for
+each status in the production pipeline, the statuses an order may move
+to and whether its details can still be edited or the order canceled.
+
+The engine reads only columns H to J (date ordered, status and date
+updated) of every row in one pass, picks the orders a transition applies
+to and writes their new status back in one batch, leaving out any order
+changed by another session since the pass.
+
+Usage: python3 -m n3orthotics.status --from PENDING --to CANCELED
+           --older-than 30 [--dry-run]
+
+At least one of --from and --older-than is needed, or --all to move
+every order that can move to the target.
+"""
+import argparse
+import datetime
+from datetime import timezone
+from n3orthotics.exporter import last_changed
+from n3orthotics.store import COLUMNS, open_store
+
+CHUNK_SIZE = 1000
+ORDER_STATUS = COLUMNS.index('order_status')
+ORDER_UPDATE = COLUMNS.index('order_update')
+EDITABLE = ('UPDATED ORDER', 'CANCELED')
+# All a transition needs, last_changed falling back to the date ordered
+TRANSITION_COLUMNS = ('order_date', 'order_status', 'order_update')
+
+# status: (statuses it can move to, modifiable, cancelable)
+STATUS_RULES = {
+    'PENDING': (('NEW ORDER',) + EDITABLE, True, True),
+    'NEW ORDER': (('CREATED', 'ACCEPTED') + EDITABLE, True, True),
+    'UPDATED ORDER': (('CREATED', 'ACCEPTED') + EDITABLE, True, True),
+    'CREATED': (('ACCEPTED',) + EDITABLE, True, True),
+    'ACCEPTED': (('DESIGNED',) + EDITABLE, True, True),
+    'DESIGNED': (('SUBMITTED TO PRINT',) + EDITABLE, True, True),
+    'SUBMITTED TO PRINT': (('PRINTED',), False, False),
+    'PRINTED': (('DISPATCHED',), False, False),
+    'DISPATCHED': ((), False, False),
+    'CANCELED': ((), False, False),
+    }
+MOVES = {
+    (status, target)
+    for status, (targets, _, _) in STATUS_RULES.items()
+    for target in targets
+    }
+MODIFIABLE = frozenset(
+    status for status, rule in STATUS_RULES.items() if rule[1])
+CANCELABLE = frozenset(
+    status for status, rule in STATUS_RULES.items() if rule[2])
+
+
+def is_modifiable(status):
+    """
+    Checks if an order with status can still have its details edited
+    """
+    return status in MODIFIABLE
+
+
+def is_cancelable(status):
+    """
+    Checks if an order with status can still be canceled
+    """
+    return status in CANCELABLE
+
+
+def can_move(status, target):
+    """
+    Checks if an order with status is allowed to move to target
+    """
+    return (status, target) in MOVES
+
+
+def find_transitions(store, target, statuses=None, before=None,
+                     chunk_size=CHUNK_SIZE):
+    """
+    Returns the rows that can move to target in one pass over store, as
+    a dict of row number to the date updated read, limited to statuses
+    when given and to orders last changed before the datetime before
+    when given
+    """
+    rows = {}
+    for chunk in store.iter_rows(chunk_size, TRANSITION_COLUMNS):
+        rows.update(
+            (row, values[ORDER_UPDATE]) for row, values in chunk
+            if len(values) > ORDER_STATUS
+            and (statuses is None or values[ORDER_STATUS] in statuses)
+            and can_move(values[ORDER_STATUS], target)
+            and (before is None or _changed_before(values, before))
+            )
+    return rows
+
+
+def apply_transition(store, target, versions, now=None):
+    """
+    Moves the rows in versions, a dict of row number to the date
+    updated it was read with, to target with the date updated set to
+    now, in one batched write. Rows changed since they were read are
+    left as they are. Returns the rows moved.
+    """
+    order_update = (now or datetime.datetime.now(timezone.utc)).isoformat()
+    if not versions:
+        return []
+    stale = store.update_cells_batch_checked(
+        {row: {'I': target, 'J': order_update} for row in versions},
+        versions)
+    return [row for row in versions if row not in stale]
+
+
+def _changed_before(values, before):
+    """
+    Checks if a row was last changed before the datetime before
+    """
+    changed = last_changed(values)
+    return changed is not None and changed < before
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--from', dest='statuses', action='append',
+                        choices=sorted(STATUS_RULES),
+                        help='only orders with this status, can be repeated')
+    parser.add_argument('--to', dest='target', required=True,
+                        choices=sorted(STATUS_RULES))
+    parser.add_argument('--older-than', type=float,
+                        help='only orders not changed for this many days')
+    parser.add_argument('--all', action='store_true',
+                        help='move every order that can move, needed '
+                        'when neither --from nor --older-than is given')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='count the orders without changing any')
+    args = parser.parse_args(argv)
+    if args.statuses is None and args.older_than is None and not args.all:
+        parser.error('give --from or --older-than to choose the orders, '
+                     'or --all to move every order that can move')
+
+    now = datetime.datetime.now(timezone.utc)
+    before = None
+    if args.older_than is not None:
+        before = now - datetime.timedelta(days=args.older_than)
+    store = open_store()
+    rows = find_transitions(store, args.target, args.statuses, before)
+    if args.dry_run:
+        print(f'{len(rows)} orders would move to {args.target}.')
+        return
+    moved = apply_transition(store, args.target, rows, now)
+    print(f'{len(moved)} orders moved to {args.target}.')
+    if len(moved) < len(rows):
+        print(f'{len(rows) - len(moved)} orders were changed by another '
+              'session meanwhile and were left as they are.')
+
+
+if __name__ == '__main__':
+    main()
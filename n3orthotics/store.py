@@ -0,0 +1,945 @@
+"""
+Order store backends. Every read and write of order rows made by run.py
+goes through one of these, either the 'orders' google worksheet or a
+local SQLite database file.
+"""
+import atexit
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from n3orthotics.cache import CachedWorksheet
+from n3orthotics.index import OrderIndex, row_matches
+from n3orthotics.registry import WorksheetRegistry
+from n3orthotics.timing import mark, timed
+from n3orthotics.tracing import trace_spreadsheet
+
+COLUMNS = [
+    'f_name', 'l_name', 'user_email', 'size_eu', 'height', 'width',
+    'order_no', 'order_date', 'order_status', 'order_update', 'row_no'
+    ]
+COLUMN_LETTERS = 'ABCDEFGHIJK'
+ORDER_NO_COLUMN = COLUMNS.index('order_no')
+ORDER_UPDATE_COLUMN = COLUMNS.index('order_update')
+SEARCH_COLUMNS = tuple(
+    COLUMNS.index(name)
+    for name in ('f_name', 'l_name', 'user_email', 'order_date')
+    )
+SEARCH_LIMIT = 20
+# Seconds an order index is kept before a missing order reloads it
+INDEX_RELOAD = float(os.environ.get('N3_INDEX_RELOAD', '5'))
+# Fewest rows added to a worksheet grid at a time
+GROW_ROWS = 1000
+_fake_dir = None
+
+
+class ConflictError(Exception):
+    """
+    Raised by a checked write when the row's date updated (column J) is
+    no longer the one the caller read, holding the row's current values
+    """
+
+    def __init__(self, row, expected, values):
+        super().__init__(
+            f'Order row {row} was updated at '
+            f'"{values[ORDER_UPDATE_COLUMN]}", expected "{expected}"'
+            )
+        self.row = row
+        self.expected = expected
+        self.values = values
+
+
+class OrderStore:
+    """
+    Common interface for order store backends. Rows are numbered as they
+    are in the worksheet, row 1 holding the column headings and orders
+    starting on row 2. Row values are returned as lists of strings in
+    column order A to K.
+    """
+
+    def last_order_no(self):
+        """
+        Returns the order number in the last row as an int, or None if
+        there are no orders yet
+        """
+        raise NotImplementedError
+
+    def row_count(self):
+        """
+        Returns the number of rows in use, including the headings row
+        """
+        raise NotImplementedError
+
+    def find_row(self, order_no):
+        """
+        Returns the row number holding order_no, or None if not found
+        """
+        raise NotImplementedError
+
+    def row_floor(self, when):
+        """
+        Returns the row the allocator hands out new rows after for
+        orders made at the datetime when, the headings row unless the
+        store is split into shards
+        """
+        return 1
+
+    def get_row(self, row):
+        """
+        Returns the values of columns A to K of row
+        """
+        raise NotImplementedError
+
+    def get_rows(self, rows):
+        """
+        Returns a dict of row number to the values of each of rows
+        """
+        return {row: self.get_row(row) for row in rows}
+
+    def iter_rows(self, chunk_size=1000, columns=None):
+        """
+        Yields every order row as a list of (row, values) pairs, reading
+        chunk_size rows at a time. columns, a list of column names,
+        limits the read to the span of those columns, the values of
+        columns outside it being left empty.
+        """
+        raise NotImplementedError
+
+    def find_order(self, order_no):
+        """
+        Returns (row, values) for order_no, or None if not found
+        """
+        row = self.find_row(order_no)
+        if row is None:
+            return None
+        return row, self.get_row(row)
+
+    def search_orders(self, query, limit=SEARCH_LIMIT):
+        """
+        Returns up to limit (row, values) of the orders where every word
+        of query starts the first name, last name, email or order date,
+        ignoring case, newest first
+        """
+        found = [
+            (row, values)
+            for chunk in self.iter_rows()
+            for row, values in chunk
+            if row_matches(values, query, SEARCH_COLUMNS)
+            ]
+        return found[::-1][:limit]
+
+    def append_row(self, values):
+        """
+        Adds a new row with values, on the row number held in column K
+        when given, otherwise after the last row in use
+        """
+        raise NotImplementedError
+
+    def append_rows(self, rows):
+        """
+        Adds several new rows, each placed as append_row would
+        """
+        for values in rows:
+            self.append_row(values)
+
+    def update_row(self, row, values):
+        """
+        Replaces the values of row, starting at column A
+        """
+        raise NotImplementedError
+
+    def update_rows(self, rows):
+        """
+        Replaces the values of several rows, rows being a dict of
+        row number to values starting at column A
+        """
+        for row, values in rows.items():
+            self.update_row(row, values)
+
+    def update_cells(self, row, cells):
+        """
+        Replaces single cells of row, cells being a dict of
+        column letter to value such as {'I': 'CANCELED'}
+        """
+        raise NotImplementedError
+
+    def update_cells_batch(self, cells_by_row):
+        """
+        Replaces single cells of many rows, cells_by_row being a dict of
+        row number to a dict of column letter to value
+        """
+        for row, cells in cells_by_row.items():
+            self.update_cells(row, cells)
+
+    def current_row(self, row):
+        """
+        Returns the latest values of row, read past any cache
+        """
+        return self.get_row(row)
+
+    def current_rows(self, rows):
+        """
+        Returns a dict of row number to the latest values of each of
+        rows, read past any cache
+        """
+        return {row: self.current_row(row) for row in rows}
+
+    def update_row_checked(self, row, values, expected):
+        """
+        Replaces the values of row as update_row does, but only if its
+        date updated (column J) is still expected. Raises ConflictError
+        otherwise.
+        """
+        self.check_version(row, expected)
+        self.update_row(row, values)
+
+    def update_cells_checked(self, row, cells, expected):
+        """
+        Replaces single cells of row as update_cells does, but only if
+        its date updated (column J) is still expected. Raises
+        ConflictError otherwise.
+        """
+        self.check_version(row, expected)
+        self.update_cells(row, cells)
+
+    def update_cells_batch_checked(self, cells_by_row, expected):
+        """
+        Replaces single cells of many rows as update_cells_batch does,
+        leaving out the rows whose date updated is no longer
+        expected[row]. Returns the rows left out.
+        """
+        current = self.current_rows(list(cells_by_row))
+        stale = [
+            row for row in cells_by_row
+            if current[row][ORDER_UPDATE_COLUMN] != (expected[row] or '')
+            ]
+        self.update_cells_batch({
+            row: cells for row, cells in cells_by_row.items()
+            if row not in stale
+            })
+        return stale
+
+    def check_version(self, row, expected):
+        """
+        Raises ConflictError if the date updated of row is not expected
+        """
+        values = self.current_row(row)
+        if values[ORDER_UPDATE_COLUMN] != (expected or ''):
+            raise ConflictError(row, expected, values)
+
+    def close(self):
+        """
+        Sends any writes still buffered, called before a process exits
+        """
+
+    def after_fork(self):
+        """
+        Drops connections inherited from a parent process, called in a
+        forked child before it uses the store. Nothing is reopened until
+        the store is next used, so the child can close every descriptor
+        it inherited after calling this.
+        """
+
+
+class SheetStore(OrderStore):
+    """
+    Order store held in the 'orders' worksheet of the google sheet.
+    Order lookups are answered from an OrderIndex built from one download
+    of the worksheet, which is refreshed when an order is not found in
+    case another session has added it since, unless the index is less
+    than reload_after seconds old. The row of an order found in the
+    index is read again, through the cache, so changes other sessions
+    have made to it are seen.
+    Updates go out as one batched range request per call unless
+    batch_writes is False, which falls back to one request per cell.
+    The store may be shared by threads: lock guards the index, and
+    load_lock lets only one thread download the worksheet at a time.
+    """
+
+    def __init__(self, worksheet, batch_writes=True,
+                 reload_after=INDEX_RELOAD):
+        self.worksheet = worksheet
+        self.batch_writes = batch_writes
+        self.reload_after = reload_after
+        self.index = None
+        # Grid size as last seen, it only ever grows
+        self.grid_rows = None
+        self.loaded_at = 0.0
+        self.loads = 0
+        # Index changes made while a new index is being downloaded
+        self.pending = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def _load_index(self, refresh=False):
+        """
+        Downloads columns A to K once and indexes every row, dropping
+        any cached copy first when refresh is True. The new index only
+        replaces the old one once it is complete, and callers that were
+        waiting for another caller's download use its index.
+        """
+        loads = self.loads
+        with self.load_lock:
+            if self.loads != loads:
+                return
+            with self.lock:
+                self.pending = []
+            try:
+                if refresh and hasattr(self.worksheet, 'invalidate'):
+                    self.worksheet.invalidate('A:K')
+                index = OrderIndex(ORDER_NO_COLUMN, SEARCH_COLUMNS)
+                index.load(self.worksheet.get_values('A:K'))
+                with self.lock:
+                    # Writes made during the download may not be in it
+                    for method, args in self.pending:
+                        getattr(index, method)(*args)
+                    self.index = index
+                    self.loaded_at = time.monotonic()
+                    self.loads += 1
+            finally:
+                with self.lock:
+                    self.pending = None
+
+    def _index(self, method, *args):
+        """
+        Calls method of the index with args to keep it up to date with a
+        write, and of the index being downloaded if there is one
+        """
+        with self.lock:
+            if self.index is not None:
+                getattr(self.index, method)(*args)
+            if self.pending is not None:
+                self.pending.append((method, args))
+
+    def _lookup(self, order_no):
+        """
+        Returns (row, values) for order_no from the index
+        """
+        with self.lock:
+            return self.index.lookup(order_no)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.pending = None
+        client = getattr(self.worksheet, 'client', None)
+        session = getattr(client, 'session', None)
+        if session is not None:
+            session.close()
+
+    def last_order_no(self):
+        order_nos = self.worksheet.get_values('G:G')
+        try:
+            return int(order_nos[-1][0])
+        except (IndexError, ValueError):
+            return None
+
+    def row_count(self):
+        return len(self.worksheet.get_values('K:K'))
+
+    def find_row(self, order_no):
+        found = self.find_order(order_no)
+        return found[0] if found else None
+
+    def find_order(self, order_no):
+        if self.index is None:
+            self._load_index()
+        found = self._lookup(order_no)
+        if found is not None:
+            row = found[0]
+            values = self.get_row(row)
+            if values[ORDER_NO_COLUMN] == str(order_no):
+                self._index('put', row, values)
+                return row, values
+            # The row has been given to another order since the index
+            # was loaded
+        if time.monotonic() - self.loaded_at < self.reload_after:
+            return None
+        self._load_index(refresh=True)
+        return self._lookup(order_no)
+
+    def search_orders(self, query, limit=SEARCH_LIMIT):
+        if self.index is None:
+            self._load_index()
+        with self.lock:
+            return self.index.search(query, limit)
+
+    def get_row(self, row, worksheet=None):
+        worksheet = worksheet or self.worksheet
+        order_row = worksheet.get_values(f'A{row}:K{row}')
+        values = order_row[0] if order_row else []
+        return values + [''] * (len(COLUMNS) - len(values))
+
+    def get_rows(self, rows, worksheet=None):
+        worksheet = worksheet or self.worksheet
+        rows = sorted(set(rows))
+        if len(rows) < 2:
+            return {row: self.get_row(row, worksheet) for row in rows}
+        # One request for the span of rows rather than one per row
+        span = worksheet.get_values(f'A{rows[0]}:K{rows[-1]}')
+        found = {}
+        for row in rows:
+            offset = row - rows[0]
+            values = span[offset] if offset < len(span) else []
+            found[row] = values + [''] * (len(COLUMNS) - len(values))
+        return found
+
+    def current_row(self, row):
+        # The sheets API has no conditional write, so the check reads
+        # the row fresh just before writing, leaving only that short gap
+        return self.get_row(
+            row, getattr(self.worksheet, 'worksheet', self.worksheet))
+
+    def current_rows(self, rows):
+        return self.get_rows(
+            rows, getattr(self.worksheet, 'worksheet', self.worksheet))
+
+    def iter_rows(self, chunk_size=1000, columns=None):
+        # Read past any CachedWorksheet so paging does not flush the cache
+        worksheet = getattr(self.worksheet, 'worksheet', self.worksheet)
+        names = _column_span(columns)
+        first = COLUMN_LETTERS[COLUMNS.index(names[0])]
+        last = COLUMN_LETTERS[COLUMNS.index(names[-1])]
+        # A short page only means its last rows are empty, unwritten
+        # slots can leave whole pages empty, so paging goes on to the end
+        # of the grid, looked up again in case another session grew it
+        if hasattr(worksheet, 'refresh'):
+            worksheet.refresh()
+        end = worksheet.row_count
+        if self.index is not None:
+            end = max(end, self.index.last_row)
+        first_row = 2
+        while first_row <= end:
+            last_row = min(first_row + chunk_size - 1, end)
+            page = worksheet.get_values(f'{first}{first_row}:{last}{last_row}')
+            chunk = [
+                (row, _widen(names, values))
+                for row, values in enumerate(page, first_row) if any(values)
+                ]
+            if chunk:
+                yield chunk
+            first_row = last_row + 1
+
+    def append_row(self, values):
+        row = _row_slot(values)
+        if row is None:
+            self.worksheet.append_row(list(values))
+            self._index('append', values)
+            return
+        self._write_block(row, [values])
+
+    def append_rows(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        slots = [_row_slot(values) for values in rows]
+        first = slots[0]
+        if first is None or slots != list(range(first, first + len(rows))):
+            self.worksheet.append_rows([list(values) for values in rows])
+            for values in rows:
+                self._index('append', values)
+            return
+        self._write_block(first, rows)
+
+    def _write_block(self, first_row, rows):
+        """
+        Writes rows onto consecutive worksheet rows from first_row in
+        one request, adding grid rows first if the sheet is too short
+        """
+        last_row = first_row + len(rows) - 1
+        if self.grid_rows is None:
+            self.grid_rows = self.worksheet.row_count
+        if last_row > self.grid_rows:
+            # Another session may have grown the grid already, which
+            # only leaves some spare rows
+            self._grow(max(last_row - self.grid_rows, GROW_ROWS))
+        last_letter = COLUMN_LETTERS[max(len(values) for values in rows) - 1]
+        self.worksheet.update(
+            f'A{first_row}:{last_letter}{last_row}',
+            [list(values) for values in rows]
+            )
+        for row, values in enumerate(rows, first_row):
+            self._index('put', row, values)
+
+    def _grow(self, rows):
+        """
+        Adds rows to the end of the worksheet's grid. gspread's add_rows
+        resizes the grid to its cached row count plus rows, which
+        shrinks the grid if another session has grown it since, so the
+        rows are added with a relative appendDimension request instead.
+        Rows are added GROW_ROWS at a time at least, so most new orders
+        fit in the grid without a request.
+        """
+        self.worksheet.spreadsheet.batch_update({'requests': [{
+            'appendDimension': {
+                'sheetId': self.worksheet.id,
+                'dimension': 'ROWS',
+                'length': rows,
+                },
+            }]})
+        self.grid_rows += rows
+
+    def update_row(self, row, values):
+        if not self.batch_writes:
+            self.update_row_by_column(row, values)
+            return
+        last_letter = COLUMN_LETTERS[len(values) - 1]
+        self.worksheet.update(f'A{row}:{last_letter}{row}', [list(values)])
+        self._index('update', row, dict(enumerate(values)))
+
+    def update_rows(self, rows):
+        if not self.batch_writes:
+            for row, values in rows.items():
+                self.update_row_by_column(row, values)
+            return
+        self.worksheet.batch_update([
+            {
+                'range': f'A{row}:{COLUMN_LETTERS[len(values) - 1]}{row}',
+                'values': [list(values)],
+            }
+            for row, values in rows.items()
+            ])
+        for row, values in rows.items():
+            self._index('update', row, dict(enumerate(values)))
+
+    def update_row_by_column(self, row, values):
+        """
+        Fallback writing row one cell per request, columns A onwards
+        """
+        for letter, value in zip(COLUMN_LETTERS, values):
+            self.worksheet.update(f'{letter}{row}', value)
+        self._index('update', row, dict(enumerate(values)))
+
+    def update_cells(self, row, cells):
+        if self.batch_writes:
+            self.worksheet.batch_update([
+                {'range': f'{letter}{row}', 'values': [[value]]}
+                for letter, value in cells.items()
+                ])
+        else:
+            for letter, value in cells.items():
+                self.worksheet.update(f'{letter}{row}', value)
+        self._index('update', row, {
+            COLUMN_LETTERS.index(letter): value
+            for letter, value in cells.items()
+            })
+
+    def update_cells_batch(self, cells_by_row):
+        if not self.batch_writes:
+            for row, cells in cells_by_row.items():
+                self.update_cells(row, cells)
+            return
+        data = []
+        for row, cells in cells_by_row.items():
+            data.extend(_cell_ranges(row, cells))
+        if data:
+            self.worksheet.batch_update(data)
+        for row, cells in cells_by_row.items():
+            self._index('update', row, {
+                COLUMN_LETTERS.index(letter): value
+                for letter, value in cells.items()
+                })
+
+
+class SqliteStore(OrderStore):
+    """
+    Order store held in a local SQLite file, with the order_no column
+    indexed so lookups do not scan the table
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS orders ('
+            'row INTEGER PRIMARY KEY, '
+            + ', '.join(f'{column} TEXT' for column in COLUMNS)
+            + ')'
+            )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS orders_order_no ON orders (order_no)'
+            )
+        for column in SEARCH_COLUMNS:
+            # NOCASE indexes let SQLite use them for LIKE 'prefix%'
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS orders_{COLUMNS[column]}_search '
+                f'ON orders ({COLUMNS[column]} COLLATE NOCASE)'
+                )
+        self.connection.commit()
+
+    @property
+    def connection(self):
+        """
+        The connection to the SQLite file, opened on first use
+        """
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False)
+        return self._connection
+
+    def after_fork(self):
+        self._connection = None
+
+    def last_order_no(self):
+        found = self.connection.execute(
+            'SELECT order_no FROM orders ORDER BY row DESC LIMIT 1'
+            ).fetchone()
+        try:
+            return int(found[0])
+        except (TypeError, ValueError):
+            return None
+
+    def row_count(self):
+        found = self.connection.execute('SELECT MAX(row) FROM orders')
+        return found.fetchone()[0] or 1
+
+    def find_row(self, order_no):
+        found = self.find_order(order_no)
+        return found[0] if found else None
+
+    def find_order(self, order_no):
+        found = self.connection.execute(
+            f'SELECT row, {", ".join(COLUMNS)} FROM orders '
+            'WHERE order_no = ? ORDER BY row LIMIT 1',
+            (str(order_no),)
+            ).fetchone()
+        if found is None:
+            return None
+        return found[0], _from_sql(found[1:])
+
+    def search_orders(self, query, limit=SEARCH_LIMIT):
+        words = query.split()
+        if not words:
+            return []
+        # SQLite uses no index for LIKEs joined with OR, so the rows
+        # starting with the longest word are found with one indexed
+        # LIKE per column, and only those are checked for every word
+        candidates = ' UNION ALL '.join(
+            f"SELECT row FROM orders WHERE {COLUMNS[column]} "
+            "LIKE ? ESCAPE '\\'"
+            for column in SEARCH_COLUMNS
+            )
+        match = ' OR '.join(
+            f"{COLUMNS[column]} LIKE ? ESCAPE '\\'"
+            for column in SEARCH_COLUMNS
+            )
+        longest = _like_prefix(max(words, key=len))
+        parameters = [longest for _ in SEARCH_COLUMNS] + [
+            _like_prefix(word) for word in words for _ in SEARCH_COLUMNS
+            ]
+        found = self.connection.execute(
+            f'SELECT row, {", ".join(COLUMNS)} FROM orders WHERE row > 1 '
+            f'AND row IN ({candidates}) '
+            f'AND {" AND ".join(f"({match})" for _ in words)} '
+            'ORDER BY row DESC LIMIT ?', parameters + [limit]
+            ).fetchall()
+        return [(values[0], _from_sql(values[1:])) for values in found]
+
+    def iter_rows(self, chunk_size=1000, columns=None):
+        names = _column_span(columns)
+        last_row = 1
+        while True:
+            found = self.connection.execute(
+                f'SELECT row, {", ".join(names)} FROM orders '
+                'WHERE row > ? ORDER BY row LIMIT ?', (last_row, chunk_size)
+                ).fetchall()
+            if not found:
+                return
+            yield [
+                (values[0], _widen(names, _from_sql(values[1:])))
+                for values in found
+                ]
+            last_row = found[-1][0]
+
+    def get_row(self, row):
+        if row == 1:
+            return list(COLUMNS)
+        found = self.connection.execute(
+            f'SELECT {", ".join(COLUMNS)} FROM orders WHERE row = ?', (row,)
+            ).fetchone()
+        if found is None:
+            return [''] * len(COLUMNS)
+        return _from_sql(found)
+
+    def append_row(self, values):
+        self.append_rows([values])
+
+    def append_rows(self, rows):
+        insert = (
+            f'INSERT INTO orders (row, {", ".join(COLUMNS)}) '
+            f'VALUES ({", ".join("?" * (len(COLUMNS) + 1))})'
+            )
+        with self.connection:
+            next_row = self.row_count() + 1
+            for values in rows:
+                row = _row_slot(values) or next_row
+                next_row = max(next_row, row + 1)
+                values = [_to_text(value) for value in values][:len(COLUMNS)]
+                values += [''] * (len(COLUMNS) - len(values))
+                try:
+                    self.connection.execute(insert, [row] + values)
+                except sqlite3.IntegrityError:
+                    # A journal sending an append again after a crash
+                    # rewrites its own order, anything else is an error
+                    if self.get_row(row)[ORDER_NO_COLUMN] != \
+                            values[ORDER_NO_COLUMN]:
+                        raise
+                    self._set_cells(row, dict(zip(COLUMN_LETTERS, values)))
+
+    def update_row(self, row, values):
+        self.update_rows({row: values})
+
+    def update_rows(self, rows):
+        with self.connection:
+            for row, values in rows.items():
+                self._set_cells(row, dict(zip(COLUMN_LETTERS, values)))
+
+    def update_cells(self, row, cells):
+        with self.connection:
+            self._set_cells(row, cells)
+
+    def update_cells_batch(self, cells_by_row):
+        with self.connection:
+            for row, cells in cells_by_row.items():
+                self._set_cells(row, cells)
+
+    def update_row_checked(self, row, values, expected):
+        self.update_cells_checked(
+            row, dict(zip(COLUMN_LETTERS, values)), expected)
+
+    def update_cells_checked(self, row, cells, expected):
+        with self.connection:
+            if not self._set_cells(row, cells, expected or ''):
+                raise ConflictError(row, expected, self.get_row(row))
+
+    def update_cells_batch_checked(self, cells_by_row, expected):
+        with self.connection:
+            return [
+                row for row, cells in cells_by_row.items()
+                if not self._set_cells(row, cells, expected[row] or '')
+                ]
+
+    def _set_cells(self, row, cells, expected=None):
+        """
+        Runs the UPDATE for single cells of row, inside the caller's
+        transaction. With expected, only a row whose order_update is
+        expected is changed. Returns the number of rows changed.
+        """
+        columns = [COLUMNS[COLUMN_LETTERS.index(x)] for x in cells]
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        values = [_to_text(value) for value in cells.values()] + [row]
+        where = 'row = ?'
+        if expected is not None:
+            where += " AND COALESCE(order_update, '') = ?"
+            values.append(_to_text(expected))
+        return self.connection.execute(
+            f'UPDATE orders SET {assignments} WHERE {where}', values
+            ).rowcount
+
+
+class LazyStore:
+    """
+    Stands in for an order store until it is first used, so importing
+    run.py makes no network calls. warm() opens the store in a
+    background thread while the user is busy at the first prompts.
+    """
+
+    def __init__(self, opener):
+        self.opener = opener
+        self.store = None
+        self.lock = threading.Lock()
+        self.warming = None
+
+    def warm(self):
+        """
+        Starts opening the store in a background thread
+        """
+        if self.store is None and self.warming is None:
+            self.warming = threading.Thread(
+                target=self._warm, daemon=True, name='store warm')
+            self.warming.start()
+
+    def _warm(self):
+        """
+        Opens the store, leaving any error to be raised again by the
+        first real use of the store
+        """
+        try:
+            self._open()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    def open(self):
+        """
+        Returns the store, opening it first if that has not happened,
+        and records how long the caller was kept waiting
+        """
+        if self.store is None:
+            with timed('store wait'):
+                self._open()
+        return self.store
+
+    def _open(self):
+        """
+        Opens the store once, however many threads ask at the same time
+        """
+        with self.lock:
+            if self.store is None:
+                with timed('store open'):
+                    self.store = self.opener()
+                mark('store ready')
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.warming = None
+        if self.store is not None:
+            self.store.after_fork()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+
+def _cell_ranges(row, cells):
+    """
+    Returns batch_update entries for cells of row, as a single range
+    when the columns are next to each other
+    """
+    letters = sorted(cells, key=COLUMN_LETTERS.index)
+    first = COLUMN_LETTERS.index(letters[0])
+    if letters == list(COLUMN_LETTERS[first:first + len(letters)]):
+        return [{
+            'range': f'{letters[0]}{row}:{letters[-1]}{row}',
+            'values': [[cells[letter] for letter in letters]],
+            }]
+    return [
+        {'range': f'{letter}{row}', 'values': [[value]]}
+        for letter, value in cells.items()
+        ]
+
+
+def _row_slot(values):
+    """
+    Returns the row number held in column K of values, if any
+    """
+    try:
+        return int(values[COLUMNS.index('row_no')])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def _like_prefix(word):
+    """
+    Returns a LIKE pattern matching values starting with word
+    """
+    for special in '\\%_':
+        word = word.replace(special, '\\' + special)
+    return word + '%'
+
+
+def _column_span(columns):
+    """
+    Returns the names of the columns from the first to the last of
+    columns in worksheet order, every column when columns is None
+    """
+    if columns is None:
+        return COLUMNS
+    indexes = [COLUMNS.index(name) for name in columns]
+    return COLUMNS[min(indexes):max(indexes) + 1]
+
+
+def _widen(names, values):
+    """
+    Returns the values read for the columns names as a whole row, the
+    other columns left empty
+    """
+    read = dict(zip(names, values))
+    return [read.get(name, '') for name in COLUMNS]
+
+
+def _from_sql(values):
+    """
+    Converts a fetched SQLite row into a list of strings
+    """
+    return ['' if value is None else value for value in values]
+
+
+def _to_text(value):
+    """
+    Stores values as the text google sheets would return them as
+    """
+    return '' if value is None else str(value)
+
+
+def open_store(journal=None):
+    """
+    Opens the order store selected by the N3_ORDER_STORE environment
+    variable, 'sheets' (default) or 'sqlite', split into a store per
+    month when N3_SHARDS is set to 'month'. Writes go through the
+    write-behind journal unless N3_JOURNAL is set to 0.
+    """
+    store = open_backend()
+    if journal is None:
+        journal = os.environ.get('N3_JOURNAL', '1') != '0'
+    if not journal:
+        return store
+    from n3orthotics.journal import open_journal
+    return open_journal(store)
+
+
+def local_path(variable, name):
+    """
+    Returns the local file named by the environment variable, by default
+    name in the working directory. With N3_FAKE_SHEETS set the default
+    is name in a temporary directory removed when the process exits, as
+    the fake spreadsheet only lasts as long as the process and its
+    journal and counters must not be mixed with the real sheet's.
+    """
+    global _fake_dir
+    if variable in os.environ:
+        return os.environ[variable]
+    if os.environ.get('N3_FAKE_SHEETS', '0') == '0':
+        return name
+    if _fake_dir is None:
+        _fake_dir = tempfile.mkdtemp(prefix='n3orthotics-fake-')
+        atexit.register(shutil.rmtree, _fake_dir, ignore_errors=True)
+    return os.path.join(_fake_dir, name)
+
+
+def open_backend():
+    """
+    Opens the order store backend named by N3_ORDER_STORE, the sheets
+    backend using the offline fake in n3orthotics.fakesheets when
+    N3_FAKE_SHEETS is set
+    """
+    backend = os.environ.get('N3_ORDER_STORE', 'sheets')
+    sharding = os.environ.get('N3_SHARDS', '')
+    if sharding not in ('', 'month'):
+        raise ValueError(f'Unknown N3_SHARDS scheme "{sharding}"')
+    if backend == 'sqlite':
+        path = os.environ.get('N3_SQLITE_PATH', 'orders.sqlite3')
+        if sharding:
+            from n3orthotics.shards import ShardedStore, SqliteShards
+            return ShardedStore(SqliteShards(path))
+        return SqliteStore(path)
+    if backend == 'sheets':
+        if os.environ.get('N3_FAKE_SHEETS', '0') != '0':
+            from n3orthotics.fakesheets import open_spreadsheet
+        else:
+            with timed('google imports'):
+                from n3orthotics.sheets import open_spreadsheet
+        registry = WorksheetRegistry(trace_spreadsheet(open_spreadsheet()))
+        # Looked up now, so it happens while the store is warming up
+        registry.resolve('orders')
+        batch_writes = os.environ.get('N3_BATCH_WRITES', '1') != '0'
+        if sharding:
+            from n3orthotics.shards import ShardedStore, SheetShards
+            return ShardedStore(SheetShards(registry, batch_writes))
+        worksheet = registry.worksheet('orders')
+        return SheetStore(CachedWorksheet(worksheet), batch_writes)
+    raise ValueError(f'Unknown N3_ORDER_STORE backend "{backend}"')
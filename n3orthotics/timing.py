@@ -0,0 +1,77 @@
+"""
+Start up timing marks for tracking cold start regressions. When the
+N3_STARTUP_REPORT environment variable names a file, one JSON line of
+marks and durations (in milliseconds) is appended to it at exit.
+"""
+import atexit
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+START = time.perf_counter()
+STARTUP_REPORT = os.environ.get('N3_STARTUP_REPORT')
+MARKS = {}
+DURATIONS = {}
+LOCK = threading.Lock()
+
+
+def mark(name):
+    """
+    Records the time since start up at which name happened, once
+    """
+    with LOCK:
+        MARKS.setdefault(name, time.perf_counter() - START)
+
+
+@contextmanager
+def timed(name):
+    """
+    Records how long the block of code inside the with statement takes
+    """
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        with LOCK:
+            DURATIONS[name] = time.perf_counter() - began
+
+
+def reset():
+    """
+    Clears every mark and restarts the clock, used by forked sessions
+    """
+    global START
+    with LOCK:
+        START = time.perf_counter()
+        MARKS.clear()
+        DURATIONS.clear()
+
+
+def report():
+    """
+    Returns the marks and durations recorded so far in milliseconds
+    """
+    with LOCK:
+        return {
+            'pid': os.getpid(),
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'marks': {k: round(v * 1000, 3) for k, v in MARKS.items()},
+            'durations': {k: round(v * 1000, 3) for k, v in DURATIONS.items()},
+            }
+
+
+def write_report(path=STARTUP_REPORT):
+    """
+    Appends the timing report to the file at path as one JSON line
+    """
+    if not path:
+        return
+    with open(path, 'a', encoding='utf-8') as report_file:
+        report_file.write(json.dumps(report()) + '\n')
+
+
+if STARTUP_REPORT:
+    atexit.register(write_report)
@@ -0,0 +1,367 @@
+"""
+Remote call tracing for the google sheets backend. Wraps the spreadsheet
+so every worksheet() lookup and worksheet method call is timed, with the
+range asked for, the size of the reply and the menu step of run.py (or
+the background thread) that made it. The HTTP requests under those calls
+are timed as well, by the transport in transport.py.
+
+Turned on by any of:
+    N3_TRACE_LOG       file to append one JSON line per call to
+    N3_TRACE_METRICS   file to write Prometheus text format metrics to
+                       at exit, '{pid}' in the name being replaced by
+                       the process id
+    N3_TRACE_SUMMARY   set to 1 to print a summary per step at exit
+"""
+import atexit
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from datetime import timezone
+
+TRACE_LOG = os.environ.get('N3_TRACE_LOG')
+TRACE_METRICS = os.environ.get('N3_TRACE_METRICS')
+TRACE_SUMMARY = os.environ.get('N3_TRACE_SUMMARY', '0') != '0'
+ENABLED = bool(TRACE_LOG or TRACE_METRICS or TRACE_SUMMARY)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOCK = threading.Lock()
+STATE = {'step': 'start'}
+# (method, step) to [calls, seconds, chars]
+CALLS = {}
+# method to a count per bucket, the last one for slower calls
+HISTOGRAMS = {}
+# (method, error) to count
+ERRORS = {}
+# name to count, for events other than remote calls
+COUNTERS = {}
+# (HTTP method, status) to [requests, seconds]
+HTTP = {}
+# HTTP method to a count per bucket, as HISTOGRAMS
+HTTP_HISTOGRAMS = {}
+
+
+def set_step(name):
+    """
+    Names the menu step that following calls from the main thread are
+    made for
+    """
+    STATE['step'] = name
+
+
+def current_step():
+    """
+    Returns the menu step, or the thread name for background threads
+    """
+    thread = threading.current_thread()
+    if thread is threading.main_thread():
+        return STATE['step']
+    return thread.name
+
+
+def record(method, range_name, size, seconds, error=None):
+    """
+    Adds one remote call to the metrics and the log
+    """
+    step = current_step()
+    with LOCK:
+        totals = CALLS.setdefault((method, step), [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += size
+        _bucket(HISTOGRAMS.setdefault(
+            method, [0] * (len(BUCKETS) + 1)), seconds)
+        if error is not None:
+            key = (method, type(error).__name__)
+            ERRORS[key] = ERRORS.get(key, 0) + 1
+        if TRACE_LOG:
+            with open(TRACE_LOG, 'a', encoding='utf-8') as log_file:
+                log_file.write(json.dumps({
+                    'time': datetime.datetime.now(timezone.utc).isoformat(),
+                    'pid': os.getpid(),
+                    'step': step,
+                    'method': method,
+                    'range': range_name,
+                    'chars': size,
+                    'ms': round(seconds * 1000, 3),
+                    'error': None if error is None else f'{error}',
+                    }) + '\n')
+
+
+def _bucket(buckets, seconds):
+    """
+    Adds a call of seconds to its histogram bucket
+    """
+    buckets[next(
+        (i for i, bound in enumerate(BUCKETS) if seconds <= bound),
+        len(BUCKETS))] += 1
+
+
+def record_http(method, status, seconds):
+    """
+    Adds one HTTP request to the metrics and the log, seconds being the
+    time from sending it to its reply's headers
+    """
+    with LOCK:
+        totals = HTTP.setdefault((method, status), [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        _bucket(HTTP_HISTOGRAMS.setdefault(
+            method, [0] * (len(BUCKETS) + 1)), seconds)
+        if TRACE_LOG:
+            with open(TRACE_LOG, 'a', encoding='utf-8') as log_file:
+                log_file.write(json.dumps({
+                    'time': datetime.datetime.now(timezone.utc).isoformat(),
+                    'pid': os.getpid(),
+                    'step': current_step(),
+                    'http': method,
+                    'status': status,
+                    'ms': round(seconds * 1000, 3),
+                    }) + '\n')
+
+
+def count(name, amount=1):
+    """
+    Adds amount to the counter name, exported as n3_<name>_total
+    """
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+
+def reset():
+    """
+    Clears the metrics, used by forked sessions
+    """
+    with LOCK:
+        CALLS.clear()
+        HISTOGRAMS.clear()
+        ERRORS.clear()
+        COUNTERS.clear()
+        HTTP.clear()
+        HTTP_HISTOGRAMS.clear()
+    STATE['step'] = 'start'
+
+
+class TracedSpreadsheet:
+    """
+    Wraps a spreadsheet so worksheet() and add_worksheet() are traced and
+    return a TracedWorksheet
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def worksheet(self, title):
+        return self._lookup('worksheet', title)
+
+    def add_worksheet(self, title, rows, cols):
+        return self._lookup('add_worksheet', title, rows=rows, cols=cols)
+
+    def _lookup(self, method, title, **kwargs):
+        """
+        Makes a traced call returning a worksheet, and wraps it
+        """
+        began = time.perf_counter()
+        try:
+            worksheet = getattr(self.spreadsheet, method)(title, **kwargs)
+        except Exception as error:
+            record(method, title, 0, time.perf_counter() - began, error)
+            raise
+        record(method, title, 0, time.perf_counter() - began)
+        return TracedWorksheet(worksheet)
+
+    def __getattr__(self, name):
+        return getattr(self.spreadsheet, name)
+
+
+class TracedWorksheet:
+    """
+    Wraps a worksheet so every method call is traced. Other attributes
+    are passed straight through.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def __getattr__(self, name):
+        attribute = getattr(self.worksheet, name)
+        if not callable(attribute):
+            return attribute
+
+        def traced(*args, **kwargs):
+            range_name = _range_of(name, args, kwargs)
+            began = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as error:
+                record(name, range_name, 0, time.perf_counter() - began,
+                       error)
+                raise
+            record(name, range_name, _size_of(result),
+                   time.perf_counter() - began)
+            return result
+        return traced
+
+
+def _range_of(method, args, kwargs):
+    """
+    Returns the A1 range a worksheet call is for, if any
+    """
+    if method == 'batch_update' and args:
+        ranges = [entry.get('range', '') for entry in args[0]]
+        more = f',+{len(ranges) - 3}' if len(ranges) > 3 else ''
+        return ','.join(ranges[:3]) + more
+    range_name = kwargs.get('range_name', args[0] if args else None)
+    return range_name if isinstance(range_name, str) else None
+
+
+def _size_of(result):
+    """
+    Returns the characters of cell values in result, or the length of
+    a JSON reply
+    """
+    if isinstance(result, list):
+        return sum(
+            len(f'{cell}') for row in result
+            for cell in (row if isinstance(row, list) else [row])
+            )
+    if isinstance(result, dict):
+        return len(json.dumps(result, default=str))
+    return 0
+
+
+def metrics():
+    """
+    Returns the metrics in Prometheus text format
+    """
+    lines = [
+        '# HELP n3_sheet_requests_total Remote worksheet calls.',
+        '# TYPE n3_sheet_requests_total counter',
+        ]
+    with LOCK:
+        calls = sorted(CALLS.items())
+        histograms = sorted(HISTOGRAMS.items())
+        errors = sorted(ERRORS.items())
+        counters = sorted(COUNTERS.items())
+        http = sorted(HTTP.items())
+        http_histograms = sorted(HTTP_HISTOGRAMS.items())
+    lines += [
+        f'n3_sheet_requests_total{{method="{method}",step="{step}"}} '
+        f'{totals[0]}'
+        for (method, step), totals in calls
+        ]
+    lines += [
+        '# HELP n3_sheet_response_chars_total Characters of cell values '
+        'returned.',
+        '# TYPE n3_sheet_response_chars_total counter',
+        ]
+    lines += [
+        f'n3_sheet_response_chars_total{{method="{method}",step="{step}"}} '
+        f'{totals[2]}'
+        for (method, step), totals in calls
+        ]
+    lines += [
+        '# HELP n3_sheet_request_seconds Remote worksheet call duration.',
+        '# TYPE n3_sheet_request_seconds histogram',
+        ]
+    for method, buckets in histograms:
+        total = 0
+        for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+            total += bucket
+            lines.append(
+                f'n3_sheet_request_seconds_bucket{{method="{method}",'
+                f'le="{bound}"}} {total}')
+        seconds = sum(
+            totals[1] for (name, _), totals in calls if name == method)
+        lines.append(
+            f'n3_sheet_request_seconds_sum{{method="{method}"}} {seconds:.6f}')
+        lines.append(
+            f'n3_sheet_request_seconds_count{{method="{method}"}} {total}')
+    lines += [
+        '# HELP n3_sheet_errors_total Remote worksheet calls that failed.',
+        '# TYPE n3_sheet_errors_total counter',
+        ]
+    lines += [
+        f'n3_sheet_errors_total{{method="{method}",error="{error}"}} {total}'
+        for (method, error), total in errors
+        ]
+    lines += [
+        '# HELP n3_http_requests_total HTTP requests to the google APIs.',
+        '# TYPE n3_http_requests_total counter',
+        ]
+    lines += [
+        f'n3_http_requests_total{{method="{method}",status="{status}"}} '
+        f'{totals[0]}'
+        for (method, status), totals in http
+        ]
+    lines += [
+        '# HELP n3_http_request_seconds Time to the reply headers of HTTP '
+        'requests.',
+        '# TYPE n3_http_request_seconds histogram',
+        ]
+    for method, buckets in http_histograms:
+        total = 0
+        for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+            total += bucket
+            lines.append(
+                f'n3_http_request_seconds_bucket{{method="{method}",'
+                f'le="{bound}"}} {total}')
+        seconds = sum(
+            totals[1] for (name, _), totals in http if name == method)
+        lines.append(
+            f'n3_http_request_seconds_sum{{method="{method}"}} {seconds:.6f}')
+        lines.append(
+            f'n3_http_request_seconds_count{{method="{method}"}} {total}')
+    for name, value in counters:
+        lines += [f'# TYPE n3_{name}_total counter',
+                  f'n3_{name}_total {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """
+    Returns a table of remote calls, time and characters per step and method
+    """
+    with LOCK:
+        calls = sorted(CALLS.items(), key=lambda item: -item[1][1])
+        counters = sorted(COUNTERS.items())
+        http = sorted(HTTP.items())
+    lines = [f'{"step":<16} {"method":<14} {"calls":>6} {"ms":>10} '
+             f'{"chars":>10}']
+    lines += [
+        f'{step:<16} {method:<14} {totals[0]:>6} '
+        f'{totals[1] * 1000:>10.1f} {totals[2]:>10}'
+        for (method, step), totals in calls
+        ]
+    lines += [
+        f'{"HTTP " + method:<16} {status:<14} {totals[0]:>6} '
+        f'{totals[1] * 1000:>10.1f}'
+        for (method, status), totals in http
+        ]
+    lines += [f'{name}: {value}' for name, value in counters]
+    return '\n'.join(lines)
+
+
+def write_outputs():
+    """
+    Writes the metrics file and prints the summary, as turned on
+    """
+    if TRACE_METRICS:
+        path = TRACE_METRICS.replace('{pid}', f'{os.getpid()}')
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(metrics())
+        os.replace(f'{path}.tmp', path)
+    if TRACE_SUMMARY and CALLS:
+        print('\nRemote calls this session:\n' + summary(), file=sys.stderr)
+
+
+def trace_spreadsheet(spreadsheet):
+    """
+    Returns spreadsheet wrapped for tracing when tracing is turned on
+    """
+    return TracedSpreadsheet(spreadsheet) if ENABLED else spreadsheet
+
+
+if ENABLED:
+    atexit.register(write_outputs)
@@ -0,0 +1,145 @@
+"""
+HTTP transport for the gspread client. In place of the default session
+gspread.authorize builds, the client gets an authorized requests session
+with a sized keep-alive connection pool, retries of failed connections,
+connect and read timeouts, and the OAuth token shared between processes
+through a file, so a new process reuses a token another process has
+already fetched instead of making its own token exchange.
+
+Each HTTP request is timed into the tracing metrics when tracing is on.
+requests has no HTTP/2 support, so connections are HTTP/1.1 kept alive
+in the pool.
+
+Settings:
+    N3_HTTP_POOL_SIZE        connections kept open per host (10)
+    N3_HTTP_CONNECT_TIMEOUT  seconds to wait for a connection (5)
+    N3_HTTP_READ_TIMEOUT     seconds to wait for a reply (30)
+    N3_HTTP_RETRIES          times a failed connection is retried (2)
+    N3_TOKEN_CACHE           token file, empty to turn it off
+                             (token-cache.json)
+"""
+import datetime
+import json
+import os
+import threading
+import gspread
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from n3orthotics import tracing
+
+HTTP_POOL_SIZE = int(os.environ.get('N3_HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('N3_HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('N3_HTTP_READ_TIMEOUT', '30'))
+HTTP_RETRIES = int(os.environ.get('N3_HTTP_RETRIES', '2'))
+TOKEN_CACHE = os.environ.get('N3_TOKEN_CACHE', 'token-cache.json')
+# A cached token is only used with at least this long left to run
+TOKEN_MARGIN = datetime.timedelta(minutes=5)
+
+
+class TokenCache:
+    """
+    The access token of one set of credentials, kept in a file readable
+    only by its owner. The file is replaced in one step so a process
+    never reads half of it.
+    """
+
+    def __init__(self, path, credentials):
+        self.path = path
+        self.credentials = credentials
+        self.key = ' '.join([
+            getattr(credentials, 'service_account_email', ''),
+            *sorted(getattr(credentials, 'scopes', None) or [])
+            ])
+        self.saved = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Gives the credentials the cached token if it is for them and
+        still has TOKEN_MARGIN to run. Returns True if it was used.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            # google-auth keeps expiry as a naive UTC datetime
+            expiry = datetime.datetime.fromisoformat(cached['expiry'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if cached.get('key') != self.key or \
+                expiry - TOKEN_MARGIN < datetime.datetime.utcnow():
+            return False
+        self.credentials.token = cached['token']
+        self.credentials.expiry = expiry
+        self.saved = cached['token']
+        tracing.count('token_cache_hits')
+        return True
+
+    def save(self):
+        """
+        Writes the credentials' token to the file if it has changed
+        since it was last loaded or saved
+        """
+        token = self.credentials.token
+        expiry = self.credentials.expiry
+        if token is None or expiry is None or token == self.saved:
+            return
+        with self.lock:
+            if token == self.saved:
+                return
+            temporary = f'{self.path}.{os.getpid()}.tmp'
+            descriptor = os.open(
+                temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as cache_file:
+                json.dump({'key': self.key, 'token': token,
+                           'expiry': expiry.isoformat()}, cache_file)
+            os.replace(temporary, self.path)
+            self.saved = token
+            tracing.count('token_cache_writes')
+
+
+def open_session(credentials, pool_size=HTTP_POOL_SIZE,
+                 retries=HTTP_RETRIES, token_cache=TOKEN_CACHE):
+    """
+    Returns an AuthorizedSession for credentials with a keep-alive
+    pool of pool_size connections per host, the token shared through
+    the file token_cache when one is named
+    """
+    session = AuthorizedSession(
+        credentials,
+        refresh_timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    # Only connecting is retried here, as a write may have been applied
+    # before its reply was lost and the journal retries writes itself
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, connect=retries, read=0,
+                          status=0, backoff_factor=0.2))
+    session.mount('https://', adapter)
+    hooks = []
+    if token_cache:
+        cache = TokenCache(token_cache, credentials)
+        cache.load()
+        hooks.append(lambda response, *args, **kwargs: cache.save())
+    if tracing.ENABLED:
+        hooks.append(_time_request)
+    session.hooks['response'].extend(hooks)
+    return session
+
+
+def _time_request(response, *args, **kwargs):
+    """
+    Adds the time to a reply's headers to the tracing metrics
+    """
+    tracing.record_http(
+        response.request.method, response.status_code,
+        response.elapsed.total_seconds())
+
+
+def authorize(credentials):
+    """
+    Returns a gspread client for credentials using open_session, with
+    the connect and read timeouts set on every request
+    """
+    client = gspread.Client(credentials, open_session(credentials))
+    client.set_timeout((HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return client
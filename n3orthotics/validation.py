@@ -0,0 +1,182 @@
+"""
+Order field validation rules shared by the terminal prompts in run.py,
+the bulk importer and the JSON API. ORDER_RULES declares the rule for
+each field of an order record and is compiled once into ORDER_SCHEMA,
+which checks a single field, a whole record or a batch of records.
+Failures are FieldErrors, ValueErrors carrying the field, an error code
+and the value as well as the message for the user.
+"""
+import re
+
+REGEX = r'^[a-zA-Z0-9.!#$%&’*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*$'
+HEIGHTS = {'l': 'Low', 'm': 'Medium', 'h': 'High'}
+WIDTHS = {'n': 'Narrow', 's': 'Standard', 'w': 'Wide'}
+
+# field: (rule, rule options)
+ORDER_RULES = {
+    'f_name': ('name', {}),
+    'l_name': ('name', {}),
+    'user_email': ('email', {'pattern': REGEX}),
+    'size_eu': ('size', {'low': 19, 'high': 50, 'step': 0.5}),
+    'height': ('choice', {'choices': HEIGHTS, 'label': 'arch height'}),
+    'width': ('choice', {'choices': WIDTHS, 'label': 'insole width'}),
+    }
+
+
+class FieldError(ValueError):
+    """
+    A value that failed its rule. code is one of 'format', 'number',
+    'range', 'step', 'choice' or 'record' for a record that is not a
+    dict of fields.
+    """
+
+    def __init__(self, code, message, value=None, field=''):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.value = value
+        self.field = field
+
+    def to_dict(self):
+        """
+        Returns the error as a dict, for JSON replies and reports
+        """
+        return {'field': self.field, 'code': self.code,
+                'message': self.message}
+
+
+def remove_blank_space(string):
+    """
+    Removes all spaces in string inputs
+    """
+    return string.replace(' ', '')
+
+
+def name_rule():
+    """
+    Names must be letters only, returned with the first letter capitalized
+    """
+    def check(value):
+        name = remove_blank_space(str(value))
+        if not name.isalpha():
+            raise FieldError(
+                'format', f'The name you have provided "{value}" does not'
+                ' seem to be in a regular format', value)
+        return name.capitalize()
+    return check
+
+
+def email_rule(pattern):
+    """
+    Emails must match pattern, returned in lowercase
+    """
+    fullmatch = re.compile(pattern).fullmatch
+
+    def check(value):
+        email = remove_blank_space(str(value)).lower()
+        if not fullmatch(email):
+            raise FieldError(
+                'format', f'The email you have provided "{value}" does not'
+                ' seem to be in a regular format', value)
+        return email
+    return check
+
+
+def size_rule(low, high, step):
+    """
+    EU shoe sizes must be between low and high in step increments,
+    returned as a float
+    """
+    def check(value):
+        try:
+            size_eu = float(remove_blank_space(str(value)))
+        except ValueError as error:
+            raise FieldError(
+                'number', f'Invalid data : {error}', value) from error
+        if size_eu < low or size_eu > high:
+            raise FieldError(
+                'range', f'Unfortunatley {size_eu} is not within the'
+                ' European shoe size range we do.', value)
+        if size_eu % step != 0:
+            raise FieldError(
+                'step', 'Incorrect information provided for European'
+                f' shoe sizing: {size_eu}', value)
+        return size_eu
+    return check
+
+
+def choice_rule(choices, label):
+    """
+    Converts a value starting with one of the letters in choices into
+    its full name. Not case sensitive.
+    """
+    def check(value):
+        choice = remove_blank_space(str(value)).lower()
+        if choice[:1] not in choices:
+            raise FieldError(
+                'choice',
+                f'Incorrect information provided for {label}: {value}',
+                value)
+        return choices[choice[:1]]
+    return check
+
+
+RULES = {
+    'name': name_rule, 'email': email_rule, 'size': size_rule,
+    'choice': choice_rule,
+    }
+
+
+class Schema:
+    """
+    Record rules compiled into one check function per field, so
+    checking a record is a dict lookup and a call per field
+    """
+
+    def __init__(self, rules):
+        self.checks = {
+            field: RULES[rule](**options)
+            for field, (rule, options) in rules.items()
+            }
+
+    def check_field(self, field, value):
+        """
+        Returns the cleaned value of field, raising FieldError if it
+        fails its rule
+        """
+        try:
+            return self.checks[field](value)
+        except FieldError as error:
+            error.field = field
+            raise
+
+    def check(self, record):
+        """
+        Returns (values, errors) for a dict record, values being a dict
+        of field to cleaned value and errors a list of FieldErrors, one
+        per field that failed. values is None if there are errors.
+        """
+        if not isinstance(record, dict):
+            return None, [FieldError(
+                'record', f'Unreadable record: {record}', record)]
+        values = {}
+        errors = []
+        for field, check in self.checks.items():
+            value = record.get(field)
+            try:
+                values[field] = check('' if value is None else value)
+            except FieldError as error:
+                error.field = field
+                errors.append(error)
+        return (None if errors else values), errors
+
+    def check_many(self, records):
+        """
+        Returns a list of (values, errors), as check returns for each
+        of records
+        """
+        check = self.check
+        return [check(record) for record in records]
+
+
+ORDER_SCHEMA = Schema(ORDER_RULES)
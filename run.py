@@ -1,34 +1,37 @@
 """
 Contains all modules imported to provide and export live data such as
 operating system, email formats, current Coordinated Universal Timezone
-and google sheets
+and the order store (google sheets or local SQLite)
 """
 import os
-import re
 import datetime
 from datetime import timezone
-import gspread
-from google.oauth2.service_account import Credentials
-
-SCOPE = [
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive.file',
-    'https://www.googleapis.com/auth/drive'
-    ]
-
-CREDS = Credentials.from_service_account_file('creds.json')
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open('n3orthotics')
-REGEX = r'^[a-zA-Z0-9.!#$%&’*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*$'
-
-user_data = ['f_name', 'l_name', 'user_email']
-order_data = [
-    'size_eu', 'height', 'width', 'order_no', '', 'order_status', '', 'row_no'
-    ]
-update_order = ['order_status', 'order_update']
-export_data = []
-search_row = [0]
+from n3orthotics import timing, tracing
+from n3orthotics.allocator import open_allocator
+from n3orthotics.order import Order, Session
+from n3orthotics.status import is_cancelable, is_modifiable
+from n3orthotics.store import COLUMNS, ConflictError, LazyStore, open_store
+from n3orthotics.validation import (
+    ORDER_RULES, ORDER_SCHEMA, FieldError, remove_blank_space
+    )
+
+STORE = LazyStore(open_store)
+ALLOCATOR = open_allocator(STORE)
+WRITE_ATTEMPTS = 3
+USER_RETRY = '\nInvalid data: {error}. Please check the entry and try again.\n'
+SIZE_PROMPT = (
+    '\nWhat EU Shoe Size would you like to fit into?'
+    '\n(sized in 0.5 increments between 19 and 50): '
+    )
+HEIGHT_PROMPT = (
+    '\nWhat level of support under the inside arch would you like?'
+    '\n(L: Low Support / M: Medium Support / H: High Support): '
+    )
+WIDTH_PROMPT = (
+    '\nWidth of insole to fit the foot &/or shoe'
+    '\n(N: Narrow / S: Standard / W: Wide): '
+    )
+timing.mark('imports')
 
 
 def start():
@@ -46,24 +49,24 @@ def start():
 
 def select_option():
     """
-    Initial user choice to place a new or retrieve an existing N3D order
+    Initial user choice to place a new or retrieve an existing N3D order.
+    Returns the selection once it is one of those available.
     """
-    correct = input('Your Selection: ')
-    for selection in correct:
+    while True:
+        correct = input('Your Selection: ')
+        selection = correct[:1]
         if selection == '1':
-            return True
-        elif selection == '2':
+            return selection
+        if selection == '2':
             clear_screen()
             print('Retrieve an existing N3D insole order : \n')
-            display_order()
-        elif selection == '3':
+            return selection
+        if selection == '3':
             clear_screen()
-            quit()
-        else:
-            print(
-                f'The number you have provided "{correct}" is not available.')
-            print('Please select again\n')
-            select_option()
+            return selection
+        print(
+            f'The number you have provided "{correct}" is not available.')
+        print('Please select again\n')
 
 
 def instruct_user_data():
@@ -79,121 +82,80 @@ def instruct_user_data():
     print('Email: rubbertoez@yourdomain.com\n')
 
 
-def get_user_data():
+def get_user_data(order):
     """
     User input of first name, last name and email to from a string
     with fist letter capitalized for names and all lowercase email
     """
     f_name = remove_blank_space(input('Your First Name: ').capitalize())
-    validate_user_f_name(f'{f_name}')
-    f_name = user_data[0]
+    validate_user_f_name(order, f'{f_name}')
 
     l_name = remove_blank_space(input('Your Last Name: ').capitalize())
-    validate_user_l_name(f'{l_name}')
-    l_name = user_data[1]
+    validate_user_l_name(order, f'{l_name}')
 
     user_email = remove_blank_space(input('Your Email: ').lower())
-    validate_user_email(f'{user_email}')
-    user_email = user_data[2]
+    validate_user_email(order, f'{user_email}')
 
 
-def summary_user_data():
+def summary_user_data(order):
     """
-    Produces a readable summary of the current user_data list
+    Produces a readable summary of the user details of order
     """
-    print(f'Full Name : {user_data[0]} {user_data[1]}\nEmail : {user_data[2]}')
+    print(
+        f'Full Name : {order.f_name} {order.l_name}'
+        f'\nEmail : {order.user_email}'
+        )
 
 
-def summary_order_data():
+def summary_order_data(order):
     """
     Produces a summary of the current order data stored locally
     """
-    size_eu = order_data[0]
-    height = order_data[1]
-    width = order_data[2]
     print('\nYour order details are as follows:')
-    summary_user_data()
-    print(f'Shoe Size : EU {size_eu}')
-    print(f'Arch Height : {height}')
-    print(f'Insole Width : {width}')
+    summary_user_data(order)
+    print(f'Shoe Size : EU {order.size_eu}')
+    print(f'Arch Height : {order.height}')
+    print(f'Insole Width : {order.width}')
 
 
-def validate_user_f_name(values):
+def prompt_field(order, field, value, prompt, retry='\n{error}'):
     """
-    Inside the try, checks all user input syntax.
-    Raises ValueError if strings cannot be converted and prompts to
-    replace data in index [0] of the user_data list = f_name
+    Checks value against the order schema rule for field and sets it on
+    order. While it fails, prints the error with the retry format and
+    asks again with prompt. Returns the cleaned value.
     """
-    try:
-        if values.isalpha():
-            user_data[0] = values.capitalize()
-        else:
-            raise ValueError(
-                f'The name you have provided "{values}" does not seem'
-                f'\nto be in a regular format'
-            )
-    except ValueError as error:
-        print(
-            f'\nInvalid data: {error}. Please check the entry and try again.\n'
-            )
-        f_name = remove_blank_space(input('Your First Name : ').capitalize())
-        validate_user_f_name(f_name)
-        user_data[0] = f_name
+    while True:
+        try:
+            value = ORDER_SCHEMA.check_field(field, value)
+        except FieldError as error:
+            print(retry.format(error=error))
+            value = input(prompt)
+            continue
+        setattr(order, field, value)
+        return value
 
 
-def validate_user_l_name(values):
+def validate_user_f_name(order, values):
     """
-    Inside the try, checks all user input syntax.
-    Raises ValueError if strings cannot be converted and prompts to
-    replace data in index [1] of the user_data list = l_name
+    Sets the f_name of order, prompting again until it is a name
     """
-    try:
-        if values.isalpha():
-            user_data[1] = values.capitalize()
-        else:
-            raise ValueError(
-                f'The name you have provided "{values}" does not seem'
-                f'to be in a regular format'
-            )
-    except ValueError as error:
-        print(
-            f'\nInvalid data: {error}. Please check the entry and try again.\n'
-            )
-        l_name = remove_blank_space(input('Your Last Name : ').capitalize())
-        validate_user_l_name(l_name)
-        user_data[1] = l_name
+    prompt_field(order, 'f_name', values, 'Your First Name : ', USER_RETRY)
 
 
-def validate_user_email(values):
+def validate_user_l_name(order, values):
     """
-    Inside the try, checks all user email input syntax.
-    Raises ValueError if strings cannot be converted and prompts to
-    replace data in index [2] of the user_data list = user_email
+    Sets the l_name of order, prompting again until it is a name
     """
-    try:
-        if re.fullmatch(REGEX, values):
-            print('Email is valid...')
-            user_data[2] = values.lower()
-            clear_screen()
-        else:
-            raise ValueError(
-                f'The email you have provided "{values}" does not seem'
-                'to be in a regular format'
-            )
-    except ValueError as error:
-        print(
-            f'\nInvalid data: {error}. Please check the entry and try again.\n'
-            )
-        user_email = remove_blank_space(input('Your Email: ').lower())
-        validate_user_email(user_email)
-        user_data[2] = user_email
+    prompt_field(order, 'l_name', values, 'Your Last Name : ', USER_RETRY)
 
 
-def remove_blank_space(string):
+def validate_user_email(order, values):
     """
-    Removes all spaces in string inputs
+    Sets the user_email of order, prompting again until it is an email
     """
-    return string.replace(' ', '')
+    prompt_field(order, 'user_email', values, 'Your Email: ', USER_RETRY)
+    print('Email is valid...')
+    clear_screen()
 
 
 def get_latest_row_entry():
@@ -201,130 +163,68 @@ def get_latest_row_entry():
     Prints a list to the terminal of the row last updated
     between columns A to F in the worksheet
     """
-    orders = SHEET.worksheet('orders').get_values('A:G')
-    latest = orders[-1]
-    print(latest)
+    latest = STORE.get_row(STORE.row_count())
+    print(latest[0:7])
 
 
-def yes_no_user():
+def yes_no_user(session):
     """
-    Prompt for user to confirm or input correct user_data
+    Prompt for user to confirm or input correct user details.
+    Returns 'confirmed' once the order data is collected, or 'changed'
+    when the user has re-entered their details.
     """
-    summary_user_data()
+    order = session.order
+    summary_user_data(order)
     correct = input('\nIs this information correct? y/n: ').lower()
     if correct.startswith('y'):
         clear_screen()
-        f_name = user_data[0]
         print(
-            f'Thanks {f_name}. Now lets customise your N3 Orthoses order...'
+            f'Thanks {order.f_name}. Now lets customise your N3 Orthoses '
+            'order...'
             )
-        get_order_data()
-        generate_order_no()
-        combine_data_for_export()
-        summary_order_data()
-        submit_order()
-    else:
+        get_order_data(order)
         clear_screen()
-        get_user_data()
+        summary_order_data(order)
+        return 'confirmed'
+    clear_screen()
+    get_user_data(order)
+    clear_screen()
+    return 'changed'
 
 
-def get_order_data():
+def get_order_data(order):
     """
     Collection of User input used to order N3D Orthosis.
     """
-    get_size_data()
-    get_height_data()
-    get_width_data()
+    get_size_data(order)
+    get_height_data(order)
+    get_width_data(order)
 
 
-def get_size_data():
+def get_size_data(order):
     """
-    Converts to a float() between EU shoe size between EU19 and EU50 only.
-    Inside the try, converts all string values into floating points and
-    raises ValueError if not a number.
+    Converts to a float() between EU shoe size between EU19 and EU50 only,
+    asking again while the order schema rejects the input
     """
-    while True:
-        try:
-            size_eu = float(remove_blank_space(input(
-                '\nWhat EU Shoe Size would you like to fit into?'
-                '\n(sized in 0.5 increments between 19 and 50): '
-                )))
-            size_divisble = size_eu % 0.5
-
-            if size_eu >= 19 and size_eu <= 50:
-                if size_divisble != 0:
-                    print(
-                        '\nIncorrect information provided for European'
-                        f'shoe sizing: {size_eu}'
-                        )
-                    get_size_data()
-                else:
-                    order_data[0] = size_eu
-                    return size_eu
-            else:
-                print(
-                    f'\nUnfortunatley {size_eu} is not within the European'
-                    'shoe size range we do.'
-                    )
-                get_size_data()
-        except ValueError as error:
-            print(f'Invalid data : {error}, please try again.\n')
-            continue
+    return prompt_field(
+        order, 'size_eu', input(SIZE_PROMPT), SIZE_PROMPT,
+        '\n{error}\nPlease try again.')
 
 
-def get_height_data():
+def get_height_data(order):
     """
-    Height user input converted into ['Low', 'Med', 'High'] for order_data
+    Height user input converted into ['Low', 'Med', 'High'] for order
     Only strings starting with l, m or h accepted. Not case sensitive.
     """
-    height = remove_blank_space(input(
-        '\nWhat level of support under the inside arch would you like?'
-        '\n(L: Low Support / M: Medium Support / H: High Support): '
-        ).lower())
-    if height.startswith('l'):
-        order_data[1] = 'Low'
-    elif height.startswith('m'):
-        order_data[1] = 'Medium'
-    elif height.startswith('h'):
-        order_data[1] = 'High'
-    else:
-        print(f'\nIncorrect information provided for arch height: {height}')
-        get_height_data()
+    return prompt_field(order, 'height', input(HEIGHT_PROMPT), HEIGHT_PROMPT)
 
 
-def get_width_data():
+def get_width_data(order):
     """
     Width user input converted into ['Narrow', 'Standard', 'Wide'] for
-    order_data
-    """
-    width = remove_blank_space(input(
-        '\nWidth of insole to fit the foot &/or shoe'
-        '\n(N: Narrow / S: Standard / W: Wide): '
-        ).lower())
-    if width.startswith('n'):
-        order_data[2] = 'Narrow'
-    elif width.startswith('s'):
-        order_data[2] = 'Standard'
-    elif width.startswith('w'):
-        order_data[2] = 'Wide'
-    else:
-        print(f'\nIncorrect information provided for insole width: {width}')
-        get_width_data()
-
-
-def combine_data_for_export():
+    order
     """
-    Loops through user_data then order_data to create single export_data
-    list in preparation to update_order_worksheet
-    """
-    clear_screen()
-    export_data.clear()
-    for value in user_data:
-        export_data.append(value)
-    for value in order_data:
-        export_data.append(value)
-    export_data.pop()
-    return export_data
+    return prompt_field(order, 'width', input(WIDTH_PROMPT), WIDTH_PROMPT)
 
 
 def clear_screen():
@@ -339,36 +239,13 @@ def clear_screen():
         _ = os.system('cls')
 
 
-def slice_last_order_no():
+def generate_order_no(order):
     """
-    Steps order number back by one value to account for the heading information
-    within gsheets document.
+    Generates an order number with todays date + the next daily sequence
+    number handed out by the order number allocator
     """
-    order_no = SHEET.worksheet('orders').get_values('G:G')
-    last_index = len(order_no) - 1
-    last_entry = order_no[last_index]
-    last_entry_int = last_entry[0]
-    slice_last_digit = slice(6)
-    reset_no = int(last_entry_int[slice_last_digit])
-    reset_no_to_ten_thousand = reset_no * 10000
-    return reset_no_to_ten_thousand
-
-
-def generate_order_no():
-    """
-    Generates an order number with todays date + increment from previous
-    order entry in worksheet
-    """
-    order_no = SHEET.worksheet('orders').get_values('G:G')
-    last_index = len(order_no) - 1
-    last_entry = order_no[last_index]
-    last_entry_int = int(last_entry[0])
-    now = datetime.datetime.now(timezone.utc)
-    order_date = now.strftime('%y%m%d')
-    new_order_no = (
-        int(order_date)*10000) + (last_entry_int - slice_last_order_no() + 1)
-    order_data[3] = new_order_no
-    return new_order_no
+    order.order_no = ALLOCATOR.next_order_no()
+    return order.order_no
 
 
 def generate_utc_time():
@@ -379,41 +256,43 @@ def generate_utc_time():
     return iso_utc_now
 
 
-def update_date_ordered():
+def update_date_ordered(order):
+    """
+    Updates the order_date and status of order for a new order
+    """
+    order.order_date = generate_utc_time()
+    order.order_status = 'NEW ORDER'
+    order.order_update = ''
+
+
+def generate_row_no(order):
     """
-    Updates the order_date filed within order_data list
+    Reserves the next free worksheet row from the allocator
     """
-    time_zone = generate_utc_time()
-    order_data[4] = time_zone
-    order_data[5] = 'NEW ORDER'
+    order.row_no = ALLOCATOR.next_row_no()
 
 
-def generate_row_no():
+def mark_pending(order):
     """
-    Retrieves current row data length and extends it by 1 value
+    Sets the status and dates of order for an order saved as pending
     """
-    row_data = SHEET.worksheet('orders').get_values('K:K')
-    new_row_no = len(row_data) + 1
-    export_data.append(new_row_no)
+    order.order_update = generate_utc_time()
+    order.order_status = 'PENDING'
+    order.order_date = ''
 
 
-def update_to_pending_status():
+def update_to_pending_status(order):
     """
     Updates status to pending when user saves order
     """
-    time_zone = generate_utc_time()
-    export_data[9] = time_zone
-    export_data[8] = 'PENDING'
-    export_data[7] = ''
-    new_order_no = generate_order_no()
-    export_data[6] = new_order_no
-    generate_row_no()
-    order_worksheet = SHEET.worksheet('orders')
-    order_worksheet.append_row(export_data)
+    mark_pending(order)
+    generate_order_no(order)
+    generate_row_no(order)
+    STORE.append_row(order.to_row())
     clear_screen()
     print('Data successfully saved as PENDING.')
     print(
-        f'\nPlease carefully record order no : {export_data[6]}'
+        f'\nPlease carefully record order no : {order.order_no}'
         '\nYou will need it to recall this item into the future.'
         )
 
@@ -428,10 +307,16 @@ def input_order_no():
         'For example:\n'
         )
     print('Example order_no format: 2205190001\n')
+    print(
+        'Lost your order number? Enter your name, email or order date'
+        ' (YYYY-MM-DD)\ninstead to search for it.\n'
+        )
     while True:
+        entry = input('You Order Number: ')
+        if any(char.isalpha() or char in '@-' for char in entry):
+            return entry.strip()
         try:
-            order_no = int(remove_blank_space(input('You Order Number: ')))
-            search_row[0] = order_no
+            order_no = int(remove_blank_space(entry))
             order_no_string = str(order_no)
             if len(order_no_string) != 10:
                 raise ValueError(
@@ -447,92 +332,101 @@ def input_order_no():
         return order_no
 
 
-def flatten_nested_list(input_list):
+def retrieve_order():
     """
-    Flattens a nested list into a list
+    Looks up the user input in the order store's order_no index, or
+    searches for it when it is not an order number, and returns the
+    matching row number and row values.
+    Asks again until an order is found.
     """
-    flattened_list = []
-    for value in input_list:
-        if isinstance(value, list):
-            flattened_list.extend(flatten_nested_list(value))
+    while True:
+        search_input = input_order_no()
+        if isinstance(search_input, str):
+            found = choose_search_result(search_input)
         else:
-            flattened_list.append(value)
-    return flattened_list
+            found = STORE.find_order(str(search_input))
+            if found is None:
+                clear_screen()
+                print(f"Order number '{search_input}' NOT FOUND?\n")
+        if found is not None:
+            return found
 
 
-def retrieve_order():
+def choose_search_result(query):
     """
-    Searches worksheet coloum 'order_no' for a match to user input and
-    returns row information to local user_data, oder_data and export_data lists
+    Lists the orders matching query, with emails partly hidden, for the
+    user to pick one. Returns the chosen (row, values) or None.
     """
-    search_input = str(input_order_no())
-    order_nos_import = SHEET.worksheet('orders').get_values('G:G')
-    order_nos = flatten_nested_list(order_nos_import)
-    order_match = [
-        index_no for index_no in range(len(order_nos))
-        if order_nos[index_no] == search_input
-        ]
-    if order_match == []:
+    results = STORE.search_orders(query)
+    if not results:
         clear_screen()
-        print(f"Order number '{search_input}' NOT FOUND?\n")
-        retrieve_order()
-    else:
-        row_location = [
-            index_no for index_no, order_no in enumerate(order_nos, 1)
-            if order_no == search_input
-            ]
-        search_match_row = row_location[0]
-        search_row[0] = search_match_row
-
-
-def display_order():
-    """
-    Gets orders by row from worksheet
-    Converts specific string values back into integers and
-    Displays entire order as a list
-    """
-    retrieve_order()
-    row = search_row[0]
-    order_row = SHEET.worksheet('orders').get_values(f'A{row}:K{row}')
-    flat_order = flatten_nested_list(order_row)
-    size_eu = flat_order[3]
-    flat_order[3] = float(size_eu)
-    order_no = flat_order[6]
-    flat_order[6] = int(order_no)
-    user_data[0:3] = flat_order[0:3]
-    order_data[0:6] = flat_order[3:9]
-    order_data[7] = int(row)
-
-    combine_data_for_export()
+        print(f"No orders found matching '{query}'.\n")
+        return None
+    print(f'\nOrders matching {query}:\n')
+    for number, (_, values) in enumerate(results, 1):
+        print(
+            f'{number}. {values[6]}  {values[0]} {values[1]}'
+            f'  {hide_email(values[2])}  {values[7][:10]}  {values[8]}'
+            )
+    selection = input('\nSelect an order, or press Enter to search again: ')
+    if selection.strip().isdigit() and \
+            1 <= int(selection) <= len(results):
+        return results[int(selection) - 1]
+    clear_screen()
+    return None
+
+
+def hide_email(email):
+    """
+    Hides all but the first letter of the name part of an email
+    """
+    name, _, domain = email.partition('@')
+    return f'{name[:1]}{"*" * (len(name) - 1)}@{domain}' if domain else email
+
+
+def display_order(session):
+    """
+    Gets orders by row from worksheet into the session's Order,
+    which converts specific string values back into numbers, and
+    Displays entire order.
+    Returns 'found' once an order is displayed.
+    """
+    # Order's slots come from COLUMNS, which pylint cannot follow
+    # pylint: disable=no-member
+    row, flat_order = retrieve_order()
+    order = session.order = Order.from_row(flat_order, row)
+    session.base = flat_order
+
+    clear_screen()
     print('Your order details are as follows:\n')
     print(
-        f'Full Name : {user_data[0]} {flat_order[1]}\nEmail : {flat_order[2]}'
+        f'Full Name : {order.f_name} {order.l_name}'
+        f'\nEmail : {order.user_email}'
         )
     print(
-        f'Shoe Size : EU {flat_order[3]}'
-        f'\nArch Height : {flat_order[4]}'
-        f'\nInsole Width : {flat_order[5]}'
+        f'Shoe Size : EU {order.size_eu}'
+        f'\nArch Height : {order.height}'
+        f'\nInsole Width : {order.width}'
         )
     print(
-        f'Order No. : {flat_order[6]}'
-        f'\nDate Ordered : {flat_order[7]}'
-        f'\nCurrent Status : {flat_order[8]}')
+        f'Order No. : {order.order_no}'
+        f'\nDate Ordered : {order.order_date}'
+        f'\nCurrent Status : {order.order_status}')
     print(f'Row : {flat_order[10]}\n')
-    update_status()
+    return 'found'
 
 
-def validate_change_feature_of_order():
+def validate_change_feature_of_order(session):
     """
     Validates order is prior to 'SUBMITTED TO PRINT' stage for
-    change_feature_of_order function
+    change_feature_of_order function.
+    Returns 'modifiable' after listing the details that can be edited,
+    otherwise 'locked'.
     """
-    row = order_data[7]
-    order_row = SHEET.worksheet('orders').get_values(f'A{row}:K{row}')
-    flat_order = flatten_nested_list(order_row)
+    order = session.order
+    flat_order = STORE.get_row(order.row_no)
     print(f'Current order status is: {flat_order[8]}')
-    if flat_order[8] == 'PENDING' or flat_order[8] == 'NEW ORDER' or \
-            flat_order[8] == 'UPDATED ORDER' or flat_order[8] == 'CREATED' or \
-            flat_order[8] == 'ACCEPTED' or flat_order[8] == 'DESIGNED':
+    if is_modifiable(flat_order[8]):
         print('Order is modifiable.')
         print('\nYour order details are as follows:\n')
         print(
@@ -543,90 +437,87 @@ def validate_change_feature_of_order():
             )
         print('\nDetails you can edit:\n')
         print(
-            f'1. First Name : {user_data[0]}'
-            f'\n2. Surname : {user_data[1]}'
-            f'\n3. Email : {user_data[2]}'
+            f'1. First Name : {order.f_name}'
+            f'\n2. Surname : {order.l_name}'
+            f'\n3. Email : {order.user_email}'
             )
         print(
-            f'4. Shoe Size : EU {order_data[0]}'
-            f'\n5. Arch Height : {order_data[1]}'
-            f'\n6. Insole Width : {order_data[2]}\n'
+            f'4. Shoe Size : EU {order.size_eu}'
+            f'\n5. Arch Height : {order.height}'
+            f'\n6. Insole Width : {order.width}\n'
             )
         print(
             '7. Submit the above details'
             '\n8. Take me Home\n'
             )
-        change_feature_of_order()
-    else:
-        print(
-            f'\nAt the {flat_order[8]} stage, this order is beyond the point'
-            ' in production\nwhere modifications can occur.'
-            )
-        email_print_update_startover()
+        return 'modifiable'
+    print(
+        f'\nAt the {flat_order[8]} stage, this order is beyond the point'
+        ' in production\nwhere modifications can occur.'
+        )
+    return 'locked'
 
 
-def change_feature_of_order():
+def change_feature_of_order(session):
     """
-    Generates a list to choose which feature of an existing order to change
+    Generates a list to choose which feature of an existing order to change.
+    Returns 'edited', 'submitted', 'home' or 'invalid'.
     """
+    order = session.order
     feature_selection = input('Your Selection : ')
     if feature_selection == '1':
         clear_screen()
         f_name = input('New First Name details: ')
         clear_screen()
-        validate_user_f_name(f_name)
-        f_name = user_data[0]
-        validate_change_feature_of_order()
+        validate_user_f_name(order, f_name)
     elif feature_selection == '2':
         clear_screen()
         l_name = input('New Last Name details: ')
         clear_screen()
-        validate_user_l_name(l_name)
-        l_name = user_data[1]
-        validate_change_feature_of_order()
+        validate_user_l_name(order, l_name)
     elif feature_selection == '3':
         clear_screen()
         user_email = input('New Email details: ')
-        validate_user_email(user_email)
-        user_email = user_data[2]
-        validate_change_feature_of_order()
+        validate_user_email(order, user_email)
     elif feature_selection == '4':
         clear_screen()
-        get_size_data()
+        get_size_data(order)
         clear_screen()
-        validate_change_feature_of_order()
     elif feature_selection == '5':
         clear_screen()
-        get_height_data()
+        get_height_data(order)
         clear_screen()
-        validate_change_feature_of_order()
     elif feature_selection == '6':
         clear_screen()
-        get_width_data()
+        get_width_data(order)
         clear_screen()
-        validate_change_feature_of_order()
     elif feature_selection == '7':
-        update_date_ordered()
-        combine_data_for_export()
-        submit_row_data()
+        expected = order.order_update
+        update_date_ordered(order)
+        clear_screen()
+        submit_row_data(order, expected, session.base)
+        session.base = order.to_row()
+        return 'submitted'
     elif feature_selection == '8':
-        combine_data_for_export()
-        main()
+        clear_screen()
+        return 'home'
     else:
         print(
             f'The number you have provided "{feature_selection}" is not part'
             'of this selection.'
             )
         print('Please select again\n')
-        validate_change_feature_of_order()
+        return 'invalid'
+    return 'edited'
 
 
-def update_status():
+def update_status(session):
     """
     Generates a list of user options to append details of an exsisting order to
-    create new order details and/or navigate through the system
+    create new order details and/or navigate through the system.
+    Returns the selection, or 'invalid' if it is not available.
     """
-    order_no = order_data[3]
+    order_no = session.order.order_no
     print(f'What would you like to do with order no. {order_no} ?')
     print('\nSelect 1. : Re-Print this order again (no changes)')
     print('Select 2. : Change the features')
@@ -635,82 +526,73 @@ def update_status():
     print('Select 5. : Search different order')
     print('Select 6. : Take me home\n')
     startover = input('Your Selection: ')
-
-    for selection in startover:
-        if selection == '1':
-            clear_screen()
-            print(f'Re-printing order number : {order_no}...')
-            submit_order()
-        elif selection == '2':
-            clear_screen()
-            print(f'Order No. {order_no}')
-            validate_change_feature_of_order()
-        elif selection == '3':
-            clear_screen()
-            print('Starting a new N3D insole order...')
-            yes_no_user()
-        elif selection == '4':
-            clear_screen()
-            print(f'Checking the current status of order no. {order_no} ...')
-            update_to_canceled_status()
-        elif selection == '5':
-            clear_screen()
-            display_order()
-        elif selection == '6':
-            clear_screen()
-            main()
-        else:
-            print(
-                f'The number you have provided "{startover}" is not available.'
-            )
-            print('Please select again\n')
-            email_print_update_startover()
-    iso_format_timezone = generate_utc_time()
-    update_order[1] = iso_format_timezone
+    selection = startover[:1]
+    if selection == '1':
+        clear_screen()
+        print(f'Re-printing order number : {order_no}...')
+    elif selection == '2':
+        clear_screen()
+        print(f'Order No. {order_no}')
+    elif selection == '3':
+        clear_screen()
+        print('Starting a new N3D insole order...')
+    elif selection == '4':
+        clear_screen()
+        print(f'Checking the current status of order no. {order_no} ...')
+    elif selection in ('5', '6'):
+        clear_screen()
+    else:
+        print(
+            f'The number you have provided "{startover}" is not available.'
+        )
+        print('Please select again\n')
+        return 'invalid'
+    return selection
 
 
 def cancel_confirm():
     """
-    Confirms the user input to cancel order and returns to main screen
+    Confirms the user input to cancel order. Returns False when the user
+    chooses to keep the order and return to the main screen
     """
     confirm = input('Are you sure you wish to cancel this order? y/n : ')
-    if confirm.startswith('y'):
-        return True
-    elif confirm.startswith('n'):
-        main()
+    return not confirm.startswith('n')
 
 
-def update_to_canceled_status():
+def update_to_canceled_status(session):
     """
-    Updates status to pending when user saves order
+    Updates status to canceled when the user confirms.
+    Returns 'canceled', 'kept' or 'locked'.
     """
-    row = order_data[7]
-    order_worksheet = SHEET.worksheet('orders')
-    print(f'Current order status is: {export_data[8]}')
-    if export_data[8] == 'PENDING' or export_data[8] == 'NEW ORDER' or \
-            export_data[8] == 'UPDATED ORDER' or export_data[8] == 'CREATED' \
-            or export_data[8] == 'ACCEPTED' or export_data[8] == 'DESIGNED':
+    order = session.order
+    status = order.order_status
+    print(f'Current order status is: {status}')
+    if is_cancelable(status):
         print('Order is modifiable.\n')
-        cancel_confirm()
-        iso_format_timezone = generate_utc_time()
-        export_data[9] = iso_format_timezone
-        export_data[8] = 'CANCELED'
-        order_worksheet.update(f'I{row}', f'{export_data[8]}')
-        order_worksheet.update(f'J{row}', f'{export_data[9]}')
+        if not cancel_confirm():
+            return 'kept'
+        expected = order.order_update
+        order.order_update = generate_utc_time()
+        order.order_status = 'CANCELED'
+        cells = {'I': order.order_status, 'J': order.order_update}
+        if not checked_write(order, expected, is_cancelable, lambda version:
+                             STORE.update_cells_checked(
+                                 order.row_no, cells, version)):
+            return 'locked'
         print('\nOrder successfully CANCELED.')
         print(
             f"An email with it's credit note details will be sent to"
-            f' {export_data[2]}'
+            f' {order.user_email}'
             )
         print(
-            f'\nPlease carefully record the order no. {export_data[6]}'
+            f'\nPlease carefully record the order no. {order.order_no}'
             '\nYou will need it to refer to this action into the future.'
             )
-        email_print_update_startover()
+        return 'canceled'
     else:
         print(
             '\nUnfortunatley as a custom made product, this order is now at'
-            f' the \n{export_data[8]} stage, manufacturing has commenced and'
+            f' the \n{status} stage, manufacturing has commenced and'
             ' the opportunity\nto alter or cancel the order has passed.'
             )
         print(
@@ -721,64 +603,134 @@ def update_to_canceled_status():
             '\nhttps://www.legislation.gov.uk/uksi/2000/2334/contents/made '
             '\nAlternately, contact info@northotics.com referring order '
             'number :'
-            f' {export_data[6]}'
+            f' {order.order_no}'
             '\n\nYour purchasing rights have not been affected.'
             )
-        email_print_update_startover()
+        return 'locked'
+
+
+def checked_write(order, expected, allowed, write, notify=None, base=None,
+                  fields=()):
+    """
+    Calls write(expected), which writes order only if its date updated
+    is still expected. If another session changed the order first, the
+    write is tried again over the latest version as long as allowed()
+    still accepts its status and that session has not changed any of
+    fields since order was read as the row values base. write should
+    only send fields, the status and the dates, so the other session's
+    changes to the rest of the order are kept.
+    Returns True once written. Otherwise False is returned and the
+    order takes the latest status, or every latest value when fields
+    were changed by both sessions. Messages for the user go to notify,
+    print by default.
+    """
+    notify = notify or print
+    for _ in range(WRITE_ATTEMPTS):
+        try:
+            write(expected)
+            return True
+        except ConflictError as conflict:
+            status = conflict.values[8]
+            expected = conflict.values[9]
+            if not allowed(status):
+                order.order_status = status
+                order.order_update = expected
+                notify(
+                    f'\nOrder No. {order.order_no} has just been moved to'
+                    f' {status}\nby another session, your change has not'
+                    ' been saved.'
+                    )
+                return False
+            latest = Order.from_row(conflict.values, order.row_no)
+            clashes = clashing_fields(order, base, latest, fields)
+            if clashes:
+                notify(
+                    f'\nOrder No. {order.order_no} has just been changed by'
+                    ' another session:\n' + ''.join(
+                        f'{field} : {getattr(latest, field)} (yours was '
+                        f'{getattr(order, field)})\n' for field in clashes)
+                    + 'Your change has not been saved, the order now holds'
+                    ' the latest details.'
+                    )
+                for field in COLUMNS:
+                    setattr(order, field, getattr(latest, field))
+                return False
+            notify('\nThis order was just updated elsewhere, retrying...')
+    notify('\nThis order is busy, please try again shortly.')
+    return False
 
 
-def submit_row_data():
+def edited_fields(order, base):
     """
-    Replaces the existing row data in the worksheet with updated data and
-    records the date of the order update
+    Returns the order details changed in order since it was read as the
+    row values base
     """
-    row = order_data[7]
-    order_worksheet = SHEET.worksheet('orders')
+    read = Order.from_row(base)
+    return [
+        field for field in ORDER_RULES
+        if getattr(order, field) != getattr(read, field)
+        ]
 
-    print(f'Accessing your order on row number : {row}')
-    iso_format_timezone = generate_utc_time()
-    export_data[9] = iso_format_timezone
-    export_data[8] = 'UPDATED ORDER'
-    order_worksheet.update(f'A{row}', export_data[0])
-    order_worksheet.update(f'B{row}', export_data[1])
-    order_worksheet.update(f'C{row}', export_data[2])
-    order_worksheet.update(f'D{row}', float(export_data[3]))
-    order_worksheet.update(f'E{row}', export_data[4])
-    order_worksheet.update(f'F{row}', export_data[5])
-    order_worksheet.update(f'G{row}', int(export_data[6]))
-    order_worksheet.update(f'H{row}', export_data[7])
-    order_worksheet.update(f'I{row}', export_data[8])
-    order_worksheet.update(f'J{row}', export_data[9])
 
-    print(f'\nOrder No. {export_data[6]} successfully updated!')
+def clashing_fields(order, base, latest, fields):
+    """
+    Returns the fields of order that the latest Order shows were also
+    changed, to something else, since order was read as base
+    """
+    if not fields:
+        return []
+    read = Order.from_row(base)
+    return [
+        field for field in fields
+        if getattr(latest, field) != getattr(read, field)
+        and getattr(latest, field) != getattr(order, field)
+        ]
+
+
+def submit_row_data(order, expected, base):
+    """
+    Writes the details changed since order was read as the row values
+    base, with the date of the order update, provided the order was last
+    updated at expected or the other changes made since can be merged
+    """
+    print(f'Accessing your order on row number : {order.row_no}')
+    fields = edited_fields(order, base)
+    order.order_update = generate_utc_time()
+    order.order_status = 'UPDATED ORDER'
+    cells = order.cells(
+        fields + ['order_date', 'order_status', 'order_update'])
+    if not checked_write(order, expected, is_modifiable, lambda version:
+                         STORE.update_cells_checked(
+                             order.row_no, cells, version),
+                         base=base, fields=fields):
+        return
+
+    print(f'\nOrder No. {order.order_no} successfully updated!')
     print('Thanks for using the N(3)Orthotics order submission app.\n')
-    update_status()
 
 
-def submit_order():
+def submit_order(session):
     """
     User choice to deny or confirm order submission.
-    Confirm compiles list from user_data and oder_data then exports it to
-    update_sales-worksheet function
+    Confirm completes the session's order then exports it to
+    update_order_worksheet function.
+    Returns 'submitted', or 'declined' to go on to save_order.
     """
     submit = input('\nWould you like to submit this order? y/n: ').lower()
     if submit.startswith('n'):
-        save_order()
-    else:
-        clear_screen()
-        generate_order_no()
-        update_date_ordered()
-        combine_data_for_export()
-        generate_row_no()
-        update_order_worksheet(export_data)
-        recent_order_no = export_data[6]
-        order_data[7] = export_data[10]
-        submitted_time = export_data[7]
-        print('Order Successfully Submitted!!')
-        print(f'\nYour order number is: {recent_order_no}')
-        print(f'Submitted on: {submitted_time}')
-        summary_order_data()
-        email_print_update_startover()
+        return 'declined'
+    order = session.order
+    clear_screen()
+    generate_order_no(order)
+    update_date_ordered(order)
+    generate_row_no(order)
+    update_order_worksheet(order.to_row())
+    session.base = order.to_row()
+    print('Order Successfully Submitted!!')
+    print(f'\nYour order number is: {order.order_no}')
+    print(f'Submitted on: {order.order_date}')
+    summary_order_data(order)
+    return 'submitted'
 
 
 def update_order_worksheet(data):
@@ -786,32 +738,31 @@ def update_order_worksheet(data):
     Update sales google worksheet, add new row with the list data provided
     """
     print('Contacting the mothership...')
-    order_worksheet = SHEET.worksheet('orders')
-    order_worksheet.append_row(data)
+    STORE.append_row(data)
     print('Information received...')
 
 
-def save_order():
+def save_order(session):
     """
     User decision to save order as pending within gsheets or
-    clear all local data and return to main screen
+    clear all local data and return to main screen.
+    Returns 'saved' or 'discarded'.
     """
     save = input('\nWould you like to save this order? y/n: ').lower()
     if save.startswith('n'):
-        order_data.clear()
-        export_data.clear()
+        session.order = Order()
         clear_screen()
-        main()
-    else:
-        export_data[7] = ''
-        update_to_pending_status()
-        email_print_update_startover()
+        return 'discarded'
+    update_to_pending_status(session.order)
+    session.base = session.order.to_row()
+    return 'saved'
 
 
-def email_print_update_startover():
+def email_print_update_startover(session):
     """
     User decision tree to navigate following a successful submission,
-    feature change, save or change of status
+    feature change, save or change of status.
+    Returns the selection once it is one of those available.
     """
     print('\nWhat would you like to do next?')
     print('Select 1. : Change the features of this Order')
@@ -819,51 +770,103 @@ def email_print_update_startover():
     print('Select 3. : Retrieve an existing N(3) order')
     print('Select 4. : Take Me Home')
     print('Select 5. : Exit the N(3)Orthotics order portal\n')
-    startover = input('Your Selection: ')
-    order_no = order_data[3]
-    for selection in startover:
+    while True:
+        startover = input('Your Selection: ')
+        order_no = session.order.order_no
+        selection = startover[:1]
         if selection == '1':
             clear_screen()
             print(f'Order No. {order_no}')
-            validate_change_feature_of_order()
         elif selection == '2':
             clear_screen()
             print('Starting a new N3D insole order...')
-            yes_no_user()
         elif selection == '3':
             clear_screen()
             print('Retrieve an Exsisting Order...\n')
-            display_order()
         elif selection == '4':
             print('Taking you to home page...\n')
-            clear_screen()
-            start()
-            select_option()
         elif selection == '5':
             print('Exiting this n3orthotics session...\n')
             clear_screen()
-            exit()
         else:
             print(
                 f'The number you have provided "{startover}" is not available.'
                 '\nPlease select again\n'
                 )
-            email_print_update_startover()
+            continue
+        return selection
 
 
-def main():
+def home_screen(session):  # pylint: disable=unused-argument
     """
-    Run all primary program functions
+    Clears the terminal and shows the start screen and its selection
     """
     clear_screen()
     start()
-    select_option()
+    timing.mark('welcome screen')
+    return select_option()
+
+
+def new_order_screen(session):
+    """
+    Collects the user details for a new order
+    """
     instruct_user_data()
-    get_user_data()
+    get_user_data(session.order)
     clear_screen()
-    yes_no_user()
-    summary_order_data()
-    combine_data_for_export()
+    return 'done'
+
+
+# Menu state machine: each state names the screen function to run and
+# the state to move to for each value that screen function returns.
+# A next state of None ends the session.
+MENU = {
+    'home': (home_screen, {
+        '1': 'user_details', '2': 'retrieve', '3': None}),
+    'user_details': (new_order_screen, {'done': 'confirm_user'}),
+    'confirm_user': (yes_no_user, {
+        'confirmed': 'submit_order', 'changed': 'confirm_user'}),
+    'submit_order': (submit_order, {
+        'submitted': 'next_step', 'declined': 'save_order'}),
+    'save_order': (save_order, {'saved': 'next_step', 'discarded': 'home'}),
+    'next_step': (email_print_update_startover, {
+        '1': 'edit_order', '2': 'confirm_user', '3': 'retrieve',
+        '4': 'home', '5': None}),
+    'retrieve': (display_order, {'found': 'order_options'}),
+    'order_options': (update_status, {
+        '1': 'submit_order', '2': 'edit_order', '3': 'confirm_user',
+        '4': 'cancel_order', '5': 'retrieve', '6': 'home',
+        'invalid': 'next_step'}),
+    'edit_order': (validate_change_feature_of_order, {
+        'modifiable': 'change_feature', 'locked': 'next_step'}),
+    'change_feature': (change_feature_of_order, {
+        'edited': 'edit_order', 'submitted': 'order_options',
+        'home': 'home', 'invalid': 'edit_order'}),
+    'cancel_order': (update_to_canceled_status, {
+        'canceled': 'next_step', 'kept': 'home', 'locked': 'next_step'}),
+    }
+
+
+def run_menu(session=None, state='home'):
+    """
+    Runs the menu for session from state until a screen leads to the
+    end of the session, one screen at a time without recursion
+    """
+    session = session or Session()
+    while state is not None:
+        screen, transitions = MENU[state]
+        tracing.set_step(state)
+        state = transitions[screen(session)]
+
+
+def main():
+    """
+    Run all primary program functions. The order store is opened in
+    the background while the user reads the welcome screen.
+    """
+    STORE.warm()
+    run_menu()
 
 
-main()
+if __name__ == '__main__':
+    main()